@@ -3,7 +3,7 @@ Application configuration for OG-Ollama-UI
 Loads from .env or environment variables
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -32,11 +32,152 @@ class AppConfig(BaseSettings):
 
     # Ollama
     OLLAMA_BASE_URL: str = "http://localhost:11434"
+    OLLAMA_BASE_URLS: List[str] = []  # multiple nodes; overrides OLLAMA_BASE_URL when set
+    OLLAMA_MAX_ATTEMPTS: int = 2  # nodes tried per request before giving up
+    OLLAMA_NODE_MAX_FAILURES: int = 3  # consecutive failures before a node is ejected
+    OLLAMA_NODE_EJECT_SECONDS: float = 30.0
+    OLLAMA_PROBE_INTERVAL: float = 15.0  # seconds between /api/ps probes (0 disables)
     OLLAMA_TIMEOUT: int = 300  # seconds
+    OLLAMA_API_MODE: str = "chat"  # "chat" (/api/chat) or "generate" (/api/generate)
+    OLLAMA_PREFIX_CACHE_SIZE: int = 1024  # prompt prefixes tracked for reuse metrics
+
+    # Upstream timing budgets (seconds). OLLAMA_TIMEOUT remains Ollama's total budget.
+    TIMEOUT_CONNECT: float = 5.0  # TCP/TLS connect
+    TIMEOUT_FIRST_BYTE: float = 120.0  # until the first streamed chunk (model load + prompt eval)
+    TIMEOUT_CHUNK_GAP: float = 30.0  # longest silence between streamed chunks
+    TIMEOUT_TOTAL: float = 60.0  # whole call, for providers other than Ollama
+    # Per-provider / per-model overrides, e.g. {"ollama:llama3.1:70b": {"first_byte": 300}}
+    TIMEOUT_OVERRIDES: Dict[str, Dict[str, float]] = {}
+
+    # Cross-provider failover and hedged streams
+    # Fallback chains per "provider:model", e.g. {"ollama:llama3.2": ["openai:gpt-4o-mini"]}
+    ROUTING_FALLBACKS: Dict[str, List[str]] = {}
+    ROUTING_HEDGE_ENABLED: bool = False  # race the next fallback when the first token is late
+    ROUTING_HEDGE_DELAY: float = 2.0  # seconds to wait before hedging until p95 TTFT is known
+    ROUTING_HEDGE_MIN_SAMPLES: int = 20  # TTFT samples needed to hedge at the observed p95
+
+    # Background health checks and per-provider circuit breakers
+    HEALTH_CHECK_INTERVAL: float = 15.0  # seconds between probe rounds (0 disables)
+    HEALTH_CHECK_TIMEOUT: float = 5.0  # seconds per provider probe
+    BREAKER_FAILURE_THRESHOLD: int = 5  # consecutive failures that open a breaker
+    BREAKER_RESET_TIMEOUT: float = 30.0  # seconds open before a half-open trial
+
+    # Model catalog cache for /api/models (stale-while-revalidate)
+    CATALOG_TTL: float = 60.0  # seconds a provider's model list is fresh
+    CATALOG_MAX_STALE: float = 3600.0  # seconds a stale list is served while refreshing
+    CATALOG_VALIDATE_MODELS: bool = True  # reject models missing from the catalog with 400
+    # Only these providers list every model they serve; others go to upstream unchecked
+    CATALOG_VALIDATE_PROVIDERS: List[str] = ["ollama"]
+
+    # Ollama model residency (warm-up, keep_alive, idle unloading)
+    RESIDENCY_WARM_MODELS: List[str] = []  # preloaded at startup
+    RESIDENCY_PINNED_MODELS: List[str] = []  # never unloaded (keep_alive=-1)
+    RESIDENCY_HOT_KEEP_ALIVE: str = "30m"  # keep_alive for models with recent traffic
+    RESIDENCY_COLD_KEEP_ALIVE: str = "5m"  # keep_alive otherwise (Ollama's default)
+    RESIDENCY_HOT_REQUESTS: int = 10  # requests within the window that make a model hot
+    RESIDENCY_WINDOW: float = 600.0  # seconds of traffic considered
+    RESIDENCY_UNLOAD_IDLE_AFTER: float = 0.0  # unload models idle this long (0 disables)
+    RESIDENCY_INTERVAL: float = 60.0  # seconds between idle checks
+
+    # Server-side conversation store
+    CONVERSATION_MAX_IN_MEMORY: int = 1024  # conversations kept in the in-memory LRU
+    CONVERSATION_SQLITE_PATH: Optional[str] = "conversations.sqlite3"  # empty keeps them in memory only
+
+    # Context-window-aware history trimming
+    # Context window in tokens per provider or "provider:model" (0 or missing = no trimming)
+    CONTEXT_WINDOWS: Dict[str, int] = {"ollama": 4096, "openai": 128000, "perplexity": 127000}
+    CONTEXT_POLICY: str = "system_recent"  # "sliding_window", "system_recent" or "summarize"
+    CONTEXT_RESERVE_TOKENS: int = 512  # room left for the reply when max_tokens is unset
+    CONTEXT_TRIM_TARGET: float = 0.75  # share of the budget kept after a trim
+    CONTEXT_SUMMARY_MODEL: str = "ollama:llama3.2"  # "provider:model" for summaries ("" disables)
+    CONTEXT_SUMMARY_MAX_TOKENS: int = 256
+
+    # Batch completions (/api/batch)
+    BATCH_CONCURRENCY_PER_MODEL: int = 4  # concurrent items per provider/model within a batch
+    BATCH_MAX_ITEMS: int = 10000  # requests per batch
+    BATCH_RETENTION: float = 3600.0  # seconds finished results stay available for resuming
+    BATCH_MAX_JOBS: int = 100  # finished batches retained
+    BATCH_MAX_RUNNING: int = 8  # batches running at once; more are rejected with 429
+    BATCH_MAX_ATTEMPTS: int = 5  # tries for items rejected with a Retry-After
+    BATCH_RETRY_MAX_WAIT: float = 30.0  # longer Retry-After (e.g. token quota) fails the item
+
+    # Async jobs (/api/jobs)
+    JOB_QUEUE_STORE: str = "sqlite"  # "sqlite" (survives restarts) or "memory"
+    JOB_QUEUE_SQLITE_PATH: str = "jobs.sqlite3"
+    JOB_WORKERS: int = 4  # concurrent jobs per process; 0 disables the workers
+    JOB_POLL_INTERVAL: float = 1.0  # seconds between queue checks when idle
+    JOB_MAX_ATTEMPTS: int = 5  # tries for jobs rejected with a Retry-After
+    JOB_RETENTION: float = 86400.0  # seconds finished jobs stay available
+    JOB_STALE_AFTER: float = 900.0  # seconds without a heartbeat before a running job is requeued
+
+    # Prometheus metrics (/metrics)
+    METRICS_ENABLED: bool = True
+
+    # Tracing
+    TRACING_ENABLED: bool = False
+    TRACING_EXPORTER: str = "log"  # "log", "otlp" or "memory"
+    TRACING_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+    TRACING_SERVICE_NAME: str = "og-ollama-ui"
+    TRACING_SAMPLE_RATIO: float = 1.0  # share of new traces recorded; callers' decisions are kept
+    # Hosts ("host" or "host:port") sent a traceparent; empty means the Ollama nodes only
+    TRACING_PROPAGATE_HOSTS: List[str] = []
+
+    # Structured logging (queue-backed, sampled; LOG_LEVEL above sets the level)
+    LOG_FORMAT: str = "json"  # "json" (one object per line) or "text"
+    LOG_QUEUE_SIZE: int = 10000  # records waiting for the writer thread; overflow is dropped
+    # Share of records kept per category below ERROR, e.g. {"request": 0.01, "uvicorn.access": 0.1}
+    LOG_SAMPLE_RATES: Dict[str, float] = {}
+    LOG_RATE_LIMIT: int = 10  # repeats of one warning per category and window (0 = unlimited)
+    LOG_RATE_WINDOW: float = 60.0  # seconds
+
+    # Runtime diagnostics (event-loop lag, blocking-call stacks, /admin profiler)
+    DIAGNOSTICS_ENABLED: bool = False
+    DIAGNOSTICS_ADMIN_TOKEN: Optional[str] = None  # Bearer token required by /admin (unset = closed)
+    DIAGNOSTICS_LAG_INTERVAL: float = 0.1  # seconds between loop lag probes
+    DIAGNOSTICS_SLOW_CALLBACK: float = 0.1  # seconds the loop may block before its stack is recorded
+    DIAGNOSTICS_SLOW_CALLBACKS_KEPT: int = 50  # most recent blocking stacks kept
+    DIAGNOSTICS_PROFILE_MAX_SECONDS: float = 300.0  # a profile left running stops itself after this
+
+    # Shared HTTP connection pool
+    HTTP_POOL_LIMIT: int = 100  # total open connections
+    HTTP_POOL_LIMIT_PER_HOST: int = 32  # open connections per upstream host
+    HTTP_KEEPALIVE_TIMEOUT: float = 30.0  # seconds an idle connection is kept
+    HTTP_DNS_CACHE_TTL: int = 300  # seconds
+
+    # Response cache (exact match on deterministic requests)
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1024  # in-memory LRU size
+    RESPONSE_CACHE_TTL: int = 3600  # seconds
+    RESPONSE_CACHE_MAX_TEMPERATURE: float = 0.0  # only cache at or below this temperature
+    RESPONSE_CACHE_SQLITE_PATH: Optional[str] = None  # enables the on-disk tier
+    RESPONSE_CACHE_DISK_MAX_ENTRIES: int = 100000
+
+    # Single-flight coalescing of identical in-flight requests
+    COALESCE_ENABLED: bool = True
+    COALESCE_MAX_TEMPERATURE: float = 0.0  # only share calls at or below this temperature
+
+    # Admission control / per-model scheduling
+    SCHEDULER_ENABLED: bool = True
+    SCHEDULER_SLOTS_PER_MODEL: int = 2  # concurrent upstream requests per model, per node
+    SCHEDULER_MAX_QUEUE_PER_MODEL: int = 32  # waiting requests before 429
+    SCHEDULER_QUEUE_TIMEOUT: float = 60.0  # seconds in queue before 503
+    SCHEDULER_OLLAMA_MAX_LOADED_MODELS: int = 1  # models each Ollama node keeps in VRAM at once
+    SCHEDULER_SWAP_MAX_WAIT: float = 10.0  # seconds a model swap may be deferred
 
     # Rate Limiting
+    RATE_LIMIT_ENABLED: bool = True
     RATE_LIMIT_REQUESTS: int = 100
     RATE_LIMIT_WINDOW: int = 60  # seconds
+    RATE_LIMIT_MAX_STREAMS: int = 4  # concurrent SSE streams per client
+    RATE_LIMIT_STORE: str = "memory"  # "memory" or "sqlite" (shared across workers)
+    RATE_LIMIT_SQLITE_PATH: str = "ratelimit.sqlite3"
+    RATE_LIMIT_TRUST_FORWARDED: bool = False  # key on X-Forwarded-For behind a proxy
+
+    # Token budgets (charged on actual prompt + completion tokens)
+    TOKEN_BUDGET_ENABLED: bool = True
+    TOKEN_BUDGET_TOKENS: int = 200000  # tokens per client per window
+    TOKEN_BUDGET_WINDOW: int = 3600  # seconds
+    TOKEN_BUDGET_DEFAULT_COMPLETION: int = 512  # estimate when max_tokens is unset
 
     model_config = SettingsConfigDict(
         env_file=".env",
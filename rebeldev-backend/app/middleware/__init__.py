@@ -0,0 +1 @@
+# Middleware package for OG-Ollama-UI API
@@ -0,0 +1,247 @@
+"""
+Per-client rate limiting for the API.
+
+Enforces RATE_LIMIT_REQUESTS per RATE_LIMIT_WINDOW with a token bucket (O(1)
+per request), keyed on the configured bearer token or client IP, and caps the
+number of SSE streams a single client may hold open at once.
+"""
+
+import abc
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from ..config import settings
+
+# Endpoints that hold a long-lived streaming response open
+STREAM_PATHS = {"/api/chat/stream", "/api/chat/raw"}
+
+# (allowed, remaining, seconds until the bucket is full again, seconds until next token)
+Decision = Tuple[bool, int, float, float]
+
+
+class RateLimitStore(abc.ABC):
+    """Token bucket storage; subclass to share state between workers"""
+
+    @abc.abstractmethod
+    async def hit(self, key: str, capacity: int, window: float, cost: float = 1.0) -> Decision:
+        """Refill ``key``'s bucket and try to take ``cost`` tokens from it"""
+
+    def close(self) -> None:
+        pass
+
+
+def _take(tokens: float, updated: float, now: float, capacity: int, window: float, cost: float):
+    """Refill a bucket and try to take ``cost`` tokens from it"""
+    rate = capacity / window
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    allowed = tokens >= cost
+    if allowed:
+        tokens -= cost
+    reset = (capacity - tokens) / rate
+    retry = 0.0 if allowed else (cost - tokens) / rate
+    return tokens, (allowed, int(tokens), reset, retry)
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """In-process buckets; correct for a single worker"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # Least recently seen client first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def hit(self, key: str, capacity: int, window: float, cost: float = 1.0) -> Decision:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (float(capacity), now))
+        tokens, decision = _take(tokens, updated, now, capacity, window, cost)
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            # O(1) LRU eviction; a bucket idle for a full window is full again anyway
+            self._buckets.popitem(last=False)
+        return decision
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Buckets in a SQLite file shared by every worker on the host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pruned_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+        return self._conn
+
+    def _hit(self, key: str, capacity: int, window: float, cost: float) -> Decision:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row if row else (float(capacity), now)
+                tokens, decision = _take(tokens, updated, now, capacity, window, cost)
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                if now - self._pruned_at >= window:
+                    # A bucket idle for a full window has refilled; dropping it changes nothing
+                    conn.execute("DELETE FROM buckets WHERE updated < ?", (now - window,))
+                    self._pruned_at = now
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return decision
+
+    async def hit(self, key: str, capacity: int, window: float, cost: float = 1.0) -> Decision:
+        return await asyncio.to_thread(self._hit, key, capacity, window, cost)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_store() -> RateLimitStore:
+    """Build the store selected by RATE_LIMIT_STORE"""
+    if settings.RATE_LIMIT_STORE == "sqlite":
+        return SQLiteRateLimitStore(settings.RATE_LIMIT_SQLITE_PATH)
+    return MemoryRateLimitStore()
+
+
+def client_key(scope: dict) -> str:
+    """Identify the caller by the configured bearer token, else by client IP"""
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    auth = headers.get("authorization", "")
+    token = settings.AUTH_TOKEN
+    if token and auth.lower().startswith("bearer "):
+        # Unchecked tokens would let a client mint a fresh bucket per request
+        if hmac.compare_digest(auth[7:].strip().encode("utf-8"), token.encode("utf-8")):
+            digest = hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+            return f"token:{digest}"
+
+    if settings.RATE_LIMIT_TRUST_FORWARDED and headers.get("x-forwarded-for"):
+        # The rightmost hop was appended by our proxy; anything left of it is client-supplied
+        return "ip:" + headers["x-forwarded-for"].split(",")[-1].strip()
+
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """ASGI middleware enforcing request rate and concurrent-stream limits"""
+
+    def __init__(
+        self,
+        app,
+        store: Optional[RateLimitStore] = None,
+        requests: Optional[int] = None,
+        window: Optional[float] = None,
+        max_streams: Optional[int] = None,
+    ):
+        self.app = app
+        self.store = store or create_store()
+        self.requests = settings.RATE_LIMIT_REQUESTS if requests is None else requests
+        self.window = settings.RATE_LIMIT_WINDOW if window is None else window
+        self.max_streams = (
+            settings.RATE_LIMIT_MAX_STREAMS if max_streams is None else max_streams
+        )
+        self.open_streams: Dict[str, int] = {}
+        self.rejected = 0
+
+    @staticmethod
+    def _limited(path: str) -> bool:
+        return path.startswith("/api/")
+
+    @staticmethod
+    def _is_stream(path: str) -> bool:
+        return path in STREAM_PATHS
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._limited(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        key = client_key(scope)
+        allowed, remaining, reset, retry = await self.store.hit(key, self.requests, self.window)
+        rate_headers = [
+            (b"ratelimit-limit", str(self.requests).encode()),
+            (b"ratelimit-remaining", str(remaining).encode()),
+            (b"ratelimit-reset", str(math.ceil(reset)).encode()),
+        ]
+
+        if not allowed:
+            self.rejected += 1
+            await self._reject(send, rate_headers, math.ceil(retry), "Rate limit exceeded")
+            return
+
+        is_stream = self._is_stream(scope["path"])
+        if is_stream and self.open_streams.get(key, 0) >= self.max_streams:
+            self.rejected += 1
+            await self._reject(send, rate_headers, 1, "Too many concurrent streams")
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + rate_headers
+            await send(message)
+
+        if not is_stream:
+            await self.app(scope, receive, send_with_headers)
+            return
+
+        self.open_streams[key] = self.open_streams.get(key, 0) + 1
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            self.open_streams[key] -= 1
+            if not self.open_streams[key]:
+                del self.open_streams[key]
+
+    @staticmethod
+    async def _reject(send, rate_headers, retry_after: int, detail: str) -> None:
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": rate_headers + [
+                (b"retry-after", str(max(retry_after, 1)).encode()),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "window": self.window,
+            "max_streams": self.max_streams,
+            "rejected": self.rejected,
+            "open_streams": sum(self.open_streams.values()),
+        }
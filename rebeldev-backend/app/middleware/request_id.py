@@ -0,0 +1,41 @@
+"""
+Request ids for log correlation.
+
+Each HTTP request gets an id: the client's ``X-Request-ID`` when it is
+well-formed, otherwise a new one. The id is put in the logging context, so
+every record logged while handling the request carries it, streams included.
+It is also echoed in the response's ``X-Request-ID`` header.
+"""
+
+from ..utils.logging import new_request_id, request_id
+
+HEADER = b"x-request-id"
+
+
+class RequestIdMiddleware:
+    """ASGI middleware binding a request id to the logging context"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        candidate = next(
+            (value.decode("latin-1") for key, value in scope["headers"] if key == HEADER), None
+        )
+        current = new_request_id(candidate)
+        encoded = current.encode("latin-1")
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), (HEADER, encoded)]
+            await send(message)
+
+        token = request_id.set(current)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
@@ -0,0 +1,57 @@
+"""
+Server spans for API requests.
+
+Each request under /api gets a server span that lasts until the last byte of
+the response is sent, so streams are timed end to end. A ``traceparent``
+header from the client makes the span part of the caller's trace. The time
+between this span's start and the handler span's start is spent on routing
+and request validation. The span is named after the matched route template
+(``GET /api/jobs/{job_id}``), not the raw path, so ids do not multiply span
+names; requests that match no route are named after their method alone.
+"""
+
+from ..services.tracing import SERVER, tracer
+
+
+def route_name(scope) -> str:
+    """``METHOD /route/{template}`` once routed, else just the method"""
+    path = getattr(scope.get("route"), "path_format", None)
+    return f"{scope['method']} {path}" if path else scope["method"]
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a server span per API request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in scope["headers"]
+            if key == b"traceparent"
+        }
+        with tracer.span(
+            scope["method"],
+            SERVER,
+            {"http.request.method": scope["method"], "url.path": scope["path"]},
+            parent=tracer.extract(headers),
+        ) as span:
+
+            async def send_traced(message):
+                if message["type"] == "http.response.start":
+                    span.name = route_name(scope)
+                    span.set_attribute("http.response.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.status = "error"
+                    span.add_event("response.start")
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                span.name = route_name(scope)
@@ -2,7 +2,7 @@
 Pydantic models for request/response validation
 """
 
-from typing import List, Optional, Dict, Any
+from typing import Annotated, List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 from datetime import datetime, timezone
 from enum import Enum
@@ -24,6 +24,10 @@ class ProviderEnum(str, Enum):
     perplexity = "perplexity"
 
 
+# "provider:model"; model names may themselves contain ':'
+RoutingTarget = Annotated[str, Field(pattern=r"^(ollama|openai|perplexity):.+$")]
+
+
 class ChatMessage(BaseModel):
     """Individual chat message"""
 
@@ -36,6 +40,17 @@ class ChatMessage(BaseModel):
     )
 
 
+class StreamOptions(BaseModel):
+    """Token batching for streaming responses"""
+
+    flush_interval_ms: int = Field(
+        50, ge=0, description="Maximum time a token is buffered before its frame is sent"
+    )
+    flush_bytes: int = Field(
+        1024, ge=1, description="Send a frame as soon as this many content bytes are buffered"
+    )
+
+
 class ChatRequest(BaseModel):
     """Request for chat completion"""
 
@@ -53,6 +68,54 @@ class ChatRequest(BaseModel):
         0.7,
         description="Controls randomness in response generation (0.0 to 2.0)"
     )
+    context: Optional[List[int]] = Field(
+        None,
+        description="Ollama context returned by a previous turn (generate mode only)"
+    )
+    stream_options: Optional[StreamOptions] = Field(
+        None,
+        description="Batch tokens into fewer SSE frames; metadata is sent on the final frame only"
+    )
+    fallbacks: Optional[List[RoutingTarget]] = Field(
+        None,
+        description="provider:model targets tried in order if the requested one fails; "
+        "overrides ROUTING_FALLBACKS",
+        example=["openai:gpt-4o-mini"]
+    )
+    hedge: Optional[bool] = Field(
+        None,
+        description="Race the next fallback when no token arrives within the p95 time to "
+        "first token; defaults to ROUTING_HEDGE_ENABLED"
+    )
+    conversation_id: Optional[str] = Field(
+        None,
+        description="Stored conversation to continue; its messages are used as the history "
+        "and this turn is appended to it. Send only the new message."
+    )
+
+
+class ConversationCreate(BaseModel):
+    """Request to create a stored conversation"""
+
+    system_prompt: Optional[str] = Field(None, description="System prompt for every turn")
+    messages: List[ChatMessage] = Field(default_factory=list, description="Initial messages")
+
+
+class ConversationAppend(BaseModel):
+    """Messages to append to a stored conversation"""
+
+    messages: List[ChatMessage] = Field(..., min_length=1, description="Messages to append")
+
+
+class ConversationResponse(BaseModel):
+    """A stored conversation, or the tail of it"""
+
+    id: str = Field(..., description="Conversation id")
+    system_prompt: Optional[str] = Field(None, description="System prompt for every turn")
+    messages: List[ChatMessage] = Field(..., description="Messages from the requested offset")
+    count: int = Field(..., description="Total number of messages in the conversation")
+    created_at: datetime = Field(..., description="Creation time in UTC")
+    updated_at: datetime = Field(..., description="Time of the last append in UTC")
 
 
 class ChatResponse(BaseModel):
@@ -0,0 +1,147 @@
+"""
+Batch API router - Runs many chat requests as one resumable job.
+"""
+
+import json
+from typing import List, Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+
+from ..models.schemas import ChatRequest, ChatResponse, ErrorResponse
+from ..services.batch import BatchJob, BatchRejected, batch_runner
+from ..services.scheduler import parse_priority
+from ..middleware.ratelimit import client_key
+from ..utils import sse
+from .chat import complete, rejection
+
+router = APIRouter()
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/ndjson")
+
+
+def parse_batch(body: bytes, content_type: str) -> List[ChatRequest]:
+    """Requests from a JSON ``{"requests": [...]}`` body or a JSONL upload"""
+    try:
+        if content_type.split(";")[0].strip() in NDJSON_TYPES:
+            items = [line for line in body.splitlines() if line.strip()]
+            validate = ChatRequest.model_validate_json
+        else:
+            payload = json.loads(body)
+            items = payload.get("requests") if isinstance(payload, dict) else payload
+            validate = ChatRequest.model_validate
+            if not isinstance(items, list):
+                raise ValueError('Expected {"requests": [...]} or a JSON list of chat requests')
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+
+    requests = []
+    for index, item in enumerate(items):
+        try:
+            requests.append(validate(item))
+        except ValidationError as e:
+            errors = [{"index": index, **error} for error in e.errors(include_url=False)]
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors
+            ) from e
+    return requests
+
+
+def get_job(batch_id: str) -> BatchJob:
+    job = batch_runner.get(batch_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch '{batch_id}' not found"
+        )
+    return job
+
+
+def ndjson_results(job: BatchJob, after: int = 0) -> StreamingResponse:
+    return sse.ClosingStreamingResponse(
+        job.stream(after),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Batch-Id": job.id},
+    )
+
+
+@router.get(
+    "/batch/stats",
+    summary="Batch runner statistics"
+)
+async def batch_stats() -> dict:
+    """Submitted batches and items, running batches and pending items."""
+    return batch_runner.stats()
+
+
+@router.post(
+    "/batch",
+    responses={
+        200: {"content": {"application/x-ndjson": {}}},
+        400: {"model": ErrorResponse},
+        422: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+    },
+    summary="Run a batch of chat completions"
+)
+async def submit_batch(
+    http_request: Request,
+    content_type: str = Header("application/json"),
+    x_priority: Optional[str] = Header(None),
+) -> StreamingResponse:
+    """
+    Run many chat requests and stream their results as NDJSON in completion order.
+
+    The batch keeps running if the client disconnects; resume with
+    ``GET /api/batch/{id}?after=<lines received>``.
+    """
+    requests = parse_batch(await http_request.body(), content_type)
+    client = client_key(http_request.scope)
+    # Batches yield to interactive traffic unless told otherwise
+    priority = parse_priority(x_priority or "low")
+
+    async def run(request: ChatRequest) -> ChatResponse:
+        response, _ = await complete(request, client, priority)
+        return response
+
+    try:
+        job = batch_runner.submit(requests, run)
+    except BatchRejected as e:
+        raise rejection(e) from e
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from e
+    return ndjson_results(job)
+
+
+@router.get(
+    "/batch/{batch_id}",
+    responses={200: {"content": {"application/x-ndjson": {}}}, 404: {"model": ErrorResponse}},
+    summary="Resume a batch's result stream"
+)
+async def resume_batch(
+    batch_id: str,
+    after: int = Query(0, ge=0, description="Number of result lines already received"),
+) -> StreamingResponse:
+    """Stream a batch's results from line ``after`` on, until the batch finishes."""
+    return ndjson_results(get_job(batch_id), after)
+
+
+@router.get(
+    "/batch/{batch_id}/status",
+    responses={404: {"model": ErrorResponse}},
+    summary="Batch progress"
+)
+async def batch_status(batch_id: str) -> dict:
+    return get_job(batch_id).status()
+
+
+@router.delete(
+    "/batch/{batch_id}",
+    responses={404: {"model": ErrorResponse}},
+    summary="Cancel a batch"
+)
+async def cancel_batch(batch_id: str) -> dict:
+    """Cancel the remaining items; results so far stay available."""
+    job = get_job(batch_id)
+    await batch_runner.cancel(batch_id)
+    return job.status()
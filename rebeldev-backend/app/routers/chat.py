@@ -3,29 +3,73 @@ Chat API router - Handles chat completion requests.
 Supports multiple AI providers: Ollama, OpenAI, Perplexity.
 """
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Header, HTTPException, Request, Response, status
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from ..models.schemas import (
+    ChatMessage,
     ChatRequest,
     ChatResponse,
+    Role,
+    StreamChunk,
     ModelsResponse,
     ErrorResponse,
+    ProviderEnum,
 )
 from ..services.ollama import OllamaService
 from ..services.openai import OpenAIService
 from ..services.perplex import PerplexityService
+from ..services.transport import http_transport
+from ..services.cache import response_cache, canonical_request_key
+from ..services.coalescer import request_coalescer
+from ..services.scheduler import model_scheduler, parse_priority, SchedulerRejected
+from ..services.quota import (
+    token_quota,
+    QuotaExceeded,
+    estimate_prompt_tokens,
+    response_tokens,
+    stream_tokens,
+)
+from ..services.streams import stream_monitor
+from ..services.metrics import metrics, record_completion, record_error, record_first_token
+from ..services.tracing import traced
+from ..services.failover import ProviderFailover, parse_target
+from ..services.health import HealthMonitor, ProviderUnavailable
+from ..services.catalog import ModelCatalog, etag_matches
+from ..services.context import ContextWindow
+from ..services.conversations import Conversation, conversation_store
+from ..middleware.ratelimit import client_key
+from ..utils import sse
+import asyncio
 import json
-from typing import AsyncGenerator
+from contextlib import aclosing
+from typing import AsyncGenerator, List, Optional, Tuple
 
 router = APIRouter()
 
-# Service instances
+# Service instances; all share the pooled transport opened in the app lifespan
 SERVICE_REGISTRY = {
-    "ollama": OllamaService(),
-    "openai": OpenAIService(),
-    "perplexity": PerplexityService(),
+    "ollama": OllamaService(transport=http_transport),
+    "openai": OpenAIService(transport=http_transport),
+    "perplexity": PerplexityService(transport=http_transport),
 }
 
+# Ollama admission limits are per node, so they scale with the healthy pool
+model_scheduler.node_counts["ollama"] = lambda: SERVICE_REGISTRY["ollama"].nodes.healthy_count()
+
+# Background probes and circuit breakers; started in the app lifespan
+health_monitor = HealthMonitor(SERVICE_REGISTRY)
+
+# Cached model lists behind /api/models and request validation
+model_catalog = ModelCatalog(SERVICE_REGISTRY)
+metrics.listed = model_catalog.lists
+
+# History trimming to each model's context window; summaries use the services above
+context_window = ContextWindow(SERVICE_REGISTRY)
+
+# Fallback chains and hedging across the services above
+failover = ProviderFailover(SERVICE_REGISTRY, health=health_monitor, context=context_window)
+
 
 def get_service(provider: str):
     """Retrieve the appropriate service for a given provider."""
@@ -38,17 +82,167 @@ def get_service(provider: str):
     return service
 
 
+def request_keys(request: ChatRequest) -> Tuple[Optional[str], Optional[str]]:
+    """Cache and coalescing keys, each computed only when that layer applies."""
+    cache_key = flight_key = None
+    if response_cache.is_cacheable(request):
+        cache_key = canonical_request_key(request)
+    if request_coalescer.is_coalescable(request):
+        # Requests that would fail over differently must not share a flight
+        flight_key = canonical_request_key(request, routing=True)
+    return cache_key, flight_key
+
+
+def served_by_primary(metadata: Optional[dict]) -> bool:
+    """Whether a result came from the requested target rather than a fallback."""
+    return not (metadata or {}).get("route_attempt")
+
+
+def check_model(request: ChatRequest) -> None:
+    """Reject models, including client-chosen fallbacks, missing from the cached catalog."""
+    targets = [(request.provider.value, request.model)]
+    targets += [parse_target(target) for target in request.fallbacks or ()]
+    for provider, model in targets:
+        if provider not in SERVICE_REGISTRY or not model_catalog.is_known(provider, model):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Model '{model}' is not available from {provider}",
+            )
+
+
+async def resolve_conversation(
+    request: ChatRequest,
+) -> Tuple[ChatRequest, Optional[Conversation]]:
+    """Fill in the history (and system prompt) of a turn that references a stored conversation."""
+    if request.conversation_id is None:
+        return request, None
+    if request.history:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Send either history or conversation_id, not both",
+        )
+    conversation = await conversation_store.get(request.conversation_id)
+    if conversation is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Conversation '{request.conversation_id}' not found",
+        )
+    update = {"history": conversation.history()}
+    if request.system_prompt is None:
+        update["system_prompt"] = conversation.system_prompt
+    return request.model_copy(update=update), conversation
+
+
+async def record_turn(conversation: Conversation, request: ChatRequest, reply: str) -> None:
+    """Append a completed turn to its conversation."""
+    await conversation_store.append(
+        conversation,
+        [
+            ChatMessage(role=Role.user, content=request.message),
+            ChatMessage(role=Role.assistant, content=reply),
+        ],
+    )
+
+
+async def complete(
+    request: ChatRequest,
+    client: str,
+    priority: int = 0,
+    bypass_cache: bool = False,
+) -> Tuple[ChatResponse, Optional[str]]:
+    """
+    Run one non-streaming turn through the cache, coalescing, admission and failover.
+
+    Returns the response and its X-Cache status (None when not cacheable).
+    Raises HTTPException and the scheduler, quota and breaker rejections.
+    """
+    get_service(request.provider)
+    request, conversation = await resolve_conversation(request)
+    cache_key, flight_key = request_keys(request)
+
+    cache_status = None
+    if cache_key is not None:
+        if bypass_cache:
+            response_cache.bypasses += 1
+            cache_status = "BYPASS"
+        else:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                if conversation is not None:
+                    await record_turn(conversation, request, cached.message)
+                return cached, "HIT"
+            cache_status = "MISS"
+
+    check_model(request)
+    failover.check(request)
+    token_quota.check(client, request)
+
+    async def upstream() -> ChatResponse:
+        # Only the leader of a coalesced call takes a slot and is charged
+        lease = await model_scheduler.acquire(request.provider.value, request.model, priority)
+        try:
+            result = await failover.complete(request)
+        finally:
+            if lease is not None:
+                lease.release()
+        token_quota.charge(client, response_tokens(request, result))
+        return result
+
+    if flight_key is not None:
+        result = await request_coalescer.run(flight_key, upstream)
+    else:
+        result = await upstream()
+
+    # A fallback's answer must not be served later as the primary target's
+    if cache_key is not None and served_by_primary(result.metadata):
+        await response_cache.set(cache_key, result)
+    if conversation is not None:
+        await record_turn(conversation, request, result.message)
+    return result, cache_status
+
+
+def rejection(e: Exception) -> HTTPException:
+    """Translate a scheduler, quota or breaker rejection into a fast 429/503 with Retry-After."""
+    return HTTPException(
+        status_code=e.status_code,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
 @router.post(
     "/chat",
     response_model=ChatResponse,
-    responses={500: {"model": ErrorResponse}},
+    responses={
+        429: {"model": ErrorResponse},
+        500: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
     summary="Create chat completion"
 )
-async def chat_completion(request: ChatRequest) -> ChatResponse:
+@traced("chat.completion")
+async def chat_completion(
+    request: ChatRequest,
+    response: Response,
+    http_request: Request,
+    x_cache_bypass: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None),
+) -> ChatResponse:
     """Create a chat completion from the specified provider."""
     try:
-        service = get_service(request.provider)
-        return await service.chat_completion(request)
+        result, cache_status = await complete(
+            request,
+            client_key(http_request.scope),
+            parse_priority(x_priority),
+            bypass_cache=bool(x_cache_bypass),
+        )
+        if cache_status:
+            response.headers["X-Cache"] = cache_status
+        return result
+    except (SchedulerRejected, QuotaExceeded, ProviderUnavailable) as e:
+        raise rejection(e) from e
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -58,28 +252,281 @@ async def chat_completion(request: ChatRequest) -> ChatResponse:
 
 @router.post(
     "/chat/stream",
-    responses={500: {"model": ErrorResponse}},
+    responses={
+        429: {"model": ErrorResponse},
+        500: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
     summary="Create streaming chat completion"
 )
-async def chat_completion_stream(request: ChatRequest) -> StreamingResponse:
+@traced("chat.stream")
+async def chat_completion_stream(
+    request: ChatRequest,
+    http_request: Request,
+    x_cache_bypass: Optional[str] = Header(None),
+    x_priority: Optional[str] = Header(None),
+) -> StreamingResponse:
     """Create a streaming chat completion using Server-Sent Events (SSE)."""
     try:
-        service = get_service(request.provider)
+        get_service(request.provider)
+        request, conversation = await resolve_conversation(request)
+        cache_key, flight_key = request_keys(request)
+        client = client_key(http_request.scope)
+
+        cached = None
+        cache_status = None
+        if cache_key is not None:
+            if x_cache_bypass:
+                response_cache.bypasses += 1
+                cache_status = "BYPASS"
+            else:
+                cached = await response_cache.get(cache_key)
+                cache_status = "HIT" if cached is not None else "MISS"
+
+        # Cache hits and joined streams cost no extra upstream work. Otherwise
+        # the slot is held for the whole stream and released when it ends.
+        subscription = None
+        lease = None
+        if cached is None:
+            check_model(request)
+            failover.check(request)
+            token_quota.check(client, request)
+            leading = True
+            if flight_key is not None:
+                # Registered before admission, so identical requests join this one
+                subscription, leading = request_coalescer.flight(flight_key)
+            if leading:
+                try:
+                    lease = await model_scheduler.acquire(
+                        request.provider.value, request.model, parse_priority(x_priority)
+                    )
+                except BaseException as e:
+                    if subscription is not None:
+                        await request_coalescer.abort(subscription, e)
+                    raise
+
+            if leading and subscription is not None:
+                def charge_flight(chunks: List[StreamChunk]) -> None:
+                    if chunks:
+                        done = next((chunk for chunk in chunks if chunk.done), None)
+                        token_quota.charge(client, stream_tokens(
+                            request,
+                            done.metadata if done else None,
+                            sum(len(chunk.content) for chunk in chunks),
+                        ))
+
+                # The flight owns the slot and the charge from here on, so both
+                # last as long as upstream runs, even after the leader has left
+                request_coalescer.start(
+                    subscription, failover.stream(request), lease, on_finish=charge_flight
+                )
+                lease = None
+
+        parts = []
+        final = None
+
+        async def tracked() -> AsyncGenerator[StreamChunk, None]:
+            """Upstream (or cached) chunks, remembering what was produced"""
+            nonlocal final
+            if cached is not None:
+                async for chunk in response_cache.replay_stream(cached):
+                    yield chunk
+                return
+
+            if subscription is not None:
+                upstream = subscription.chunks()
+            else:
+                upstream = failover.stream(request)
+            async with aclosing(upstream) as chunks:
+                async for chunk in chunks:
+                    parts.append(chunk.content)
+                    if chunk.done:
+                        final = chunk
+                    yield chunk
 
         async def stream() -> AsyncGenerator[str, None]:
+            # Anything other than a normal end or an upstream error means the
+            # client went away (cancellation or GeneratorExit from the response)
+            outcome = "disconnected"
+            stream_monitor.opened()
             try:
-                async for chunk in service.chat_completion_stream(request):
-                    yield f"data: {json.dumps(chunk.dict())}\n\n"
-                yield "data: [DONE]\n\n"
+                if request.stream_options is not None:
+                    frames = sse.encode_batched(tracked(), request.stream_options)
+                else:
+                    frames = sse.encode_chunks(tracked())
+                async with aclosing(frames):
+                    async for data in frames:
+                        yield data
+                outcome = "completed"
+
+                if conversation is not None:
+                    if cached is not None:
+                        await record_turn(conversation, request, cached.message)
+                    elif final is not None:
+                        await record_turn(conversation, request, "".join(parts))
+
+                if (
+                    cache_key is not None
+                    and final is not None
+                    and served_by_primary(final.metadata)
+                ):
+                    await response_cache.set(
+                        cache_key,
+                        ChatResponse(
+                            message="".join(parts),
+                            model=request.model,
+                            provider=request.provider,
+                            metadata=final.metadata,
+                        ),
+                    )
             except Exception as e:
-                yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
+                outcome = "failed"
+                yield sse.error_frame(e)
+            finally:
+                if lease is not None:
+                    lease.release()
+                tokens = 0
+                if subscription is None and parts:
+                    # Charged here so aborted streams still pay for what was generated
+                    tokens = stream_tokens(
+                        request,
+                        final.metadata if final else None,
+                        sum(len(p) for p in parts),
+                    )
+                    token_quota.charge(client, tokens)
+                if outcome == "completed":
+                    stream_monitor.finished()
+                elif outcome == "failed":
+                    stream_monitor.errored()
+                else:
+                    stream_monitor.disconnect(request.model, tokens)
+
+        headers = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        if cache_status:
+            headers["X-Cache"] = cache_status
+
+        teardown = None
+        if lease is not None:
+            teardown = BackgroundTask(lease.release)
+        elif subscription is not None:
+            teardown = BackgroundTask(subscription.close)
 
-        return StreamingResponse(
+        return sse.ClosingStreamingResponse(
             stream(),
             media_type="text/event-stream",
+            headers=headers,
+            # Covers streams that are torn down before the generator starts
+            background=teardown,
+        )
+
+    except (SchedulerRejected, QuotaExceeded, ProviderUnavailable) as e:
+        raise rejection(e) from e
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        ) from e
+
+
+@router.post(
+    "/chat/raw",
+    responses={
+        400: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
+    summary="Relay Ollama's native NDJSON stream"
+)
+@traced("chat.raw")
+async def chat_completion_raw(
+    request: ChatRequest,
+    http_request: Request,
+    x_priority: Optional[str] = Header(None),
+) -> StreamingResponse:
+    """Relay the upstream Ollama NDJSON stream byte-for-byte (Ollama only)."""
+    try:
+        if request.provider != ProviderEnum.ollama:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Passthrough streaming is only available for Ollama",
+            )
+
+        if request.conversation_id is not None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Stored conversations are not available for passthrough streaming",
+            )
+
+        service = get_service(request.provider)
+        check_model(request)
+        client = client_key(http_request.scope)
+        token_quota.check(client, request)
+        lease = await model_scheduler.acquire(
+            request.provider.value, request.model, parse_priority(x_priority)
+        )
+
+        final = None
+
+        def account(record: dict) -> None:
+            nonlocal final
+            final = record
+            token_quota.charge(client, stream_tokens(request, record, 0))
+
+        async def relay() -> AsyncGenerator[bytes, None]:
+            outcome = "disconnected"
+            records = 0
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            first_at = None
+            stream_monitor.opened()
+            try:
+                upstream = service.passthrough_stream(context_window.fit(request), on_final=account)
+                async with aclosing(upstream):
+                    async for data in upstream:
+                        if first_at is None:
+                            first_at = loop.time()
+                            record_first_token("ollama", request.model, first_at - started)
+                        # Roughly one token per NDJSON record; bytes.count stays in C
+                        records += data.count(b"\n")
+                        yield data
+                outcome = "completed"
+                ended = loop.time()
+                record_completion(
+                    "ollama", request.model, "raw", ended - started,
+                    (final or {}).get("eval_count") or records, ended - (first_at or ended),
+                )
+            except Exception as e:
+                outcome = "failed"
+                record_error("ollama", request.model, e)
+                yield (json.dumps({"error": str(e)}) + "\n").encode("utf-8")
+            finally:
+                if lease is not None:
+                    lease.release()
+                tokens = 0
+                if final is None and records:
+                    # No done record to charge from; estimate what was generated
+                    tokens = estimate_prompt_tokens(request) + records
+                    token_quota.charge(client, tokens)
+                if outcome == "completed":
+                    stream_monitor.finished()
+                elif outcome == "failed":
+                    stream_monitor.errored()
+                else:
+                    stream_monitor.disconnect(request.model, tokens)
+
+        return sse.ClosingStreamingResponse(
+            relay(),
+            media_type="application/x-ndjson",
             headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
+            background=BackgroundTask(lease.release) if lease is not None else None,
         )
 
+    except (SchedulerRejected, QuotaExceeded, ProviderUnavailable) as e:
+        raise rejection(e) from e
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -93,12 +540,28 @@ async def chat_completion_stream(request: ChatRequest) -> StreamingResponse:
     responses={500: {"model": ErrorResponse}},
     summary="Get available models"
 )
-async def get_available_models(provider: str = "ollama") -> ModelsResponse:
-    """Retrieve the list of available models from a specific provider."""
+@traced("chat.models")
+async def get_available_models(
+    provider: str = "ollama",
+    if_none_match: Optional[str] = Header(None),
+) -> Response:
+    """
+    Retrieve the list of available models from a provider, or from all of them
+    with ``provider=all``. Served from the model catalog cache with an ETag.
+    """
     try:
-        service = get_service(provider)
-        models = await service.get_models()
-        return ModelsResponse(models=models, count=len(models))
+        if provider == "all":
+            entry = await model_catalog.all()
+        else:
+            get_service(provider)
+            entry = await model_catalog.get(provider)
+
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, entry.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -112,17 +575,110 @@ async def get_available_models(provider: str = "ollama") -> ModelsResponse:
     responses={200: {"description": "Health status of all providers"}}
 )
 async def health_check() -> dict:
-    """Perform a health check for all registered AI providers."""
-    status_map = {}
-    for name, service in SERVICE_REGISTRY.items():
-        try:
-            await service.health_check()
-            status_map[name] = True
-        except Exception:
-            status_map[name] = False
-
-    overall_status = "healthy" if any(status_map.values()) else "unhealthy"
-    return {
-        "status": overall_status,
-        "providers": status_map,
-    }
+    """Health of all registered AI providers, from the background monitor (no live probes)."""
+    return health_monitor.snapshot()
+
+
+@router.get(
+    "/health/breakers",
+    summary="Circuit breaker state per provider"
+)
+async def breaker_stats() -> dict:
+    """Breaker state, consecutive failures and trips per provider."""
+    return health_monitor.stats()
+
+
+@router.get(
+    "/cache/stats",
+    summary="Response cache statistics",
+    responses={200: {"description": "Hit/miss counters for the response cache"}}
+)
+async def cache_stats() -> dict:
+    """Report response cache hit/miss counters."""
+    return response_cache.stats()
+
+
+@router.get(
+    "/coalescing/stats",
+    summary="Request coalescing statistics",
+    responses={200: {"description": "Shared vs. leading upstream calls"}}
+)
+async def coalescing_stats() -> dict:
+    """Report how many requests joined an identical in-flight call."""
+    return request_coalescer.stats()
+
+
+@router.get(
+    "/scheduler/stats",
+    summary="Admission scheduler statistics",
+    responses={200: {"description": "Per-model slots, queue depth and wait times"}}
+)
+async def scheduler_stats() -> dict:
+    """Report per-model queue depth, active slots and wait times."""
+    return model_scheduler.stats()
+
+
+@router.get(
+    "/streams/stats",
+    summary="Open streams and client disconnects"
+)
+async def stream_stats() -> dict:
+    """Active streams, how finished streams ended and tokens wasted on disconnects."""
+    return stream_monitor.stats()
+
+
+@router.get(
+    "/failover/stats",
+    summary="Fallback and hedging statistics"
+)
+async def failover_stats() -> dict:
+    """Fallbacks taken, hedges fired and won, failures and p95 TTFT per target."""
+    return failover.stats()
+
+
+@router.get(
+    "/models/stats",
+    summary="Model catalog cache statistics"
+)
+async def catalog_stats() -> dict:
+    """Catalog hits, stale hits, misses and per-provider age."""
+    return model_catalog.stats()
+
+
+@router.get(
+    "/context/stats",
+    summary="History trimming statistics"
+)
+async def context_stats() -> dict:
+    """Trimmed requests, messages and tokens dropped, and background summaries."""
+    return context_window.stats()
+
+
+@router.get(
+    "/ollama/nodes",
+    summary="Ollama node pool status",
+    responses={200: {"description": "Health, load and resident models per node"}}
+)
+async def ollama_nodes() -> dict:
+    """Report health, outstanding requests and known models per Ollama node."""
+    return SERVICE_REGISTRY["ollama"].nodes.stats()
+
+
+@router.get(
+    "/ollama/residency",
+    summary="Ollama model residency",
+    responses={200: {"description": "keep_alive, resident nodes and load times per model"}}
+)
+async def ollama_residency() -> dict:
+    """Report per-model keep_alive, where each model is loaded and the load time paid."""
+    return SERVICE_REGISTRY["ollama"].residency.stats()
+
+
+@router.get(
+    "/quota",
+    summary="Remaining token budget",
+    responses={200: {"description": "Token budget for the calling client"}}
+)
+async def quota_status(http_request: Request) -> dict:
+    """Report the calling client's remaining token budget."""
+    return token_quota.status(client_key(http_request.scope))
@@ -0,0 +1,89 @@
+"""
+Conversations API router - Stored conversations referenced by chat turns.
+"""
+
+from fastapi import APIRouter, HTTPException, Query, Response, status
+from ..models.schemas import (
+    ConversationAppend,
+    ConversationCreate,
+    ConversationResponse,
+    ErrorResponse,
+)
+from ..services.conversations import Conversation, conversation_store
+
+router = APIRouter()
+
+
+async def get_conversation(conversation_id: str) -> Conversation:
+    conversation = await conversation_store.get(conversation_id)
+    if conversation is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Conversation '{conversation_id}' not found",
+        )
+    return conversation
+
+
+@router.get(
+    "/conversations/stats",
+    summary="Conversation store statistics"
+)
+async def conversation_stats() -> dict:
+    """In-memory entries, hits, loads from disk and evictions."""
+    return conversation_store.stats()
+
+
+@router.post(
+    "/conversations",
+    response_model=ConversationResponse,
+    status_code=status.HTTP_201_CREATED,
+    summary="Create a conversation"
+)
+async def create_conversation(body: ConversationCreate) -> ConversationResponse:
+    """Create a stored conversation, optionally seeded with messages."""
+    conversation = await conversation_store.create(body.system_prompt, body.messages)
+    return conversation.to_response()
+
+
+@router.get(
+    "/conversations/{conversation_id}",
+    response_model=ConversationResponse,
+    responses={404: {"model": ErrorResponse}},
+    summary="Fetch a conversation"
+)
+async def fetch_conversation(
+    conversation_id: str,
+    offset: int = Query(0, ge=0, description="Return only messages from this index on"),
+) -> ConversationResponse:
+    """Fetch a conversation, or with ``offset`` only the messages a client has not seen."""
+    conversation = await get_conversation(conversation_id)
+    return conversation.to_response(offset)
+
+
+@router.post(
+    "/conversations/{conversation_id}/messages",
+    response_model=ConversationResponse,
+    responses={404: {"model": ErrorResponse}},
+    summary="Append messages to a conversation"
+)
+async def append_messages(conversation_id: str, body: ConversationAppend) -> ConversationResponse:
+    """Append messages; the response carries only the appended ones."""
+    conversation = await get_conversation(conversation_id)
+    start = len(conversation.messages)
+    await conversation_store.append(conversation, body.messages)
+    return conversation.to_response(start)
+
+
+@router.delete(
+    "/conversations/{conversation_id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    responses={404: {"model": ErrorResponse}},
+    summary="Delete a conversation"
+)
+async def delete_conversation(conversation_id: str) -> Response:
+    if not await conversation_store.delete(conversation_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Conversation '{conversation_id}' not found",
+        )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,76 @@
+"""
+Diagnostics router - Event-loop health and an on-demand sampling profiler.
+"""
+
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+
+from ..config import settings
+from ..services.diagnostics import ProfilerError, loop_monitor, profiler
+
+# Collapsed stacks, one "frame;frame;frame count" per line
+CONTENT_TYPE = "text/plain; charset=utf-8"
+
+
+async def require_admin(authorization: Optional[str] = Header(None)) -> None:
+    """404 while diagnostics are off or no admin token is set; 401 without the token"""
+    token = settings.DIAGNOSTICS_ADMIN_TOKEN
+    # Fail closed: stacks and profiles expose code paths and request data
+    if not settings.DIAGNOSTICS_ENABLED or not token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Diagnostics are disabled")
+    if not hmac.compare_digest(authorization or "", f"Bearer {token}"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Admin token required",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get(
+    "/diagnostics",
+    summary="Event-loop lag and blocking calls"
+)
+async def diagnostics() -> dict:
+    """Loop lag statistics, recent blocked-loop stacks and the profiler's state."""
+    return {"loop": loop_monitor.stats(), "profiler": profiler.status()}
+
+
+@router.post(
+    "/profiler/start",
+    summary="Start the sampling profiler"
+)
+async def start_profiler(
+    hz: int = Query(100, ge=1, le=1000, description="Samples per second"),
+    all_threads: bool = Query(False, description="Sample worker threads as well as the event loop"),
+) -> dict:
+    """Start sampling the event loop's stack; ``POST /profiler/stop`` returns the profile."""
+    try:
+        # Handlers run on the loop thread, so that is the one sampled
+        profiler.start(hz=hz, all_threads=all_threads)
+    except ProfilerError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e)) from e
+    return profiler.status()
+
+
+@router.post(
+    "/profiler/stop",
+    response_class=Response,
+    responses={200: {"content": {CONTENT_TYPE: {}}}},
+    summary="Stop the profiler and download collapsed stacks"
+)
+async def stop_profiler() -> Response:
+    """Collapsed stacks for flamegraph.pl, speedscope or any compatible viewer."""
+    try:
+        collapsed = await profiler.stop()
+    except ProfilerError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e)) from e
+    return Response(
+        collapsed,
+        media_type=CONTENT_TYPE,
+        headers={"X-Profile-Samples": str(profiler.samples)},
+    )
@@ -0,0 +1,127 @@
+"""
+Jobs API router - Chat completions submitted now and collected later.
+"""
+
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse
+
+from ..models.schemas import ChatRequest, ChatResponse, ErrorResponse
+from ..services.jobs import CANCELLED, FAILED, SUCCEEDED, Job, job_manager
+from ..services.scheduler import parse_priority
+from ..middleware.ratelimit import client_key
+from .chat import check_model, complete, get_service
+
+router = APIRouter()
+
+
+async def run_job(request: ChatRequest, client: str, priority: int) -> ChatResponse:
+    """Worker entry point: the same path as a /chat request"""
+    response, _ = await complete(request, client, priority)
+    return response
+
+
+async def get_job(job_id: str) -> Job:
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found"
+        )
+    return job
+
+
+@router.get(
+    "/jobs/stats",
+    summary="Job queue statistics"
+)
+async def job_stats() -> dict:
+    """Workers, jobs run by this process and queued/running/finished counts."""
+    return await job_manager.stats()
+
+
+@router.post(
+    "/jobs",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={400: {"model": ErrorResponse}},
+    summary="Submit a chat completion job"
+)
+async def submit_job(
+    request: ChatRequest,
+    response: Response,
+    http_request: Request,
+    x_priority: Optional[str] = Header(None),
+) -> dict:
+    """
+    Queue a chat completion and return its id at once.
+
+    Poll ``GET /api/jobs/{id}`` for the status and collect the reply from
+    ``GET /api/jobs/{id}/result``.
+    """
+    get_service(request.provider)
+    check_model(request)
+    job = await job_manager.submit(
+        request.model_copy(update={"stream": False}),
+        client_key(http_request.scope),
+        parse_priority(x_priority),
+    )
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job.to_dict()
+
+
+@router.get(
+    "/jobs/{job_id}",
+    responses={404: {"model": ErrorResponse}},
+    summary="Job status"
+)
+async def job_status(job_id: str) -> dict:
+    return (await get_job(job_id)).to_dict()
+
+
+@router.get(
+    "/jobs/{job_id}/result",
+    response_model=ChatResponse,
+    responses={
+        202: {"description": "Still queued or running"},
+        404: {"model": ErrorResponse},
+        410: {"model": ErrorResponse},
+    },
+    summary="Job result"
+)
+async def job_result(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=30, description="Seconds to wait for the job to finish"),
+):
+    """
+    The chat response of a finished job.
+
+    While the job is pending this answers 202 with its status; a failed job
+    answers with the status code and detail the request would have had.
+    """
+    job = await job_manager.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Job '{job_id}' not found"
+        )
+    if job.status == SUCCEEDED:
+        return Response(job.result, media_type="application/json")
+    if job.status == FAILED:
+        raise HTTPException(status_code=job.status_code or 500, detail=job.error)
+    if job.status == CANCELLED:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE, detail=f"Job '{job_id}' was cancelled"
+        )
+    return JSONResponse(
+        job.to_dict(), status_code=status.HTTP_202_ACCEPTED, headers={"Retry-After": "1"}
+    )
+
+
+@router.delete(
+    "/jobs/{job_id}",
+    responses={404: {"model": ErrorResponse}},
+    summary="Cancel a job"
+)
+async def cancel_job(job_id: str) -> dict:
+    """Cancel a queued or running job; finished jobs are left as they are."""
+    await get_job(job_id)
+    return (await job_manager.cancel(job_id)).to_dict()
@@ -0,0 +1,25 @@
+"""
+Metrics router - Prometheus scrape endpoint.
+"""
+
+from fastapi import APIRouter, HTTPException, Response, status
+
+from ..services.metrics import metrics
+
+router = APIRouter()
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get(
+    "/metrics",
+    response_class=Response,
+    responses={200: {"content": {CONTENT_TYPE: {}}}},
+    summary="Prometheus metrics"
+)
+async def prometheus_metrics() -> Response:
+    """Latency, time-to-first-token, throughput, queue, error, stream and pool metrics."""
+    if not metrics.enabled:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,256 @@
+"""
+Batch chat completions.
+
+A batch is a list of chat requests run as a background job. Each
+provider/model group gets a fixed number of workers, so a large batch cannot
+flood the per-model queues. Results are kept as pre-serialized NDJSON lines in
+completion order, and every line carries the input index. A client streams
+them while the batch runs, and after a disconnect it reconnects with the
+number of lines it already has.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from ..models.schemas import ChatRequest, ChatResponse
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+Runner = Callable[[ChatRequest], Awaitable[ChatResponse]]
+
+# Seconds a client is told to wait when too many batches are running
+BUSY_RETRY_AFTER = 10
+
+
+class BatchRejected(Exception):
+    """Raised when a batch cannot start because too many are already running"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+def error_record(index: int, error: Exception) -> dict:
+    """NDJSON record for a failed item, keeping the HTTP status it would have had"""
+    detail = getattr(error, "detail", None) or str(error) or type(error).__name__
+    return {"index": index, "status": getattr(error, "status_code", 500), "error": detail}
+
+
+class BatchJob:
+    """One submitted batch and its results so far"""
+
+    def __init__(self, requests: List[ChatRequest]):
+        self.id = uuid.uuid4().hex
+        self.requests = requests
+        self.total = len(requests)
+        self.lines: List[bytes] = []
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = False
+        self.done = False
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def _emit(self, record: dict) -> None:
+        self.lines.append((json.dumps(record, ensure_ascii=False, default=str) + "\n").encode())
+        # Wake current readers; later ones wait on a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def add_result(self, index: int, response: ChatResponse) -> None:
+        self.completed += 1
+        self._emit({"index": index, "response": response.model_dump(mode="json")})
+
+    def add_error(self, index: int, error: Exception) -> None:
+        self.failed += 1
+        self._emit(error_record(index, error))
+
+    def finish(self) -> None:
+        self.done = True
+        self.finished_at = time.time()
+        # Last line: lets a reader tell a finished batch from a dropped connection
+        self._emit({"batch_id": self.id, "done": True, **self.counts()})
+
+    def counts(self) -> dict:
+        return {
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    async def stream(self, after: int = 0) -> AsyncGenerator[bytes, None]:
+        """Result lines from position ``after`` on, following the job until it ends"""
+        position = after
+        while True:
+            changed = self.changed
+            if position < len(self.lines):
+                chunk = b"".join(self.lines[position:])
+                position = len(self.lines)
+                yield chunk
+                continue
+            if self.done:
+                return
+            await changed.wait()
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "done": self.done,
+            "lines": len(self.lines),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            **self.counts(),
+        }
+
+
+class BatchRunner:
+    """Runs batch jobs with bounded concurrency per provider and model"""
+
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        max_items: Optional[int] = None,
+        retention: Optional[float] = None,
+        max_jobs: Optional[int] = None,
+        max_running: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        max_retry_wait: Optional[float] = None,
+    ):
+        self.concurrency = (
+            settings.BATCH_CONCURRENCY_PER_MODEL if concurrency is None else concurrency
+        )
+        self.max_items = settings.BATCH_MAX_ITEMS if max_items is None else max_items
+        self.retention = settings.BATCH_RETENTION if retention is None else retention
+        self.max_jobs = settings.BATCH_MAX_JOBS if max_jobs is None else max_jobs
+        self.max_running = settings.BATCH_MAX_RUNNING if max_running is None else max_running
+        self.max_attempts = settings.BATCH_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.max_retry_wait = (
+            settings.BATCH_RETRY_MAX_WAIT if max_retry_wait is None else max_retry_wait
+        )
+        self.jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+        self.submitted = 0
+        self.items = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def _prune(self) -> None:
+        """Forget finished jobs past their retention, and the oldest finished beyond max_jobs"""
+        now = time.time()
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished:
+            if now - job.finished_at > self.retention or len(self.jobs) > self.max_jobs:
+                del self.jobs[job.id]
+
+    def submit(self, requests: List[ChatRequest], run: Runner) -> BatchJob:
+        if not requests:
+            raise ValueError("A batch needs at least one request")
+        if len(requests) > self.max_items:
+            raise ValueError(f"A batch holds at most {self.max_items} requests")
+        self._prune()
+        # _prune keeps unfinished batches, so this is what bounds self.jobs
+        if sum(1 for job in self.jobs.values() if not job.done) >= self.max_running:
+            self.rejected += 1
+            raise BatchRejected(
+                f"{self.max_running} batches are already running", BUSY_RETRY_AFTER
+            )
+        job = BatchJob(requests)
+        self.jobs[job.id] = job
+        self.submitted += 1
+        self.items += job.total
+        job.task = asyncio.create_task(self._run(job, run))
+        return job
+
+    async def _run(self, job: BatchJob, run: Runner) -> None:
+        groups: Dict[Tuple[str, str], Deque[int]] = {}
+        for index, request in enumerate(job.requests):
+            groups.setdefault((request.provider.value, request.model), deque()).append(index)
+
+        async def worker(indices: Deque[int]) -> None:
+            while indices:
+                index = indices.popleft()
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        response = await run(job.requests[index])
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        retry_after = getattr(e, "retry_after", None)
+                        if (
+                            retry_after is not None
+                            and attempt < self.max_attempts
+                            # A spent token budget can take a whole window to refill;
+                            # waiting that out would hold the group and the batch
+                            and float(retry_after) <= self.max_retry_wait
+                        ):
+                            # Transient rejection: try the item again once Retry-After has passed
+                            self.retried += 1
+                            await asyncio.sleep(float(retry_after))
+                            continue
+                        job.add_error(index, e)
+                    else:
+                        job.add_result(index, response)
+                    break
+
+        workers = [
+            worker(indices)
+            for indices in groups.values()
+            for _ in range(min(self.concurrency, len(indices)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            job.cancelled = True
+            raise
+        finally:
+            job.requests = []  # results are all that is needed from here on
+            job.finish()
+            logger.info(
+                "[Batch] %s finished: %s completed, %s failed%s",
+                job.id,
+                job.completed,
+                job.failed,
+                " (cancelled)" if job.cancelled else "",
+            )
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(job_id)
+
+    async def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+            await asyncio.gather(job.task, return_exceptions=True)
+        return True
+
+    async def close(self) -> None:
+        for job_id in list(self.jobs):
+            await self.cancel(job_id)
+
+    def stats(self) -> dict:
+        running = [job for job in self.jobs.values() if not job.done]
+        return {
+            "concurrency_per_model": self.concurrency,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "items": self.items,
+            "retried": self.retried,
+            "running": len(running),
+            "pending_items": sum(job.total - job.completed - job.failed for job in running),
+            "retained": len(self.jobs),
+        }
+
+
+# Process-wide batch runner
+batch_runner = BatchRunner()
@@ -0,0 +1,259 @@
+"""
+Exact-match response cache for chat completions.
+
+Responses are keyed on a canonical hash of every request field that affects
+the generated output. Entries live in an in-memory LRU tier bounded by size
+and TTL, optionally backed by an on-disk SQLite tier shared across restarts.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional, Tuple
+
+from ..models.schemas import ChatRequest, ChatResponse, StreamChunk
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_request_key(request: ChatRequest, routing: bool = False) -> str:
+    """
+    Stable hash of the request fields that determine the model output.
+
+    With ``routing``, the fallback chain and hedging choice are hashed too, so
+    only requests that would be routed the same way share a key.
+    """
+    history = [[getattr(m.role, "value", m.role), m.content] for m in request.history]
+    material = {
+        "provider": getattr(request.provider, "value", request.provider),
+        "model": request.model,
+        "system_prompt": request.system_prompt,
+        "history": history,
+        "message": request.message,
+        "max_tokens": request.max_tokens,
+        "temperature": request.temperature,
+        "context": request.context,
+    }
+    if routing:
+        material["fallbacks"] = request.fallbacks
+        material["hedge"] = request.hedge
+    raw = json.dumps(material, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryTier:
+    """Bounded LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class SQLiteTier:
+    """On-disk tier; blocking sqlite calls run in a worker thread"""
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # Upper bound on the row count; replacements overcount, eviction recounts
+        self._rows = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)"
+            )
+            self._conn.commit()
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self._conn
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM responses WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl),
+            )
+            self._rows += 1
+            if self._rows > self.max_entries:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Drop expired rows, then the soonest-expiring ones down to 90% of the cap"""
+        # Evicting below the cap means this runs once per ~max_entries/10 writes
+        conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        rows = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = rows - self.max_entries * 9 // 10
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY expires_at LIMIT ?)",
+                (excess,),
+            )
+            rows -= excess
+        self._rows = rows
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self._set, key, value)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResponseCache:
+    """Two-tier exact-match cache with hit/miss accounting"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sqlite_path: Optional[str] = None,
+        max_temperature: Optional[float] = None,
+    ):
+        self.enabled = settings.RESPONSE_CACHE_ENABLED if enabled is None else enabled
+        max_entries = settings.RESPONSE_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        ttl = settings.RESPONSE_CACHE_TTL if ttl is None else ttl
+        sqlite_path = sqlite_path or settings.RESPONSE_CACHE_SQLITE_PATH
+        self.max_temperature = (
+            settings.RESPONSE_CACHE_MAX_TEMPERATURE if max_temperature is None else max_temperature
+        )
+
+        self.memory = MemoryTier(max_entries, ttl)
+        self.disk = (
+            SQLiteTier(sqlite_path, ttl, settings.RESPONSE_CACHE_DISK_MAX_ENTRIES)
+            if sqlite_path
+            else None
+        )
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.bypasses = 0
+        self.stores = 0
+
+    def is_cacheable(self, request: ChatRequest) -> bool:
+        """Only cache sufficiently deterministic requests"""
+        if not self.enabled:
+            return False
+        temperature = 0.7 if request.temperature is None else request.temperature
+        return temperature <= self.max_temperature
+
+    async def get(self, key: str) -> Optional[ChatResponse]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            try:
+                value = await self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.warning("Response cache disk read failed: %s", e)
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        response = ChatResponse.model_validate_json(value)
+        response.metadata = {**(response.metadata or {}), "cached": True}
+        return response
+
+    async def set(self, key: str, response: ChatResponse) -> None:
+        value = response.model_dump_json()
+        self.memory.set(key, value)
+        self.stores += 1
+        if self.disk is not None:
+            try:
+                await self.disk.set(key, value)
+            except sqlite3.Error as e:
+                logger.warning("Response cache disk write failed: %s", e)
+
+    async def replay_stream(self, response: ChatResponse) -> AsyncGenerator[StreamChunk, None]:
+        """Replay a cached response in the same shape as a live stream"""
+        yield StreamChunk(
+            content=response.message,
+            done=False,
+            metadata={"model": response.model, "cached": True},
+        )
+        yield StreamChunk(content="", done=True, metadata=response.metadata)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "bypasses": self.bypasses,
+            "stores": self.stores,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_enabled": self.disk is not None,
+        }
+
+    def clear(self) -> None:
+        self.memory.clear()
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+# Process-wide response cache
+response_cache = ResponseCache()
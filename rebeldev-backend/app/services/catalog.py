@@ -0,0 +1,184 @@
+"""
+Cached model catalog for /api/models.
+
+Each provider's model list is cached with stale-while-revalidate semantics:
+fresh entries are served as-is, stale ones are served immediately while a
+single background refresh runs, and only a cold or expired catalog makes the
+caller wait. Every entry keeps its pre-serialized JSON body and an ETag, and a
+set of model names for O(1) validation of incoming requests.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+from ..models.schemas import ModelInfo, ModelsResponse
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogEntry:
+    """One provider's (or the aggregated) model list, ready to serve"""
+
+    def __init__(self, models: List[ModelInfo], fetched_at: Optional[float] = None):
+        self.models = models
+        self.fetched_at = time.monotonic() if fetched_at is None else fetched_at
+        self.retry_at = 0.0  # earliest background refresh after a failed one
+        response = ModelsResponse(models=models, count=len(models))
+        self.body = response.model_dump_json().encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.names: Set[str] = set()
+        for model in models:
+            self.names.add(model.name)
+            # Ollama lists "llama3.2:latest" for a model requested as "llama3.2"
+            if model.name.endswith(":latest"):
+                self.names.add(model.name[: -len(":latest")])
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Evaluate an If-None-Match header (weak comparison, lists and '*')"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ModelCatalog:
+    """Per-provider model lists with stale-while-revalidate refresh"""
+
+    def __init__(
+        self,
+        services: Dict[str, object],
+        ttl: Optional[float] = None,
+        max_stale: Optional[float] = None,
+        validate: Optional[bool] = None,
+        validate_providers: Optional[List[str]] = None,
+    ):
+        self.services = services
+        self.ttl = settings.CATALOG_TTL if ttl is None else ttl
+        self.max_stale = settings.CATALOG_MAX_STALE if max_stale is None else max_stale
+        self.validate = settings.CATALOG_VALIDATE_MODELS if validate is None else validate
+        self.validate_providers = set(
+            settings.CATALOG_VALIDATE_PROVIDERS if validate_providers is None else validate_providers
+        )
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._aggregate: Optional[CatalogEntry] = None
+        self._aggregate_key: tuple = ()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_errors = 0
+
+    def _refresh(self, provider: str) -> asyncio.Task:
+        """Start (or join) the single in-flight refresh for ``provider``"""
+        task = self._refreshing.get(provider)
+        if task is None:
+            task = asyncio.create_task(self._fetch(provider))
+            self._refreshing[provider] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(provider, None))
+        return task
+
+    async def _fetch(self, provider: str) -> CatalogEntry:
+        try:
+            models = await self.services[provider].get_models()
+        except Exception as e:
+            self.refresh_errors += 1
+            stale = self._entries.get(provider)
+            if stale is None:
+                raise
+            if time.monotonic() - stale.fetched_at >= self.ttl + self.max_stale:
+                # Too old to stand in for the provider any longer
+                del self._entries[provider]
+                raise
+            logger.warning("[Catalog] Refresh of %s failed, serving stale list: %s", provider, e)
+            stale.retry_at = time.monotonic() + self.ttl
+            return stale
+        entry = CatalogEntry(models)
+        self._entries[provider] = entry
+        return entry
+
+    async def get(self, provider: str) -> CatalogEntry:
+        entry = self._entries.get(provider)
+        if entry is not None:
+            now = time.monotonic()
+            age = now - entry.fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return entry
+            if age < self.ttl + self.max_stale:
+                self.stale_hits += 1
+                if now >= entry.retry_at:
+                    self._refresh(provider)
+                return entry
+        self.misses += 1
+        # Shielded so a caller going away does not cancel a refresh others await
+        return await asyncio.shield(self._refresh(provider))
+
+    async def all(self) -> CatalogEntry:
+        """All providers, fetched concurrently; providers that fail are left out"""
+        results = await asyncio.gather(
+            *(self.get(provider) for provider in self.services), return_exceptions=True
+        )
+        entries = []
+        for provider, result in zip(self.services, results):
+            if isinstance(result, Exception):
+                logger.warning("[Catalog] %s models unavailable: %s", provider, result)
+                continue
+            entries.append(result)
+
+        key = tuple(entry.etag for entry in entries)
+        if self._aggregate is None or key != self._aggregate_key:
+            self._aggregate = CatalogEntry([m for entry in entries for m in entry.models])
+            self._aggregate_key = key
+        return self._aggregate
+
+    def is_known(self, provider: str, model: str) -> bool:
+        """
+        O(1) check of a requested model against the cached catalog.
+
+        Never blocks on the network: with no (or an empty) catalog for the
+        provider the model is assumed to exist and the upstream decides. The
+        same goes for providers whose list is curated rather than complete
+        (OpenAI's is filtered, Perplexity's is static).
+        """
+        if not self.validate or provider not in self.validate_providers:
+            return True
+        entry = self._entries.get(provider)
+        if entry is None or not entry.names:
+            return True
+        return model in entry.names
+
+    def lists(self, provider: str, model: str) -> bool:
+        """Whether the cached catalog lists ``model``; unlike ``is_known``, False without one"""
+        entry = self._entries.get(provider)
+        return entry is not None and model in entry.names
+
+    async def warm(self) -> None:
+        """Populate every provider's catalog, e.g. at startup"""
+        await self.all()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "ttl": self.ttl,
+            "max_stale": self.max_stale,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refresh_errors": self.refresh_errors,
+            "providers": {
+                provider: {
+                    "models": len(entry.models),
+                    "age": round(now - entry.fetched_at, 1),
+                    "etag": entry.etag,
+                }
+                for provider, entry in self._entries.items()
+            },
+        }
@@ -0,0 +1,216 @@
+"""
+Single-flight request coalescing.
+
+Concurrent requests with the same canonical key share one upstream call.
+Non-streaming callers await the same result; streaming callers subscribe to a
+shared token fan-out and late joiners first receive the chunks already produced.
+
+Whether a caller leads or joins is decided without yielding to the event loop,
+and a flight is registered before its leader awaits admission. Admission and
+charging therefore happen once per flight, on the leader's path only. A stream
+flight owns its leader's scheduler slot, so the slot is held exactly as long as
+the upstream stream runs, whether or not the leader is still listening.
+"""
+
+import asyncio
+import logging
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from ..models.schemas import ChatRequest, ChatResponse, StreamChunk
+from ..config import settings
+from .scheduler import Lease
+
+logger = logging.getLogger(__name__)
+
+
+class _StreamFlight:
+    """One upstream stream fanned out to any number of subscribers"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[StreamChunk] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        # Callers on this flight, counted from the moment they lead or join
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def pump(self, source: AsyncGenerator[StreamChunk, None]) -> None:
+        try:
+            async for chunk in source:
+                async with self.changed:
+                    self.chunks.append(chunk)
+                    self.changed.notify_all()
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            await source.aclose()
+            self.done = True
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def fail(self, error: BaseException) -> None:
+        """End a flight that never started, e.g. because its leader was rejected"""
+        self.error = error
+        self.done = True
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def follow(self) -> AsyncGenerator[StreamChunk, None]:
+        index = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: index < len(self.chunks) or self.done)
+                pending = self.chunks[index:]
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if self.done and index >= len(self.chunks):
+                break
+
+        if isinstance(self.error, asyncio.CancelledError):
+            # The upstream task was cancelled from outside, e.g. at shutdown
+            raise RuntimeError("The shared upstream stream was cancelled")
+        if self.error is not None:
+            raise self.error
+
+
+class Subscription:
+    """One caller's place on a stream flight; close() is idempotent"""
+
+    def __init__(self, coalescer: "RequestCoalescer", flight: _StreamFlight):
+        self.coalescer = coalescer
+        self.flight = flight
+        self.closed = False
+        flight.subscribers += 1
+
+    async def chunks(self) -> AsyncGenerator[StreamChunk, None]:
+        """The flight's chunks from the first one, as they are produced"""
+        try:
+            async for chunk in self.flight.follow():
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.coalescer._leave(self.flight)
+
+
+class RequestCoalescer:
+    """Deduplicates identical in-flight chat requests"""
+
+    def __init__(self, enabled: Optional[bool] = None, max_temperature: Optional[float] = None):
+        self.enabled = settings.COALESCE_ENABLED if enabled is None else enabled
+        self.max_temperature = (
+            settings.COALESCE_MAX_TEMPERATURE if max_temperature is None else max_temperature
+        )
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    def is_coalescable(self, request: ChatRequest) -> bool:
+        """Only share upstream calls whose output should not differ between callers"""
+        if not self.enabled:
+            return False
+        temperature = 0.7 if request.temperature is None else request.temperature
+        return temperature <= self.max_temperature
+
+    async def run(
+        self, key: str, factory: Callable[[], Awaitable[ChatResponse]]
+    ) -> ChatResponse:
+        """
+        Run ``factory`` once for all concurrent callers with the same key.
+
+        The leader's ``factory`` should include admission and charging: joiners
+        only await its result (or its rejection).
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.joined += 1
+            result = await asyncio.shield(future)
+            return result.model_copy(deep=True)
+
+        self.leaders += 1
+        future = asyncio.ensure_future(factory())
+        self._calls[key] = future
+        future.add_done_callback(
+            lambda done: self._calls.pop(key) if self._calls.get(key) is done else None
+        )
+        return await asyncio.shield(future)
+
+    def flight(self, key: str) -> Tuple[Subscription, bool]:
+        """
+        A subscription to the stream flight for ``key`` and whether the caller leads it.
+
+        A leader must follow up with ``start`` once admitted, or ``abort``;
+        until then joiners wait on the flight without taking any resources.
+        """
+        flight = self._streams.get(key)
+        leading = flight is None
+        if leading:
+            self.leaders += 1
+            flight = self._streams[key] = _StreamFlight(key)
+        else:
+            self.joined += 1
+        return Subscription(self, flight), leading
+
+    def _forget(self, flight: _StreamFlight) -> None:
+        if self._streams.get(flight.key) is flight:
+            del self._streams[flight.key]
+
+    def start(
+        self,
+        subscription: Subscription,
+        source: AsyncGenerator[StreamChunk, None],
+        lease: Optional[Lease] = None,
+        on_finish: Optional[Callable[[List[StreamChunk]], None]] = None,
+    ) -> None:
+        """
+        Pump an admitted leader's upstream stream to the flight's subscribers.
+
+        The flight owns ``lease`` from here on: the slot is released when the
+        upstream stream ends or is cancelled, whichever subscriber stays longest.
+        """
+        flight = subscription.flight
+
+        def finished(_: asyncio.Task) -> None:
+            # Also runs for a task cancelled before its first step
+            self._forget(flight)
+            if lease is not None:
+                lease.release()
+            if on_finish is not None:
+                on_finish(flight.chunks)
+
+        flight.task = asyncio.create_task(flight.pump(source))
+        flight.task.add_done_callback(finished)
+
+    async def abort(self, subscription: Subscription, error: BaseException) -> None:
+        """The leader was not admitted; its joiners get the same error"""
+        self._forget(subscription.flight)
+        await subscription.flight.fail(error)
+
+    def _leave(self, flight: _StreamFlight) -> None:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done and flight.task is not None:
+            # Nobody is listening any more; stop generating upstream
+            self._forget(flight)
+            flight.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "leaders": self.leaders,
+            "joined": self.joined,
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+        }
+
+
+# Process-wide coalescer
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,288 @@
+"""
+Context-window-aware history trimming.
+
+Before a request is sent to a provider its history is fitted to the target
+model's context window, minus the system prompt, the new message and room for
+the reply. Token counts are estimated per message and, for stored
+conversations, cached as running totals so a turn only counts what is new.
+
+When the history no longer fits, older messages are dropped according to
+CONTEXT_POLICY:
+
+- ``sliding_window``: keep the most recent messages that fit.
+- ``system_recent``: keep system messages from the history, then the most
+  recent messages that fit.
+- ``summarize``: like ``system_recent``, and the dropped turns are summarized
+  in the background by a cheap model (CONTEXT_SUMMARY_MODEL). The summary is
+  added to the system prompt once it is ready.
+
+Trimming cuts down to CONTEXT_TRIM_TARGET of the budget and then keeps that
+cut point until the history outgrows the budget again. The prompt prefix
+therefore stays identical for several turns and Ollama can keep reusing its KV
+cache, instead of re-evaluating a window that shifts by one message per turn.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import math
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from ..models.schemas import ChatMessage, ChatRequest, ProviderEnum, Role
+from ..config import settings
+from .conversations import ConversationHistory
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("sliding_window", "system_recent", "summarize")
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep names, facts, "
+    "decisions and open questions; omit pleasantries.\n\n"
+)
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Cheap token estimate (~4 characters per token)"""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def message_tokens(message: ChatMessage) -> int:
+    return estimate_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def token_sums(history: List[ChatMessage]) -> Tuple[List[int], int]:
+    """Running token totals for ``history``; cached for stored conversations"""
+    if isinstance(history, ConversationHistory):
+        return history.cumulative("tokens", message_tokens)
+    sums = [0]
+    for message in history:
+        sums.append(sums[-1] + message_tokens(message))
+    return sums, 0
+
+
+def chain_digest(previous: str, message: ChatMessage) -> str:
+    """Digest of a history prefix extended by ``message``"""
+    # Timestamps are left out: clients that omit them get a fresh one per request
+    raw = f"{previous}\0{Role(message.role).value}\0{message.content}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def prefix_digests(history: List[ChatMessage]) -> Tuple[List[str], int]:
+    """
+    Running digests of ``history``; cached for stored conversations.
+
+    ``digests[base + i + 1]`` identifies the whole history up to and including
+    message ``i``, so two conversations only share a key if they share every
+    message up to it.
+    """
+    if isinstance(history, ConversationHistory):
+        return history.fold("digests", chain_digest, "")
+    digests = [""]
+    for message in history:
+        digests.append(chain_digest(digests[-1], message))
+    return digests, 0
+
+
+class ContextWindow:
+    """Fits request histories to per-model context budgets"""
+
+    def __init__(
+        self,
+        services: Dict[str, object],
+        windows: Optional[Dict[str, int]] = None,
+        policy: Optional[str] = None,
+        reserve_tokens: Optional[int] = None,
+        trim_target: Optional[float] = None,
+        summary_model: Optional[str] = None,
+        summary_max_tokens: Optional[int] = None,
+        max_entries: int = 4096,
+    ):
+        self.services = services
+        self.windows = settings.CONTEXT_WINDOWS if windows is None else windows
+        self.policy = settings.CONTEXT_POLICY if policy is None else policy
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown CONTEXT_POLICY '{self.policy}', expected one of {POLICIES}")
+        self.reserve_tokens = (
+            settings.CONTEXT_RESERVE_TOKENS if reserve_tokens is None else reserve_tokens
+        )
+        self.trim_target = settings.CONTEXT_TRIM_TARGET if trim_target is None else trim_target
+        self.summary_model = (
+            settings.CONTEXT_SUMMARY_MODEL if summary_model is None else summary_model
+        )
+        self.summary_max_tokens = (
+            settings.CONTEXT_SUMMARY_MAX_TOKENS if summary_max_tokens is None else summary_max_tokens
+        )
+        self.max_entries = max_entries
+
+        # Digest of the history through the first kept message -> cut points chosen earlier
+        self._anchors: "OrderedDict[str, None]" = OrderedDict()
+        # Digest of the history through the first kept message -> summary of everything before it
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._summarizing: Dict[str, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.trimmed = 0
+        self.messages_dropped = 0
+        self.tokens_dropped = 0
+        self.summaries = 0
+        self.summary_hits = 0
+        self.summary_failures = 0
+
+    def window(self, provider: str, model: str) -> int:
+        """Context window for ``provider:model``, else the provider default (0 = unlimited)"""
+        window = self.windows.get(f"{provider}:{model}")
+        if window is None:
+            window = self.windows.get(provider, 0)
+        return window
+
+    @staticmethod
+    def _remember(cache: OrderedDict, key: str, value, max_entries: int) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+    def _cut(
+        self,
+        history: List[ChatMessage],
+        sums: List[int],
+        digests: List[str],
+        base: int,
+        budget: int,
+    ) -> int:
+        """Index of the first history message to keep"""
+        total = sums[base + len(history)]
+        # Smallest cut whose tail fits the budget
+        needed = bisect.bisect_left(sums, total - budget, base, base + len(history)) - base
+        # Reuse the earliest cut point chosen before that still fits
+        for index in range(needed, len(history)):
+            if digests[base + index + 1] in self._anchors:
+                return index
+        target = total - int(budget * self.trim_target)
+        cut = bisect.bisect_left(sums, target, base, base + len(history)) - base
+        if cut < len(history):
+            self._remember(self._anchors, digests[base + cut + 1], None, self.max_entries)
+        return cut
+
+    def fit(self, request: ChatRequest) -> ChatRequest:
+        """``request`` with its history trimmed to the target's budget; unchanged if it fits"""
+        history = request.history
+        window = self.window(request.provider.value, request.model)
+        if not history or window <= 0:
+            return request
+
+        budget = (
+            window
+            - (request.max_tokens or self.reserve_tokens)
+            - estimate_tokens(request.system_prompt)
+            - estimate_tokens(request.message)
+            - MESSAGE_OVERHEAD_TOKENS * 2
+        )
+        sums, base = token_sums(history)
+        if sums[base + len(history)] - sums[base] <= budget:
+            return request
+
+        pinned: List[ChatMessage] = []
+        if self.policy != "sliding_window":
+            pinned = [m for m in history if Role(m.role) == Role.system]
+            budget -= sum(message_tokens(m) for m in pinned)
+        if self.policy == "summarize":
+            budget -= self.summary_max_tokens
+
+        digests, _ = prefix_digests(history)
+        cut = self._cut(history, sums, digests, base, budget) if budget > 0 else len(history)
+        if isinstance(history, ConversationHistory):
+            kept = history.tail(cut)
+        else:
+            kept = history[cut:]
+        dropped = history[:cut]
+        if pinned:
+            # Budgeted for every system message; only the dropped ones need re-adding
+            pinned = [m for m in dropped if Role(m.role) == Role.system]
+            if pinned:
+                kept = pinned + list(kept)
+
+        self.trimmed += 1
+        self.messages_dropped += len(dropped) - len(pinned)
+        self.tokens_dropped += sums[base + cut] - sums[base]
+        update = {"history": kept}
+
+        if self.policy == "summarize" and cut < len(history):
+            summary = self._summary(history, cut, digests, base)
+            if summary:
+                prefix = f"{request.system_prompt}\n\n" if request.system_prompt else ""
+                update["system_prompt"] = f"{prefix}Summary of the earlier conversation: {summary}"
+        return request.model_copy(update=update)
+
+    def _summary(
+        self, history: List[ChatMessage], cut: int, digests: List[str], base: int
+    ) -> Optional[str]:
+        """Summary of ``history[:cut]`` if ready; otherwise start making it"""
+        key = digests[base + cut + 1]
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self.summary_hits += 1
+            self._summaries.move_to_end(key)
+            return summary
+        if key in self._summarizing or not self.summary_model:
+            return None
+
+        # Build on the latest summary of an earlier cut, if there is one
+        previous, start = None, 0
+        for index in range(cut - 1, 0, -1):
+            previous = self._summaries.get(digests[base + index + 1])
+            if previous is not None:
+                start = index
+                break
+        task = asyncio.create_task(self._summarize(key, previous, list(history[start:cut])))
+        self._summarizing[key] = task
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        task.add_done_callback(lambda _: self._summarizing.pop(key, None))
+        return None
+
+    async def _summarize(
+        self, key: str, previous: Optional[str], messages: List[ChatMessage]
+    ) -> None:
+        provider, _, model = self.summary_model.partition(":")
+        transcript = "\n".join(f"{Role(m.role).value}: {m.content}" for m in messages)
+        if previous:
+            transcript = f"Earlier summary: {previous}\n\n{transcript}"
+        try:
+            request = ChatRequest(
+                message=SUMMARY_PROMPT + transcript,
+                model=model,
+                provider=ProviderEnum(provider),
+                stream=False,
+                max_tokens=self.summary_max_tokens,
+                temperature=0.2,
+            )
+            response = await self.services[provider].chat_completion(request)
+        except Exception as e:
+            self.summary_failures += 1
+            logger.warning("[Context] Summarizing %s messages failed: %s", len(messages), e)
+            return
+        self.summaries += 1
+        self._remember(self._summaries, key, response.message.strip(), self.max_entries)
+
+    async def close(self) -> None:
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "trimmed": self.trimmed,
+            "messages_dropped": self.messages_dropped,
+            "tokens_dropped": self.tokens_dropped,
+            "summaries": self.summaries,
+            "summary_hits": self.summary_hits,
+            "summary_failures": self.summary_failures,
+            "summarizing": len(self._summarizing),
+        }
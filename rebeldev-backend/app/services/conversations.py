@@ -0,0 +1,356 @@
+"""
+Server-side conversation store.
+
+Conversations are append-only message lists kept in an in-memory LRU, backed
+by SQLite so they survive eviction and restarts. A chat turn that references a
+``conversation_id`` sends only its new message; the stored history is filled
+in server-side and the turn (question and reply) is appended once it
+completes. Each conversation also caches its history as rendered by each
+provider, so a turn renders only the messages added since the previous one.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from ..models.schemas import ChatMessage, ConversationResponse, Role
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ConversationHistory(list):
+    """
+    Snapshot of (a window of) a stored conversation, used as ``ChatRequest.history``.
+
+    Holds ``source[start:end]`` and shares the conversation's render cache:
+    since conversations only grow, the cache is always rendered from the first
+    message and any snapshot is a slice of it.
+    """
+
+    def __init__(
+        self,
+        source: List[ChatMessage],
+        rendered: Dict[str, list],
+        start: int = 0,
+        end: Optional[int] = None,
+    ):
+        self.end = len(source) if end is None else end
+        super().__init__(source[start:self.end])
+        self.source = source
+        self.rendered = rendered
+        self.start = start
+
+    def tail(self, offset: int) -> "ConversationHistory":
+        """The same snapshot without its first ``offset`` messages"""
+        return ConversationHistory(self.source, self.rendered, self.start + offset, self.end)
+
+    def render(self, kind: str, render: Callable[[ChatMessage], T]) -> List[T]:
+        cached = self.rendered.setdefault(kind, [])
+        for message in self.source[len(cached):self.end]:
+            cached.append(render(message))
+        return cached[self.start:self.end]
+
+    def fold(
+        self, kind: str, step: Callable[[T, ChatMessage], T], initial: T
+    ) -> Tuple[List[T], int]:
+        """
+        Running fold of ``step`` over the conversation, and this snapshot's base.
+
+        ``values[base + i]`` covers the snapshot's first ``i`` messages plus
+        everything before the snapshot.
+        """
+        values = self.rendered.setdefault(kind, [initial])
+        for message in self.source[len(values) - 1:self.end]:
+            values.append(step(values[-1], message))
+        return values, self.start
+
+    def cumulative(self, kind: str, value: Callable[[ChatMessage], int]) -> Tuple[List[int], int]:
+        """Running totals of ``value``, so range totals are O(1); see ``fold``"""
+        return self.fold(kind, lambda total, message: total + value(message), 0)
+
+
+def chat_message(message: ChatMessage) -> dict:
+    """Role/content form of a message shared by every provider's chat API"""
+    return {"role": Role(message.role).value, "content": message.content}
+
+
+def render_history(
+    history: List[ChatMessage], kind: str, render: Callable[[ChatMessage], T]
+) -> List[T]:
+    """Render each history message, reusing a conversation's cache when there is one"""
+    if isinstance(history, ConversationHistory):
+        return history.render(kind, render)
+    return [render(message) for message in history]
+
+
+class Conversation:
+    """One stored conversation"""
+
+    def __init__(
+        self,
+        conversation_id: str,
+        system_prompt: Optional[str] = None,
+        messages: Optional[List[ChatMessage]] = None,
+        created_at: Optional[float] = None,
+        updated_at: Optional[float] = None,
+    ):
+        self.id = conversation_id
+        self.system_prompt = system_prompt
+        self.messages: List[ChatMessage] = messages or []
+        self.created_at = time.time() if created_at is None else created_at
+        self.updated_at = self.created_at if updated_at is None else updated_at
+        self.rendered: Dict[str, list] = {}
+
+    def history(self) -> ConversationHistory:
+        return ConversationHistory(self.messages, self.rendered)
+
+    def to_response(self, offset: int = 0) -> ConversationResponse:
+        return ConversationResponse(
+            id=self.id,
+            system_prompt=self.system_prompt,
+            messages=self.messages[offset:],
+            count=len(self.messages),
+            created_at=datetime.fromtimestamp(self.created_at, timezone.utc),
+            updated_at=datetime.fromtimestamp(self.updated_at, timezone.utc),
+        )
+
+
+class ConversationDisk:
+    """SQLite tier; blocking sqlite calls run in a worker thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id TEXT PRIMARY KEY, system_prompt TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+                "content TEXT NOT NULL, timestamp TEXT, "
+                "PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _rows(conversation_id: str, start: int, messages: List[ChatMessage]) -> list:
+        return [
+            (
+                conversation_id,
+                start + i,
+                Role(m.role).value,
+                m.content,
+                m.timestamp.isoformat() if m.timestamp else None,
+            )
+            for i, m in enumerate(messages)
+        ]
+
+    def _create(self, conversation: Conversation) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO conversations (id, system_prompt, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    conversation.id,
+                    conversation.system_prompt,
+                    conversation.created_at,
+                    conversation.updated_at,
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                self._rows(conversation.id, 0, conversation.messages),
+            )
+            conn.commit()
+
+    def _append(
+        self, conversation_id: str, start: int, messages: List[ChatMessage], updated_at: float
+    ) -> None:
+        # Only the new rows are written; earlier turns are never rewritten
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                self._rows(conversation_id, start, messages),
+            )
+            conn.execute(
+                "UPDATE conversations SET updated_at = ? WHERE id = ?",
+                (updated_at, conversation_id),
+            )
+            conn.commit()
+
+    def _load(self, conversation_id: str) -> Optional[Conversation]:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT system_prompt, created_at, updated_at FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages "
+                "WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,),
+            ).fetchall()
+        messages = [
+            ChatMessage(
+                role=role,
+                content=content,
+                timestamp=datetime.fromisoformat(timestamp) if timestamp else None,
+            )
+            for role, content, timestamp in rows
+        ]
+        return Conversation(conversation_id, row[0], messages, row[1], row[2])
+
+    def _delete(self, conversation_id: str) -> bool:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            deleted = conn.execute(
+                "DELETE FROM conversations WHERE id = ?", (conversation_id,)
+            ).rowcount
+            conn.commit()
+        return bool(deleted)
+
+    async def create(self, conversation: Conversation) -> None:
+        await asyncio.to_thread(self._create, conversation)
+
+    async def append(
+        self, conversation_id: str, start: int, messages: List[ChatMessage], updated_at: float
+    ) -> None:
+        await asyncio.to_thread(self._append, conversation_id, start, messages, updated_at)
+
+    async def load(self, conversation_id: str) -> Optional[Conversation]:
+        return await asyncio.to_thread(self._load, conversation_id)
+
+    async def delete(self, conversation_id: str) -> bool:
+        return await asyncio.to_thread(self._delete, conversation_id)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ConversationStore:
+    """In-memory LRU of conversations in front of the SQLite tier"""
+
+    def __init__(self, max_entries: Optional[int] = None, sqlite_path: Optional[str] = None):
+        self.max_entries = (
+            settings.CONVERSATION_MAX_IN_MEMORY if max_entries is None else max_entries
+        )
+        sqlite_path = settings.CONVERSATION_SQLITE_PATH if sqlite_path is None else sqlite_path
+        self.disk = ConversationDisk(sqlite_path) if sqlite_path else None
+        self._entries: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.disk_loads = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, conversation: Conversation) -> None:
+        self._entries[conversation.id] = conversation
+        self._entries.move_to_end(conversation.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def create(
+        self, system_prompt: Optional[str] = None, messages: Optional[List[ChatMessage]] = None
+    ) -> Conversation:
+        conversation = Conversation(uuid.uuid4().hex, system_prompt, list(messages or []))
+        if self.disk is not None:
+            await self.disk.create(conversation)
+        self._remember(conversation)
+        return conversation
+
+    async def _load(self, conversation_id: str) -> Optional[Conversation]:
+        try:
+            conversation = await self.disk.load(conversation_id)
+        except sqlite3.Error as e:
+            logger.warning("[Conversations] Load of %s failed: %s", conversation_id, e)
+            return None
+        if conversation is not None:
+            self.disk_loads += 1
+            # A concurrent create or append may have beaten the load into memory
+            conversation = self._entries.get(conversation_id, conversation)
+            self._remember(conversation)
+        return conversation
+
+    async def get(self, conversation_id: str) -> Optional[Conversation]:
+        conversation = self._entries.get(conversation_id)
+        if conversation is not None:
+            self.hits += 1
+            self._entries.move_to_end(conversation_id)
+            return conversation
+        if self.disk is None:
+            self.misses += 1
+            return None
+
+        # Single-flight, so concurrent turns share one in-memory copy
+        task = self._loading.get(conversation_id)
+        if task is None:
+            task = asyncio.create_task(self._load(conversation_id))
+            self._loading[conversation_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+        conversation = await asyncio.shield(task)
+        if conversation is None:
+            self.misses += 1
+        return conversation
+
+    async def append(self, conversation: Conversation, messages: List[ChatMessage]) -> None:
+        """Append messages; the sequence numbers are claimed before any await"""
+        start = len(conversation.messages)
+        conversation.messages.extend(messages)
+        conversation.updated_at = time.time()
+        self._remember(conversation)
+        if self.disk is not None:
+            try:
+                await self.disk.append(conversation.id, start, messages, conversation.updated_at)
+            except sqlite3.Error as e:
+                logger.warning("[Conversations] Append to %s failed: %s", conversation.id, e)
+
+    async def delete(self, conversation_id: str) -> bool:
+        deleted = self._entries.pop(conversation_id, None) is not None
+        if self.disk is not None:
+            deleted = await self.disk.delete(conversation_id) or deleted
+        return deleted
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_loads": self.disk_loads,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_enabled": self.disk is not None,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+# Process-wide conversation store
+conversation_store = ConversationStore()
@@ -0,0 +1,272 @@
+"""
+Runtime diagnostics for the event loop.
+
+Every provider call and every stream shares one asyncio loop. Any synchronous
+work on it stalls all of them: a large ``json.loads``, validating a long
+history, a blocking write. This module finds such work in a running process.
+
+- ``LoopMonitor`` measures loop lag continuously. A probe task sleeps for a
+  fixed interval and records how late it wakes up.
+- The monitor also runs a watchdog thread. When the probe has not run for
+  longer than the slow-callback threshold, the loop is blocked. The watchdog
+  then records the loop thread's stack, which shows the code doing the
+  blocking.
+- ``SamplingProfiler`` samples the loop thread's stack from another thread at
+  a fixed rate. It returns collapsed stacks (``frame;frame;frame count``), the
+  input format of flamegraph.pl, speedscope and most other flame graph tools.
+
+Everything here is opt-in (DIAGNOSTICS_ENABLED). Both threads only read
+interpreter state, so the loop itself pays for one short task per interval.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+
+from ..config import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# Frames recorded for a blocked loop, innermost last
+STACK_DEPTH = 40
+# Lag samples kept for the recent percentiles
+RECENT_WINDOW = 60.0
+
+loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "How late the event loop ran a timer", buckets=LAG_BUCKETS
+)
+loop_blocked = metrics.counter(
+    "event_loop_blocked_total", "Times the event loop was blocked past the slow-callback threshold"
+)
+
+
+class ProfilerError(Exception):
+    """The profiler is not in the state the operation needs"""
+
+
+def format_stack(frame, limit: int = STACK_DEPTH) -> List[str]:
+    """``file:line in function: source`` for each frame, outermost first"""
+    return [
+        f"{entry.filename}:{entry.lineno} in {entry.name}" + (f": {entry.line}" if entry.line else "")
+        for entry in traceback.extract_stack(frame, limit)
+    ]
+
+
+def fold_stack(frame) -> str:
+    """One collapsed-stack line: frames outermost first, separated by semicolons"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        frames.append(f"{module}:{getattr(code, 'co_qualname', code.co_name)}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class LoopMonitor:
+    """Loop lag probe plus a watchdog that records what is blocking the loop"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        interval: Optional[float] = None,
+        slow_threshold: Optional[float] = None,
+        keep: Optional[int] = None,
+    ):
+        self.enabled = settings.DIAGNOSTICS_ENABLED if enabled is None else enabled
+        self.interval = settings.DIAGNOSTICS_LAG_INTERVAL if interval is None else interval
+        self.slow_threshold = (
+            settings.DIAGNOSTICS_SLOW_CALLBACK if slow_threshold is None else slow_threshold
+        )
+        self.slow_callbacks: Deque[dict] = deque(
+            maxlen=settings.DIAGNOSTICS_SLOW_CALLBACKS_KEPT if keep is None else keep
+        )
+        self.recent: Deque[float] = deque(maxlen=max(int(RECENT_WINDOW / self.interval), 1))
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.loop_thread: Optional[int] = None
+        self._heartbeat = 0.0
+        self._stall: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Start probing the running loop; a no-op unless enabled"""
+        if not self.enabled or self._task is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.to_thread(self._watchdog.join)
+
+    async def _probe(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._heartbeat = now
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.recent.append(lag)
+            if metrics.enabled:
+                loop_lag.observe(lag)
+            stall, self._stall = self._stall, None
+            if stall is not None:
+                # The watchdog saw the start of this stall; now its length is known
+                stall["duration_ms"] = round(lag * 1000, 1)
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.slow_threshold / 2):
+            blocked = time.monotonic() - self._heartbeat - self.interval
+            if blocked < self.slow_threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stall = {
+                "detected_at": time.time(),
+                "blocked_ms": round(blocked * 1000, 1),
+                "duration_ms": None,
+                "stack": format_stack(frame),
+            }
+            del frame
+            self._stall = stall
+            self.slow_callbacks.append(stall)
+            self.blocked += 1
+            if metrics.enabled:
+                loop_blocked.inc()
+            logger.warning(
+                "[Diagnostics] Event loop blocked for %.0fms in %s",
+                blocked * 1000,
+                stall["stack"][-1] if stall["stack"] else "?",
+                extra={"stack": stall["stack"]},
+            )
+
+    def stats(self) -> dict:
+        recent = sorted(self.recent)
+
+        def ms(value: float) -> float:
+            return round(value * 1000, 2)
+
+        return {
+            "enabled": self.enabled,
+            "running": self._task is not None,
+            "interval_ms": ms(self.interval),
+            "slow_callback_ms": ms(self.slow_threshold),
+            "lag": {
+                "samples": self.samples,
+                "mean_ms": ms(self.total_lag / self.samples) if self.samples else None,
+                "max_ms": ms(self.max_lag),
+                # Over the last RECENT_WINDOW seconds
+                "recent_p50_ms": ms(recent[len(recent) // 2]) if recent else None,
+                "recent_p99_ms": ms(recent[int(len(recent) * 0.99)]) if recent else None,
+                "recent_max_ms": ms(recent[-1]) if recent else None,
+            },
+            "blocked": self.blocked,
+            "slow_callbacks": list(self.slow_callbacks),
+        }
+
+
+class SamplingProfiler:
+    """Samples a thread's stack from a background thread and folds the samples"""
+
+    def __init__(self, max_seconds: Optional[float] = None):
+        self.max_seconds = (
+            settings.DIAGNOSTICS_PROFILE_MAX_SECONDS if max_seconds is None else max_seconds
+        )
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.hz = 0
+        self.started_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, hz: int = 100, thread_id: Optional[int] = None, all_threads: bool = False) -> None:
+        """Sample ``thread_id`` (default: the caller's thread, i.e. the loop) ``hz`` times a second"""
+        if self.running:
+            raise ProfilerError("The profiler is already running")
+        self.stacks = Counter()
+        self.samples = 0
+        self.hz = hz
+        self.started_at = time.time()
+        self.ended_at = None
+        self._stopped.clear()
+        target = threading.get_ident() if thread_id is None else thread_id
+        self._thread = threading.Thread(
+            target=self._sample, args=(target, all_threads), name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def _sample(self, target: int, all_threads: bool) -> None:
+        interval = 1 / self.hz
+        deadline = time.monotonic() + self.max_seconds
+        own = threading.get_ident()
+        while not self._stopped.wait(interval):
+            frames: Dict[int, object] = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own or (not all_threads and thread_id != target):
+                    continue
+                self.stacks[fold_stack(frame)] += 1
+                self.samples += 1
+            del frames
+            if time.monotonic() >= deadline:
+                logger.warning("[Diagnostics] Profiler stopped after %.0fs", self.max_seconds)
+                break
+        self.ended_at = time.time()
+
+    async def stop(self) -> str:
+        """Stop sampling and return the collapsed stacks, most frequent first"""
+        thread = self._thread
+        if thread is None:
+            raise ProfilerError("The profiler has not been started")
+        self._stopped.set()
+        # The sampler may be mid-sample; wait for it off the loop
+        await asyncio.to_thread(thread.join)
+        if self._thread is thread:
+            self._thread = None
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "hz": self.hz,
+            "samples": self.samples,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+        }
+
+
+# Process-wide loop monitor and profiler
+loop_monitor = LoopMonitor()
+profiler = SamplingProfiler()
@@ -0,0 +1,333 @@
+"""
+Cross-provider failover and hedged streaming.
+
+A request is served by a chain of ``provider:model`` targets: the requested one
+followed by its fallbacks (from the request or ROUTING_FALLBACKS). Targets are
+tried in order until one succeeds. With hedging on, a stream that has not
+produced its first token within the primary target's p95 time to first token
+races the next target as well; whichever streams first is kept and the other
+is cancelled. Targets whose circuit breaker is open are skipped, and the
+outcome of every attempt is fed back into the breakers. Each target gets the
+history trimmed to its own context window.
+"""
+
+import asyncio
+import logging
+import math
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Tuple
+
+from ..models.schemas import ChatRequest, ChatResponse, ProviderEnum, StreamChunk
+from ..config import settings
+from .context import ContextWindow
+from .health import HealthMonitor, ProviderUnavailable
+from .metrics import error_class, record_completion, record_error, record_first_token
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = {p.value for p in ProviderEnum}
+
+
+def parse_target(target: str) -> Tuple[str, str]:
+    """Split ``provider:model``; model names may themselves contain ':'"""
+    provider, _, model = target.partition(":")
+    if provider not in PROVIDERS or not model:
+        raise ValueError(f"Invalid routing target '{target}', expected provider:model")
+    return provider, model
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """Whether an error says the provider is unhealthy, rather than the request bad"""
+    kind = error_class(error)
+    return kind in ("connection", "upstream_5xx") or kind.startswith("timeout")
+
+
+class TTFTStats:
+    """Rolling time-to-first-token samples for one target"""
+
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+class _Attempt:
+    """One in-flight target of a stream, waiting for its first chunk"""
+
+    def __init__(self, target: str, request: ChatRequest, stream: AsyncGenerator):
+        self.target = target
+        self.request = request
+        self.stream = stream
+        self.started = asyncio.get_running_loop().time()
+        self.first: asyncio.Task = asyncio.ensure_future(stream.__anext__())
+
+    async def cancel(self) -> None:
+        self.first.cancel()
+        await asyncio.gather(self.first, return_exceptions=True)
+        await self.stream.aclose()
+
+
+class ProviderFailover:
+    """Routes requests across a fallback chain of providers, optionally hedged"""
+
+    def __init__(
+        self,
+        services: Dict[str, object],
+        health: Optional[HealthMonitor] = None,
+        context: Optional[ContextWindow] = None,
+        fallbacks: Optional[Dict[str, List[str]]] = None,
+        hedge_enabled: Optional[bool] = None,
+        hedge_delay: Optional[float] = None,
+        hedge_min_samples: Optional[int] = None,
+    ):
+        self.services = services
+        self.health = health
+        self.context = context
+        self.fallbacks = settings.ROUTING_FALLBACKS if fallbacks is None else fallbacks
+        self.hedge_enabled = (
+            settings.ROUTING_HEDGE_ENABLED if hedge_enabled is None else hedge_enabled
+        )
+        self.hedge_delay = settings.ROUTING_HEDGE_DELAY if hedge_delay is None else hedge_delay
+        self.hedge_min_samples = (
+            settings.ROUTING_HEDGE_MIN_SAMPLES if hedge_min_samples is None else hedge_min_samples
+        )
+        self.ttft: Dict[str, TTFTStats] = {}
+        self.fallbacks_used = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.failures: Dict[str, int] = {}
+
+    def chain(self, request: ChatRequest) -> List[Tuple[str, ChatRequest]]:
+        """``(target, request)`` pairs in the order they should be tried"""
+        primary = f"{request.provider.value}:{request.model}"
+        fallbacks = request.fallbacks
+        if fallbacks is None:
+            fallbacks = self.fallbacks.get(primary, [])
+
+        chain = [(primary, request)]
+        for target in fallbacks:
+            provider, model = parse_target(target)
+            if target == primary or provider not in self.services:
+                continue
+            chain.append(
+                (target, request.model_copy(update={"provider": ProviderEnum(provider), "model": model}))
+            )
+        return chain
+
+    def hedge_after(self, target: str) -> float:
+        """Seconds to wait for a first token before hedging ``target``"""
+        stats = self.ttft.get(target)
+        if stats is None or len(stats.samples) < self.hedge_min_samples:
+            return self.hedge_delay
+        return stats.p95()
+
+    def _admit(self, request: ChatRequest) -> bool:
+        return self.health is None or self.health.available(request.provider.value)
+
+    def _unavailable(self, chain: List[Tuple[str, ChatRequest]]) -> ProviderUnavailable:
+        wait = min(self.health.retry_after(routed.provider.value) for _, routed in chain)
+        return ProviderUnavailable(
+            f"No available provider for {chain[0][0]}: circuit breaker open",
+            retry_after=max(1, math.ceil(wait)),
+        )
+
+    def check(self, request: ChatRequest) -> None:
+        """Fail fast, before admission, when every target's breaker is open"""
+        if self.health is None:
+            return
+        chain = self.chain(request)
+        if all(self.health.is_open(routed.provider.value) for _, routed in chain):
+            error = self._unavailable(chain)
+            record_error(request.provider.value, request.model, error)
+            raise error
+
+    def _fit(self, request: ChatRequest) -> ChatRequest:
+        """Trim the history to the context window of the target actually called"""
+        return self.context.fit(request) if self.context is not None else request
+
+    def _record_success(self, request: ChatRequest) -> None:
+        if self.health is not None:
+            self.health.record(request.provider.value, True)
+
+    def _record_failure(self, target: str, request: ChatRequest, error: Exception) -> None:
+        self.failures[target] = self.failures.get(target, 0) + 1
+        record_error(request.provider.value, request.model, error)
+        logger.warning("[Failover] %s failed: %s", target, error)
+        if self.health is not None and is_provider_failure(error):
+            # A 4xx (bad key, unknown model, oversized prompt) must not open the breaker
+            self.health.record(request.provider.value, False)
+
+    @staticmethod
+    def _annotate(metadata: Optional[dict], target: str, attempt: int, hedged: bool) -> dict:
+        return {**(metadata or {}), "route": target, "route_attempt": attempt, "hedged": hedged}
+
+    async def complete(self, request: ChatRequest) -> ChatResponse:
+        """Non-streaming completion, falling back along the chain on errors"""
+        chain = self.chain(request)
+        loop = asyncio.get_running_loop()
+        last_error: Optional[Exception] = None
+        for attempt, (target, routed) in enumerate(chain):
+            if not self._admit(routed):
+                continue
+            started = loop.time()
+            try:
+                service = self.services[routed.provider.value]
+                response = await service.chat_completion(self._fit(routed))
+            except Exception as e:
+                self._record_failure(target, routed, e)
+                last_error = e
+                continue
+            self._record_success(routed)
+            elapsed = loop.time() - started
+            tokens = (response.usage or {}).get("completion_tokens") or 0
+            record_completion(
+                routed.provider.value, routed.model, "complete", elapsed, tokens, elapsed
+            )
+            if attempt:
+                self.fallbacks_used += 1
+            if len(chain) > 1:
+                response.metadata = self._annotate(response.metadata, target, attempt, False)
+            return response
+        raise last_error or self._unavailable(chain)
+
+    def stream(self, request: ChatRequest) -> AsyncGenerator[StreamChunk, None]:
+        hedge = self.hedge_enabled if request.hedge is None else request.hedge
+        return self._stream(self.chain(request), hedge)
+
+    async def _stream(
+        self, chain: List[Tuple[str, ChatRequest]], hedge: bool
+    ) -> AsyncGenerator[StreamChunk, None]:
+        """
+        Stream from the first target to produce a token.
+
+        Failures before the first token move on to the next target. Once a
+        target has produced a token the others are cancelled, and later errors
+        propagate since part of the answer has already been sent.
+        """
+        loop = asyncio.get_running_loop()
+        pending = deque(enumerate(chain))
+        racing: Dict[asyncio.Task, Tuple[int, _Attempt]] = {}
+        last_error: Optional[Exception] = None
+
+        def launch() -> bool:
+            """Start the next target whose breaker admits it"""
+            while pending:
+                index, (target, routed) = pending.popleft()
+                if not self._admit(routed):
+                    continue
+                service = self.services[routed.provider.value]
+                attempt = _Attempt(
+                    target, routed, service.chat_completion_stream(self._fit(routed))
+                )
+                racing[attempt.first] = (index, attempt)
+                return True
+            return False
+
+        winner: Optional[Tuple[int, _Attempt, StreamChunk]] = None
+        hedged = False
+        try:
+            launch()
+            while racing and winner is None:
+                timeout = None
+                if hedge and pending and len(racing) == 1:
+                    attempt = next(iter(racing.values()))[1]
+                    elapsed = loop.time() - attempt.started
+                    timeout = max(self.hedge_after(attempt.target) - elapsed, 0)
+
+                done, _ = await asyncio.wait(
+                    racing, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if launch():
+                        hedged = True
+                        self.hedges += 1
+                    continue
+
+                for task in done:
+                    index, attempt = racing.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        last_error = Exception(f"{attempt.target} returned an empty stream")
+                        self._record_failure(attempt.target, attempt.request, last_error)
+                    except Exception as e:
+                        last_error = e
+                        self._record_failure(attempt.target, attempt.request, e)
+                    else:
+                        if winner is None:
+                            winner = (index, attempt, first)
+                            continue
+                    await attempt.stream.aclose()
+
+                if winner is None and not racing:
+                    launch()
+        finally:
+            for index, attempt in racing.values():
+                await attempt.cancel()
+            racing.clear()
+
+        if winner is None:
+            raise last_error or self._unavailable(chain)
+
+        index, attempt, first = winner
+        routed = attempt.request
+        first_at = loop.time()
+        self._record_success(routed)
+        self.ttft.setdefault(attempt.target, TTFTStats()).record(first_at - attempt.started)
+        record_first_token(routed.provider.value, routed.model, first_at - attempt.started)
+        if index:
+            self.fallbacks_used += 1
+            if hedged:
+                self.hedges_won += 1
+
+        chunk_count = 0
+        final: Optional[dict] = None
+        async with aclosing(attempt.stream) as chunks:
+            chunk = first
+            while True:
+                if chunk.content:
+                    chunk_count += 1
+                if chunk.done:
+                    final = chunk.metadata
+                    if len(chain) > 1:
+                        chunk.metadata = self._annotate(chunk.metadata, attempt.target, index, hedged)
+                yield chunk
+                if chunk.done:
+                    break
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception as e:
+                    record_error(routed.provider.value, routed.model, e)
+                    raise
+
+        # Prefer the provider's token count; a content chunk is about one token otherwise
+        tokens = (final or {}).get("eval_count") or chunk_count
+        ended = loop.time()
+        record_completion(
+            routed.provider.value, routed.model, "stream", ended - attempt.started, tokens,
+            ended - first_at,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "hedge_enabled": self.hedge_enabled,
+            "fallbacks_used": self.fallbacks_used,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "failures": dict(self.failures),
+            "ttft_p95": {
+                target: round(stats.p95(), 4)
+                for target, stats in self.ttft.items()
+                if stats.samples
+            },
+        }
@@ -0,0 +1,223 @@
+"""
+Background provider health checks and circuit breakers.
+
+A monitor probes every provider concurrently on a schedule and keeps one
+circuit breaker per provider, fed by both probes and live traffic. A breaker
+opens after repeated consecutive failures, rejects traffic while open, lets a
+single trial request through once its cooldown has passed (half-open) and
+closes again on success. ``/api/health`` is served from a snapshot that is
+rebuilt only when something changes.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderUnavailable(Exception):
+    """Every target of a request is behind an open circuit breaker"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = 503
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one provider"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.times_opened = 0
+
+    @property
+    def is_open(self) -> bool:
+        """Open and still cooling down; does not change state"""
+        return self.state == OPEN and time.monotonic() < self.opened_at + self.reset_timeout
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """Whether a request may go through now; may move open -> half-open"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now < self.opened_at + self.reset_timeout:
+                return False
+            self._transition(HALF_OPEN)
+        # Half-open: one trial at a time; a trial that never reported back lapses
+        if now - self.trial_started < self.reset_timeout:
+            return False
+        self.trial_started = now
+        return True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.consecutive_failures >= self.failure_threshold
+        ):
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        logger.info("[Health] Circuit for %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        self.trial_started = 0.0
+        self.on_change()
+
+    def on_change(self) -> None:
+        """Hook for the owning monitor"""
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+        }
+
+
+class HealthMonitor:
+    """Scheduled concurrent probes plus per-provider circuit breakers"""
+
+    def __init__(
+        self,
+        services: Dict[str, object],
+        interval: Optional[float] = None,
+        probe_timeout: Optional[float] = None,
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+    ):
+        self.services = services
+        self.interval = settings.HEALTH_CHECK_INTERVAL if interval is None else interval
+        self.probe_timeout = (
+            settings.HEALTH_CHECK_TIMEOUT if probe_timeout is None else probe_timeout
+        )
+        failure_threshold = (
+            settings.BREAKER_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        )
+        reset_timeout = settings.BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        for name in services:
+            breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+            breaker.on_change = self._refresh
+            self.breakers[name] = breaker
+        self.probed: Dict[str, Optional[bool]] = {name: None for name in services}
+        self.checked_at: Optional[float] = None
+        self._snapshot: dict = {}
+        self._task: Optional[asyncio.Task] = None
+        self._refresh()
+
+    def available(self, provider: str) -> bool:
+        """Routing check; consumes the half-open trial slot when it grants one"""
+        breaker = self.breakers.get(provider)
+        return breaker is None or breaker.allow()
+
+    def is_open(self, provider: str) -> bool:
+        """Whether the provider's breaker is open and cooling down; no side effects"""
+        breaker = self.breakers.get(provider)
+        return breaker is not None and breaker.is_open
+
+    def retry_after(self, provider: str) -> float:
+        breaker = self.breakers.get(provider)
+        return breaker.retry_after() if breaker is not None else 0.0
+
+    def record(self, provider: str, ok: bool) -> None:
+        """Feed the outcome of a live request into the provider's breaker"""
+        breaker = self.breakers.get(provider)
+        if breaker is None:
+            return
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    async def _probe(self, name: str) -> None:
+        try:
+            healthy = bool(
+                await asyncio.wait_for(self.services[name].health_check(), self.probe_timeout)
+            )
+        except Exception as e:
+            logger.warning("[Health] Probe of %s failed: %s", name, e)
+            healthy = False
+        self.probed[name] = healthy
+        self.record(name, healthy)
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(*(self._probe(name) for name in self.services))
+        self.checked_at = time.time()
+        self._refresh()
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("[Health] Probe round failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _refresh(self) -> None:
+        """Rebuild the health snapshot after a probe round or breaker transition"""
+        providers = {
+            name: None if probed is None else probed and self.breakers[name].state != OPEN
+            for name, probed in self.probed.items()
+        }
+        if any(providers.values()):
+            overall = "healthy"
+        elif all(value is None for value in providers.values()):
+            overall = "unknown"
+        else:
+            overall = "unhealthy"
+        self._snapshot = {
+            "status": overall,
+            "providers": providers,
+            "breakers": {name: b.state for name, b in self.breakers.items()},
+            "checked_at": self.checked_at,
+        }
+
+    def snapshot(self) -> dict:
+        """Current health, O(1); never touches the network"""
+        return self._snapshot
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "checked_at": self.checked_at,
+            "breakers": {name: b.to_dict() for name, b in self.breakers.items()},
+        }
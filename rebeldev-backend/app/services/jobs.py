@@ -0,0 +1,674 @@
+"""
+Asynchronous chat jobs.
+
+A job is a non-streaming chat request that is accepted immediately and run
+later by an in-process worker pool. Clients poll for its status, fetch the
+result and may cancel it, without holding a connection open for the whole
+generation. Jobs live in a pluggable queue; the SQLite queue survives restarts
+and can be shared by several workers on one host.
+
+Jobs rejected for transient reasons (queue full, quota, open breaker) go back
+to the queue until their Retry-After has passed. Jobs still running when the
+process stops are requeued on shutdown. While a job runs its process refreshes
+a heartbeat; a job whose heartbeat is older than JOB_STALE_AFTER seconds
+belongs to a dead process and is requeued, or failed once it has been tried
+JOB_MAX_ATTEMPTS times. The heartbeat also picks up jobs cancelled by another
+process, so their owner stops them. A worker only records an outcome while the
+job is still running under its ownership; a job cancelled or reclaimed in the
+meantime keeps its newer state.
+"""
+
+import abc
+import asyncio
+import copy
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from ..models.schemas import ChatRequest, ChatResponse
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+JobRunner = Callable[[ChatRequest, str, int], Awaitable[ChatResponse]]
+
+COLUMNS = (
+    "id", "status", "priority", "client", "request", "result", "error", "status_code",
+    "attempts", "not_before", "owner", "created_at", "started_at", "finished_at",
+    "heartbeat_at",
+)
+
+# What a worker writes back when a job leaves its hands
+OUTCOME_COLUMNS = (
+    "status", "result", "error", "status_code", "not_before", "owner", "finished_at",
+)
+
+ABANDONED = "Job abandoned: its worker stopped responding too many times"
+
+
+class Job:
+    """One queued chat request and its outcome"""
+
+    def __init__(
+        self,
+        request: str,
+        client: str,
+        priority: int = 0,
+        id: Optional[str] = None,
+        status: str = QUEUED,
+        result: Optional[str] = None,
+        error: Optional[str] = None,
+        status_code: Optional[int] = None,
+        attempts: int = 0,
+        not_before: float = 0.0,
+        owner: Optional[str] = None,
+        created_at: Optional[float] = None,
+        started_at: Optional[float] = None,
+        finished_at: Optional[float] = None,
+        heartbeat_at: Optional[float] = None,
+    ):
+        self.id = id or uuid.uuid4().hex
+        self.status = status
+        self.priority = priority
+        self.client = client
+        self.request = request  # ChatRequest JSON
+        self.result = result  # ChatResponse JSON
+        self.error = error
+        self.status_code = status_code
+        self.attempts = attempts
+        self.not_before = not_before
+        self.owner = owner
+        self.created_at = time.time() if created_at is None else created_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.heartbeat_at = heartbeat_at  # last sign of life from the owner while running
+
+    def row(self) -> tuple:
+        return tuple(getattr(self, column) for column in COLUMNS)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "status_code": self.status_code,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue(abc.ABC):
+    """Job storage; subclass for other backends"""
+
+    @abc.abstractmethod
+    async def put(self, job: Job) -> None:
+        """Add a new job"""
+
+    @abc.abstractmethod
+    async def get(self, job_id: str) -> Optional[Job]:
+        """The job with ``job_id``, if it exists"""
+
+    @abc.abstractmethod
+    async def claim(self, owner: str) -> Optional[Job]:
+        """Atomically mark the next runnable job as running for ``owner``"""
+
+    @abc.abstractmethod
+    async def save(self, job: Job, owner: str) -> bool:
+        """
+        Store the outcome of a job ``owner`` has been running.
+
+        Returns False, storing nothing, when the job is no longer running under
+        ``owner`` (cancelled elsewhere, or reclaimed as stale by another process).
+        """
+
+    @abc.abstractmethod
+    async def cancel(self, job_id: str, running: bool = False) -> Optional[Job]:
+        """
+        Cancel a queued job, and with ``running`` a running one too.
+
+        Otherwise running jobs are returned unchanged for the local worker to stop.
+        """
+
+    @abc.abstractmethod
+    async def requeue(
+        self,
+        owner: Optional[str] = None,
+        stale_before: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+    ) -> int:
+        """
+        Put running jobs of ``owner``, or last heard of before a time, back in the queue.
+
+        Stale jobs already tried ``max_attempts`` times are failed instead, so a
+        job that keeps killing its worker does not come back forever. Returns
+        how many jobs were requeued or failed.
+        """
+
+    @abc.abstractmethod
+    async def heartbeat(self, owner: str, job_ids: List[str]) -> List[str]:
+        """Refresh ``owner``'s running jobs; returns those of ``job_ids`` cancelled elsewhere"""
+
+    @abc.abstractmethod
+    async def prune(self, finished_before: float) -> int:
+        """Delete jobs finished before a time; returns how many"""
+
+    @abc.abstractmethod
+    async def counts(self) -> Dict[str, int]:
+        """Number of jobs per status"""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryJobQueue(JobQueue):
+    """In-process queue; jobs are lost on restart"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+
+    async def put(self, job: Job) -> None:
+        self._jobs[job.id] = job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def claim(self, owner: str) -> Optional[Job]:
+        now = time.time()
+        runnable = [j for j in self._jobs.values() if j.status == QUEUED and j.not_before <= now]
+        if not runnable:
+            return None
+        job = min(runnable, key=lambda j: (-j.priority, j.created_at))
+        job.status, job.owner, job.started_at, job.heartbeat_at = RUNNING, owner, now, now
+        job.attempts += 1
+        # The worker's copy, so cancels and reclaims here are not overwritten in place
+        return copy.copy(job)
+
+    async def save(self, job: Job, owner: str) -> bool:
+        stored = self._jobs.get(job.id)
+        if stored is None or stored.status != RUNNING or stored.owner != owner:
+            return False
+        self._jobs[job.id] = job
+        return True
+
+    async def cancel(self, job_id: str, running: bool = False) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is not None and (job.status == QUEUED or (running and job.status == RUNNING)):
+            job.status, job.finished_at = CANCELLED, time.time()
+        return job
+
+    async def requeue(
+        self,
+        owner: Optional[str] = None,
+        stale_before: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+    ) -> int:
+        requeued = 0
+        for job in self._jobs.values():
+            if job.status != RUNNING:
+                continue
+            stale = (
+                stale_before is not None and (job.heartbeat_at or job.started_at) < stale_before
+            )
+            if stale and max_attempts is not None and job.attempts >= max_attempts:
+                job.status, job.owner, job.finished_at = FAILED, None, time.time()
+                job.error, job.status_code = ABANDONED, 500
+                requeued += 1
+            elif stale or (owner is not None and job.owner == owner):
+                job.status, job.owner = QUEUED, None
+                requeued += 1
+        return requeued
+
+    async def heartbeat(self, owner: str, job_ids: List[str]) -> List[str]:
+        now = time.time()
+        cancelled = []
+        for job_id in job_ids:
+            job = self._jobs.get(job_id)
+            if job is None or job.owner != owner:
+                continue
+            if job.status == RUNNING:
+                job.heartbeat_at = now
+            elif job.status == CANCELLED:
+                cancelled.append(job_id)
+        return cancelled
+
+    async def prune(self, finished_before: float) -> int:
+        stale = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status in FINISHED and job.finished_at < finished_before
+        ]
+        for job_id in stale:
+            del self._jobs[job_id]
+        return len(stale)
+
+    async def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+
+class SQLiteJobQueue(JobQueue):
+    """Jobs in a SQLite file; survives restarts and is shared by workers on the host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, "
+                "client TEXT NOT NULL, request TEXT NOT NULL, result TEXT, error TEXT, "
+                "status_code INTEGER, attempts INTEGER NOT NULL, not_before REAL NOT NULL, "
+                "owner TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, "
+                "heartbeat_at REAL)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat_at" not in columns:
+                # Files created before heartbeats were recorded
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, priority, created_at)"
+            )
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def _get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return Job(**dict(zip(COLUMNS, row))) if row else None
+
+    def _claim(self, owner: str) -> Optional[Job]:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM jobs "
+                    "WHERE status = ? AND not_before <= ? "
+                    "ORDER BY priority DESC, created_at LIMIT 1",
+                    (QUEUED, now),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job = Job(**dict(zip(COLUMNS, row)))
+                job.status, job.owner, job.started_at, job.heartbeat_at = RUNNING, owner, now, now
+                job.attempts += 1
+                conn.execute(
+                    "UPDATE jobs SET status = ?, owner = ?, started_at = ?, heartbeat_at = ?, "
+                    "attempts = ? WHERE id = ?",
+                    (job.status, owner, now, now, job.attempts, job.id),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def _put(self, job: Job) -> None:
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        self._execute(
+            f"INSERT INTO jobs ({', '.join(COLUMNS)}) VALUES ({placeholders})", job.row()
+        )
+
+    def _save(self, job: Job, owner: str) -> bool:
+        return self._execute(
+            f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in OUTCOME_COLUMNS)} "
+            "WHERE id = ? AND owner = ? AND status = ?",
+            (*(getattr(job, column) for column in OUTCOME_COLUMNS), job.id, owner, RUNNING),
+        ).rowcount > 0
+
+    def _cancel(self, job_id: str, running: bool) -> Optional[Job]:
+        self._execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+            (CANCELLED, time.time(), job_id, QUEUED, RUNNING if running else QUEUED),
+        )
+        return self._get(job_id)
+
+    def _requeue(
+        self, owner: Optional[str], stale_before: Optional[float], max_attempts: Optional[int]
+    ) -> int:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                failed = 0
+                if stale_before is not None and max_attempts is not None:
+                    failed = conn.execute(
+                        "UPDATE jobs SET status = ?, owner = NULL, error = ?, status_code = 500, "
+                        "finished_at = ? WHERE status = ? "
+                        "AND COALESCE(heartbeat_at, started_at) < ? AND attempts >= ?",
+                        (FAILED, ABANDONED, time.time(), RUNNING, stale_before, max_attempts),
+                    ).rowcount
+                requeued = conn.execute(
+                    "UPDATE jobs SET status = ?, owner = NULL "
+                    "WHERE status = ? AND (owner = ? OR COALESCE(heartbeat_at, started_at) < ?)",
+                    (QUEUED, RUNNING, owner, stale_before),
+                ).rowcount
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return failed + requeued
+
+    def _heartbeat(self, owner: str, job_ids: List[str]) -> List[str]:
+        placeholders = ", ".join("?" for _ in job_ids)
+        self._execute(
+            f"UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = ? "
+            f"AND id IN ({placeholders})",
+            (time.time(), owner, RUNNING, *job_ids),
+        )
+        rows = self._execute(
+            f"SELECT id FROM jobs WHERE owner = ? AND status = ? AND id IN ({placeholders})",
+            (owner, CANCELLED, *job_ids),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _prune(self, finished_before: float) -> int:
+        return self._execute(
+            f"DELETE FROM jobs WHERE status IN ({', '.join('?' for _ in FINISHED)}) "
+            "AND finished_at < ?",
+            (*FINISHED, finished_before),
+        ).rowcount
+
+    def _counts(self) -> Dict[str, int]:
+        rows = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    async def put(self, job: Job) -> None:
+        await asyncio.to_thread(self._put, job)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    async def claim(self, owner: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._claim, owner)
+
+    async def save(self, job: Job, owner: str) -> bool:
+        return await asyncio.to_thread(self._save, job, owner)
+
+    async def cancel(self, job_id: str, running: bool = False) -> Optional[Job]:
+        return await asyncio.to_thread(self._cancel, job_id, running)
+
+    async def requeue(
+        self,
+        owner: Optional[str] = None,
+        stale_before: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+    ) -> int:
+        return await asyncio.to_thread(self._requeue, owner, stale_before, max_attempts)
+
+    async def heartbeat(self, owner: str, job_ids: List[str]) -> List[str]:
+        if not job_ids:
+            return []
+        return await asyncio.to_thread(self._heartbeat, owner, job_ids)
+
+    async def prune(self, finished_before: float) -> int:
+        return await asyncio.to_thread(self._prune, finished_before)
+
+    async def counts(self) -> Dict[str, int]:
+        return await asyncio.to_thread(self._counts)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_queue() -> JobQueue:
+    """Build the queue selected by JOB_QUEUE_STORE"""
+    if settings.JOB_QUEUE_STORE == "sqlite":
+        return SQLiteJobQueue(settings.JOB_QUEUE_SQLITE_PATH)
+    return MemoryJobQueue()
+
+
+class JobManager:
+    """Worker pool draining a JobQueue"""
+
+    def __init__(
+        self,
+        queue: Optional[JobQueue] = None,
+        workers: Optional[int] = None,
+        poll_interval: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        retention: Optional[float] = None,
+        stale_after: Optional[float] = None,
+    ):
+        self.queue = queue or create_queue()
+        self.workers = settings.JOB_WORKERS if workers is None else workers
+        self.poll_interval = settings.JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.max_attempts = settings.JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.retention = settings.JOB_RETENTION if retention is None else retention
+        self.stale_after = settings.JOB_STALE_AFTER if stale_after is None else stale_after
+        # Several heartbeats per stale period, so a live job is never taken for dead
+        self.heartbeat_interval = min(self.stale_after / 3, 30.0)
+        self.owner = uuid.uuid4().hex
+        self.run: Optional[JobRunner] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._cancelling: set = set()
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._maintained_at = 0.0
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def submit(self, request: ChatRequest, client: str, priority: int = 0) -> Job:
+        job = Job(request.model_dump_json(), client, priority)
+        await self.queue.put(job)
+        self.submitted += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await self.queue.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """The job once finished, or as it stands after ``timeout`` seconds"""
+        job = await self.queue.get(job_id)
+        if job is None or job.status in FINISHED or timeout <= 0:
+            return job
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        deadline = time.monotonic() + timeout
+        try:
+            # Re-read at the poll interval too: another process may finish the job
+            while job is not None and job.status not in FINISHED:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+                job = await self.queue.get(job_id)
+        finally:
+            # Jobs finished elsewhere, or never, would otherwise leave their event behind
+            self._forget_event(job_id, event)
+        return job
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        task = self._running.get(job_id)
+        # A job running in another process is marked cancelled; its owner's
+        # heartbeat notices and stops it
+        job = await self.queue.cancel(job_id, running=task is None)
+        if job is not None and job.status == RUNNING and task is not None:
+            finished = self._finished.setdefault(job_id, asyncio.Event())
+            self._cancelling.add(job_id)
+            task.cancel()
+            # The worker records the cancellation; wait for it so the reply is final
+            try:
+                await asyncio.wait_for(finished.wait(), 5.0)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._forget_event(job_id, finished)
+            job = await self.queue.get(job_id)
+        return job
+
+    def _notify(self, job: Job) -> None:
+        event = self._finished.pop(job.id, None)
+        if event is not None:
+            event.set()
+
+    def _forget_event(self, job_id: str, event: asyncio.Event) -> None:
+        # Other waiters may still hold it; they fall back to polling
+        if self._finished.get(job_id) is event:
+            del self._finished[job_id]
+
+    async def _execute(self, job: Job) -> None:
+        request = ChatRequest.model_validate_json(job.request)
+        task = asyncio.create_task(self.run(request, job.client, job.priority))
+        self._running[job.id] = task
+        try:
+            response = await task
+        except asyncio.CancelledError:
+            if job.id not in self._cancelling:
+                raise  # shutting down; requeued by stop()
+            self._cancelling.discard(job.id)
+            job.status = CANCELLED
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None and job.attempts < self.max_attempts:
+                # Transient rejection: back to the queue until Retry-After has passed
+                job.status, job.owner = QUEUED, None
+                job.not_before = time.time() + float(retry_after)
+            else:
+                job.status = FAILED
+                job.error = getattr(e, "detail", None) or str(e) or type(e).__name__
+                job.status_code = getattr(e, "status_code", 500)
+        else:
+            job.status = SUCCEEDED
+            job.result = response.model_dump_json()
+            job.status_code = 200
+        finally:
+            self._running.pop(job.id, None)
+
+        if job.status in FINISHED:
+            job.finished_at = time.time()
+        if not await self.queue.save(job, self.owner):
+            # Cancelled or reclaimed meanwhile; the newer state stands
+            logger.info("[Jobs] Job %s was taken over; dropping its %s outcome", job.id, job.status)
+            self._notify(job)
+            return
+        if job.status == SUCCEEDED:
+            self.succeeded += 1
+        elif job.status == FAILED:
+            self.failed += 1
+        elif job.status == QUEUED:
+            self.retried += 1
+        if job.status in FINISHED:
+            self._notify(job)
+
+    async def _maintain(self) -> None:
+        now = time.time()
+        if now - self._maintained_at < max(self.poll_interval, 30.0):
+            return
+        self._maintained_at = now
+        recovered = await self.queue.requeue(
+            stale_before=now - self.stale_after, max_attempts=self.max_attempts
+        )
+        if recovered:
+            logger.warning("[Jobs] Recovered %s jobs abandoned by a dead worker", recovered)
+        await self.queue.prune(now - self.retention)
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                await self._maintain()
+                job = await self.queue.claim(self.owner)
+            except Exception:
+                logger.exception("[Jobs] Queue access failed")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("[Jobs] Job %s could not be recorded", job.id)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                cancelled = await self.queue.heartbeat(self.owner, list(self._running))
+            except Exception:
+                logger.exception("[Jobs] Heartbeat failed")
+                continue
+            for job_id in cancelled:
+                task = self._running.get(job_id)
+                if task is not None:
+                    self._cancelling.add(job_id)
+                    task.cancel()
+
+    def start(self, run: JobRunner) -> None:
+        if self._tasks or self.workers <= 0:
+            return
+        self.run = run
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # Separate from the workers, which may all be busy with long jobs
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._running.values(), return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+        # Interrupted jobs go back to the queue for the next start
+        await self.queue.requeue(owner=self.owner)
+
+    async def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": len(self._running),
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "queue": await self.queue.counts(),
+        }
+
+    def close(self) -> None:
+        self.queue.close()
+
+
+# Process-wide job manager; workers are started in the app lifespan
+job_manager = JobManager()
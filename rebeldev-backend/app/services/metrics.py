@@ -0,0 +1,336 @@
+"""
+Prometheus metrics.
+
+A small in-process registry of counters, gauges and histograms, rendered in
+the Prometheus text format by ``GET /metrics``. Recording is a dict lookup and
+a bisect, so instrumenting the hot path costs next to nothing. Values that
+other components already track (open streams, connection pool usage) are read
+by collectors at scrape time instead of being mirrored on every change.
+
+The upstream metrics split a slow reply into its parts: admission queue time,
+time to first token, tokens per second and, for Ollama, the model's own load,
+prompt evaluation and generation times.
+
+Model names come from clients, so only models listed in the model catalog get
+their own label; anything else is recorded as "other".
+"""
+
+import abc
+import asyncio
+import bisect
+import math
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from ..config import settings
+from ..utils import logging as log_setup
+from .streams import stream_monitor
+from .transport import http_transport
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TTFT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+QUEUE_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+
+# Rejection exceptions by class name; the modules raising them record here
+REJECTION_CLASSES = {
+    "SchedulerRejected": "rejected",
+    "QuotaExceeded": "quota",
+    "ProviderUnavailable": "breaker_open",
+}
+STATUS_PATTERN = re.compile(r"API error:? (\d{3})")
+# Label for models the catalog does not list
+OTHER_MODEL = "other"
+
+
+def error_class(error: BaseException) -> str:
+    """Coarse, low-cardinality class of an upstream or admission error"""
+    # Services wrap the original error; the cause says more than the wrapper.
+    # A wrapper raised without "from" still carries the original as its context.
+    current: Optional[BaseException] = error
+    while current is not None:
+        name = REJECTION_CLASSES.get(type(current).__name__)
+        if name is not None:
+            return name
+        if isinstance(current, asyncio.TimeoutError):
+            phase = getattr(current, "phase", None)
+            return f"timeout_{phase}" if phase else "timeout"
+        if isinstance(current, aiohttp.ClientConnectionError):
+            return "connection"
+        status = getattr(current, "status", None) or getattr(current, "status_code", None)
+        if status is None:
+            match = STATUS_PATTERN.search(str(current))
+            status = int(match.group(1)) if match else None
+        if isinstance(status, int):
+            return f"upstream_{status // 100}xx"
+        current = current.__cause__ or (
+            None if current.__suppress_context__ else current.__context__
+        )
+    return "error"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[Sample]:
+        """``(name, labels, value)`` for every series of this metric"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, counts in self.values.items():
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**base, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", base, counts[-1]
+            yield f"{self.name}_count", base, cumulative
+
+
+class MetricsRegistry:
+    """Named metrics plus collectors sampled at scrape time"""
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = settings.METRICS_ENABLED if enabled is None else enabled
+        self.metrics: Dict[str, _Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+        # Whether the catalog lists a provider's model; set by the catalog's owner
+        self.listed: Optional[Callable[[str, str], bool]] = None
+
+    def model_label(self, provider: str, model: str) -> str:
+        """``model`` if the catalog lists it, else "other", so clients cannot add series"""
+        if self.listed is None or self.listed(provider, model):
+            return model
+        return OTHER_MODEL
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, collect: Callable[[], None]) -> None:
+        """Run ``collect`` before every scrape to refresh gauges from live state"""
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+
+upstream_latency = metrics.histogram(
+    "llm_request_duration_seconds",
+    "Upstream completion time, from request to last token",
+    ("provider", "model", "mode"),
+)
+time_to_first_token = metrics.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from upstream request to the first streamed token",
+    ("provider", "model"),
+    TTFT_BUCKETS,
+)
+tokens_per_second = metrics.histogram(
+    "llm_tokens_per_second",
+    "Completion tokens per second as seen by the proxy",
+    ("provider", "model"),
+    RATE_BUCKETS,
+)
+queue_time = metrics.histogram(
+    "llm_queue_wait_seconds",
+    "Time spent waiting for admission to a provider/model",
+    ("provider", "model"),
+    QUEUE_BUCKETS,
+)
+upstream_errors = metrics.counter(
+    "llm_errors_total",
+    "Failed upstream calls and admission rejections by error class",
+    ("provider", "model", "error"),
+)
+ollama_duration = metrics.histogram(
+    "ollama_duration_seconds",
+    "Ollama's own timing of a completion: load, prompt_eval, eval and total",
+    ("model", "phase"),
+)
+ollama_tokens = metrics.counter(
+    "ollama_tokens_total",
+    "Tokens evaluated by Ollama: prompt or generated (eval)",
+    ("model", "kind"),
+)
+active_streams = metrics.gauge("llm_active_streams", "Streams currently open to clients")
+streams_total = metrics.counter(
+    "llm_streams_total", "Finished client streams by outcome", ("outcome",)
+)
+pool_connections = metrics.gauge(
+    "http_pool_connections", "Upstream HTTP pool connections by state", ("state",)
+)
+log_records_dropped = metrics.counter(
+    "log_records_dropped_total",
+    "Log records not written: queue_full, sampled or rate_limited",
+    ("reason",),
+)
+
+
+def collect_live_state() -> None:
+    active_streams.set(value=stream_monitor.active)
+    # The stream monitor already counts outcomes; mirror its totals
+    streams_total.values[("completed",)] = stream_monitor.completed
+    streams_total.values[("failed",)] = stream_monitor.failed
+    streams_total.values[("disconnected",)] = stream_monitor.disconnected
+    pool = http_transport.stats()
+    pool_connections.set("limit", value=pool["limit"])
+    pool_connections.set("acquired", value=pool.get("acquired", 0))
+    pool_connections.set("idle", value=pool.get("idle", 0))
+    if log_setup.log_pipeline is not None:
+        logs = log_setup.log_pipeline.stats()
+        log_records_dropped.values[("queue_full",)] = logs["dropped"]
+        log_records_dropped.values[("sampled",)] = logs["sampled_out"]
+        log_records_dropped.values[("rate_limited",)] = logs["suppressed"]
+
+
+metrics.collector(collect_live_state)
+
+OLLAMA_PHASES = (
+    ("load", "load_duration"),
+    ("prompt_eval", "prompt_eval_duration"),
+    ("eval", "eval_duration"),
+    ("total", "total_duration"),
+)
+
+
+def record_ollama(model: str, data: dict) -> None:
+    """Record the timings and token counts of an Ollama done record"""
+    if not metrics.enabled or not data:
+        return
+    model = metrics.model_label("ollama", model)
+    for phase, field in OLLAMA_PHASES:
+        nanoseconds = data.get(field)
+        if nanoseconds:
+            ollama_duration.observe(nanoseconds / 1e9, model, phase)
+    for kind, field in (("prompt", "prompt_eval_count"), ("eval", "eval_count")):
+        if data.get(field):
+            ollama_tokens.inc(model, kind, amount=data[field])
+
+
+def record_completion(
+    provider: str, model: str, mode: str, seconds: float, tokens: int, generating: float
+) -> None:
+    """Record one finished upstream completion; ``generating`` is the time spent producing tokens"""
+    if not metrics.enabled:
+        return
+    model = metrics.model_label(provider, model)
+    upstream_latency.observe(seconds, provider, model, mode)
+    if tokens and generating > 0:
+        tokens_per_second.observe(tokens / generating, provider, model)
+
+
+def record_first_token(provider: str, model: str, seconds: float) -> None:
+    if metrics.enabled:
+        time_to_first_token.observe(seconds, provider, metrics.model_label(provider, model))
+
+
+def record_queue_time(provider: str, model: str, seconds: float) -> None:
+    if metrics.enabled:
+        queue_time.observe(seconds, provider, metrics.model_label(provider, model))
+
+
+def record_error(provider: str, model: str, error: BaseException) -> None:
+    if metrics.enabled:
+        upstream_errors.inc(provider, metrics.model_label(provider, model), error_class(error))
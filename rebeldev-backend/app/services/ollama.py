@@ -4,125 +4,292 @@ Ollama service for handling requests to local Ollama instances
 
 import aiohttp
 import asyncio
+import hashlib
 import json
 import logging
+from collections import OrderedDict
+from contextlib import aclosing
 from datetime import datetime
-from typing import List, AsyncGenerator, Optional
+from typing import List, AsyncGenerator, Callable, Optional, Tuple
 
-from ..models.schemas import ChatRequest, ChatResponse, StreamChunk, ModelInfo
+from ..models.schemas import ChatMessage, ChatRequest, ChatResponse, StreamChunk, ModelInfo, Role
 from ..config import settings
+from .transport import HTTPTransport, http_transport
+from .ollama_pool import OllamaNode, OllamaNodePool, model_name
+from .conversations import chat_message, render_history
+from .metrics import record_ollama
+from .residency import ModelResidency
+from .timeouts import timeout_policy
+from .tracing import traced
 
 logger = logging.getLogger(__name__)
 
 
+class OllamaAPIError(Exception):
+    """Non-200 response from an Ollama node"""
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"Ollama API error {status}: {text}")
+        self.status = status
+
+
+# Bytes of stream tail kept by the passthrough relay to find the done record
+PASSTHROUGH_TAIL_BYTES = 64 * 1024
+
+# Errors after which the request is retried on the next node
+RETRIABLE_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+def is_node_failure(error: Exception) -> bool:
+    """Whether an error says something about the node rather than the request"""
+    if isinstance(error, OllamaAPIError):
+        return error.status >= 500
+    return isinstance(error, RETRIABLE_ERRORS)
+
+
+def serialize_message(role: str, content: str) -> bytes:
+    """Canonical byte form of a chat message, identical across turns"""
+    return json.dumps(
+        {"role": role, "content": content}, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def serialize_history(message: ChatMessage) -> bytes:
+    return serialize_message(Role(message.role).value, message.content)
+
+
+PROMPT_ROLES = {"user": "Human", "assistant": "Assistant", "system": "System"}
+
+
+def prompt_line(message: ChatMessage) -> str:
+    """One history message in /api/generate prompt form"""
+    role = Role(message.role).value
+    return f"{PROMPT_ROLES.get(role, role.capitalize())}: {message.content}"
+
+
+class PrefixTracker:
+    """
+    Remembers which message prefixes were recently sent to each model so the
+    share of a new prompt that Ollama can serve from its KV cache can be estimated.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+
+    @staticmethod
+    def _digests(model: str, messages: List[bytes]) -> List[str]:
+        """Rolling digests of every leading slice of ``messages``"""
+        rolling = hashlib.sha1(model.encode("utf-8"))
+        digests = []
+        for raw in messages:
+            rolling.update(raw)
+            rolling.update(b"\n")
+            digests.append(rolling.hexdigest())
+        return digests
+
+    def reuse_ratio(self, model: str, messages: List[bytes]) -> float:
+        """Fraction of prompt bytes covered by the longest previously seen prefix"""
+        total = sum(len(raw) for raw in messages)
+        if not total:
+            return 0.0
+
+        reused = 0
+        running = 0
+        for raw, digest in zip(messages, self._digests(model, messages)):
+            running += len(raw)
+            if digest in self._seen:
+                reused = running
+                self._seen.move_to_end(digest)
+        return round(reused / total, 4)
+
+    def record(self, model: str, messages: List[bytes]) -> None:
+        """Register a conversation (including the reply) as resident in the cache"""
+        for digest in self._digests(model, messages):
+            self._seen[digest] = None
+            self._seen.move_to_end(digest)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+
 class OllamaService:
     """Service for interacting with the Ollama API"""
 
-    def __init__(self, session: Optional[aiohttp.ClientSession] = None):
-        self.base_url = settings.OLLAMA_BASE_URL
-        self.timeout = settings.OLLAMA_TIMEOUT
-        self.session = session or aiohttp.ClientSession()
-
-    async def close(self):
-        """Gracefully close aiohttp session"""
-        if not self.session.closed:
-            await self.session.close()
+    def __init__(
+        self,
+        transport: Optional[HTTPTransport] = None,
+        nodes: Optional[OllamaNodePool] = None,
+    ):
+        self.api_mode = settings.OLLAMA_API_MODE
+        self.prefix_tracker = PrefixTracker(settings.OLLAMA_PREFIX_CACHE_SIZE)
+        self.transport = transport or http_transport
+        self.nodes = nodes or OllamaNodePool(transport=self.transport)
+        self.residency = ModelResidency(self.nodes)
+        self.max_attempts = settings.OLLAMA_MAX_ATTEMPTS
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled session from the shared transport"""
+        return self.transport.session
+
+    @property
+    def base_url(self) -> str:
+        """URL of the node currently preferred for general requests"""
+        return self.nodes.candidates("")[0].url
+
+    def start(self) -> None:
+        """Start background probing of the Ollama nodes and model warm-up"""
+        self.nodes.start()
+        self.residency.start()
+
+    async def close(self) -> None:
+        await self.residency.stop()
+        await self.nodes.stop()
 
     async def health_check(self) -> bool:
-        """Check if Ollama API is reachable"""
+        """Check if any Ollama node is reachable"""
         try:
-            async with self.session.get(
-                f"{self.base_url}/api/tags",
-                timeout=aiohttp.ClientTimeout(total=5)
-            ) as response:
-                return response.status == 200
+            return any(await self.nodes.probe_all())
         except Exception as e:
-            logger.warning(f"Ollama health check failed: {e}")
+            logger.warning("Ollama health check failed: %s", e)
             return False
 
     async def get_models(self) -> List[ModelInfo]:
-        """Fetch list of models from Ollama"""
+        """Fetch the models pulled on any healthy Ollama node"""
         try:
-            async with self.session.get(
-                f"{self.base_url}/api/tags",
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API error {response.status}: {error_text}")
-
-                data = await response.json()
-                models = []
-
-                for model_data in data.get("models", []):
-                    models.append(
-                        ModelInfo(
-                            name=model_data["name"],
-                            provider="ollama",
-                            size=model_data.get("size"),
-                            modified_at=(
-                                datetime.fromisoformat(
-                                    model_data["modified_at"].replace("Z", "+00:00")
-                                )
-                                if model_data.get("modified_at")
-                                else None
-                            ),
-                            description=f"Ollama model: {model_data['name']}",
-                        )
+            # Nodes may have different models pulled; the catalog is their union
+            nodes = [node for node in self.nodes.nodes if node.healthy] or self.nodes.nodes
+            results = await asyncio.gather(
+                *(self._get_tags(node) for node in nodes), return_exceptions=True
+            )
+            listings = []
+            last_error: Optional[Exception] = None
+            for node, result in zip(nodes, results):
+                if not isinstance(result, BaseException):
+                    listings.append(result)
+                    continue
+                if not isinstance(result, Exception) or not is_node_failure(result):
+                    raise result
+                self.nodes.record_failure(node)
+                last_error = result
+            if not listings:
+                raise last_error or Exception("No Ollama nodes configured")
+
+            models = []
+            seen = set()
+
+            for model_data in (m for data in listings for m in data.get("models", [])):
+                if model_data["name"] in seen:
+                    continue
+                seen.add(model_data["name"])
+                models.append(
+                    ModelInfo(
+                        name=model_data["name"],
+                        provider="ollama",
+                        size=model_data.get("size"),
+                        modified_at=(
+                            datetime.fromisoformat(
+                                model_data["modified_at"].replace("Z", "+00:00")
+                            )
+                            if model_data.get("modified_at")
+                            else None
+                        ),
+                        description=f"Ollama model: {model_data['name']}",
                     )
+                )
 
-                return models
+            return models
 
         except Exception as e:
             logger.exception("Failed to fetch Ollama models")
             raise Exception(f"Failed to fetch Ollama models: {str(e)}") from e
 
+    async def _get_tags(self, node: OllamaNode) -> dict:
+        async with self.session.get(
+            f"{node.url}/api/tags",
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise OllamaAPIError(response.status, error_text)
+            data = await response.json()
+            node.available_models = {model_name(m["name"]) for m in data.get("models", [])}
+            return data
+
+    async def _post(self, node: OllamaNode, endpoint: str, payload: dict) -> dict:
+        async with self.session.post(
+            f"{node.url}{endpoint}",
+            json=payload,
+            timeout=timeout_policy("ollama", payload["model"]).client_timeout(),
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise OllamaAPIError(response.status, error_text)
+            return await response.json()
+
     async def chat_completion(self, request: ChatRequest) -> ChatResponse:
         """Perform a non-streaming chat completion using Ollama"""
         try:
-            logger.info(f"[Ollama] Requesting non-streamed completion for model '{request.model}'")
-
-            prompt = self.build_prompt(request)
-            payload = {
-                "model": request.model,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": request.temperature or 0.7,
-                },
+            logger.info(
+                "[Ollama] Requesting non-streamed completion for model '%s'",
+                request.model,
+                extra={"category": "request"},
+            )
+
+            endpoint, payload, serialized = self.build_payload(request, stream=False)
+            reuse_ratio = self.prefix_tracker.reuse_ratio(request.model, serialized)
+
+            last_error: Optional[Exception] = None
+            for node in self.nodes.candidates(request.model)[: self.max_attempts]:
+                self.nodes.acquire(node)
+                try:
+                    data = await self._post(node, endpoint, payload)
+                except Exception as e:
+                    if not is_node_failure(e):
+                        raise
+                    logger.warning("[Ollama] Node %s failed, trying next: %s", node.url, e)
+                    self.nodes.record_failure(node)
+                    last_error = e
+                    continue
+                finally:
+                    self.nodes.release(node)
+
+                self.nodes.record_success(node, request.model)
+                break
+            else:
+                raise last_error or Exception("No Ollama nodes configured")
+
+            content = self.extract_content(data)
+            self.residency.record(request.model, data)
+            record_ollama(request.model, data)
+            self.prefix_tracker.record(
+                request.model, serialized + [serialize_message("assistant", content)]
+            )
+
+            metadata = {
+                "done": data.get("done", False),
+                "api_mode": self.api_mode,
+                "node": node.url,
+                "prefix_reuse_ratio": reuse_ratio,
+                "total_duration": data.get("total_duration"),
+                "load_duration": data.get("load_duration"),
+                "prompt_eval_duration": data.get("prompt_eval_duration"),
+                "eval_duration": data.get("eval_duration"),
             }
-
-            if request.max_tokens:
-                payload["options"]["num_predict"] = request.max_tokens
-
-            async with self.session.post(
-                f"{self.base_url}/api/generate",
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=self.timeout),
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API error {response.status}: {error_text}")
-
-                data = await response.json()
-
-                return ChatResponse(
-                    message=data.get("response", ""),
-                    model=request.model,
-                    provider="ollama",
-                    usage={
-                        "prompt_tokens": data.get("prompt_eval_count", 0),
-                        "completion_tokens": data.get("eval_count", 0),
-                        "total_tokens": data.get("prompt_eval_count", 0) + data.get("eval_count", 0),
-                    },
-                    metadata={
-                        "done": data.get("done", False),
-                        "total_duration": data.get("total_duration"),
-                        "load_duration": data.get("load_duration"),
-                        "prompt_eval_duration": data.get("prompt_eval_duration"),
-                        "eval_duration": data.get("eval_duration"),
-                    },
-                )
+            if data.get("context") is not None:
+                metadata["context"] = data["context"]
+
+            return ChatResponse(
+                message=content,
+                model=request.model,
+                provider="ollama",
+                usage={
+                    "prompt_tokens": data.get("prompt_eval_count", 0),
+                    "completion_tokens": data.get("eval_count", 0),
+                    "total_tokens": data.get("prompt_eval_count", 0) + data.get("eval_count", 0),
+                },
+                metadata=metadata,
+            )
 
         except Exception as e:
             logger.exception("Ollama chat completion failed")
@@ -133,57 +300,271 @@ class OllamaService:
     ) -> AsyncGenerator[StreamChunk, None]:
         """Perform a streaming chat completion using Ollama"""
         try:
-            logger.info(f"[Ollama] Requesting streamed completion for model '{request.model}'")
+            logger.info(
+                "[Ollama] Requesting streamed completion for model '%s'",
+                request.model,
+                extra={"category": "request"},
+            )
+
+            endpoint, payload, serialized = self.build_payload(request, stream=True)
+            reuse_ratio = self.prefix_tracker.reuse_ratio(request.model, serialized)
+
+            last_error: Optional[Exception] = None
+            for node in self.nodes.candidates(request.model)[: self.max_attempts]:
+                started = False
+                self.nodes.acquire(node)
+                try:
+                    # aclosing: abort the upstream request as soon as our consumer goes away
+                    async with aclosing(self._stream_from(
+                        node, endpoint, payload, request, serialized, reuse_ratio
+                    )) as chunks:
+                        async for chunk in chunks:
+                            started = True
+                            yield chunk
+                    self.nodes.record_success(node, request.model)
+                    return
+                except Exception as e:
+                    # Only fail over while nothing has been sent to the client
+                    if started or not is_node_failure(e):
+                        raise
+                    logger.warning("[Ollama] Node %s failed, trying next: %s", node.url, e)
+                    self.nodes.record_failure(node)
+                    last_error = e
+                finally:
+                    self.nodes.release(node)
+
+            raise last_error or Exception("No Ollama nodes configured")
 
-            prompt = self.build_prompt(request)
-            payload = {
-                "model": request.model,
-                "prompt": prompt,
-                "stream": True,
-                "options": {
-                    "temperature": request.temperature or 0.7,
-                },
-            }
+        except Exception as e:
+            logger.exception("Ollama streaming chat completion failed")
+            raise Exception(f"Ollama streaming failed: {str(e)}") from e
+
+    async def _stream_from(
+        self,
+        node: OllamaNode,
+        endpoint: str,
+        payload: dict,
+        request: ChatRequest,
+        serialized: List[bytes],
+        reuse_ratio: float,
+    ) -> AsyncGenerator[StreamChunk, None]:
+        produced = []
+        timer = timeout_policy("ollama", request.model).timer()
+
+        response = await timer.wait(self.session.post(
+            f"{node.url}{endpoint}",
+            json=payload,
+            timeout=timer.policy.client_timeout(),
+        ))
+        async with response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise OllamaAPIError(response.status, error_text)
+
+            while True:
+                line = await timer.chunk(response.content.readline())
+                if not line:
+                    break
+                try:
+                    line = line.decode("utf-8").strip()
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    content = self.extract_content(data)
+                    produced.append(content)
 
-            if request.max_tokens:
-                payload["options"]["num_predict"] = request.max_tokens
-
-            async with self.session.post(
-                f"{self.base_url}/api/generate",
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=self.timeout),
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"Ollama API error {response.status}: {error_text}")
-
-                async for line in response.content:
-                    try:
-                        line = line.decode("utf-8").strip()
-                        if not line:
-                            continue
-                        data = json.loads(line)
-
-                        yield StreamChunk(
-                            content=data.get("response", ""),
-                            done=data.get("done", False),
-                            metadata={
-                                "model": request.model,
-                                "eval_count": data.get("eval_count"),
-                                "eval_duration": data.get("eval_duration"),
-                            },
+                    metadata = {
+                        "model": request.model,
+                        "eval_count": data.get("eval_count"),
+                        "eval_duration": data.get("eval_duration"),
+                    }
+                    if data.get("done"):
+                        self.residency.record(request.model, data)
+                        record_ollama(request.model, data)
+                        self.prefix_tracker.record(
+                            request.model,
+                            serialized + [serialize_message("assistant", "".join(produced))],
+                        )
+                        metadata.update(
+                            api_mode=self.api_mode,
+                            node=node.url,
+                            prefix_reuse_ratio=reuse_ratio,
+                            prompt_eval_count=data.get("prompt_eval_count"),
+                            prompt_eval_duration=data.get("prompt_eval_duration"),
+                            load_duration=data.get("load_duration"),
+                            total_duration=data.get("total_duration"),
                         )
+                        if data.get("context") is not None:
+                            metadata["context"] = data["context"]
 
-                        if data.get("done"):
-                            break
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Failed to decode stream chunk: {line} — {e}")
-                        continue
+                    yield StreamChunk(
+                        content=content,
+                        done=data.get("done", False),
+                        metadata=metadata,
+                    )
+
+                    if data.get("done"):
+                        break
+                except json.JSONDecodeError as e:
+                    logger.warning("Failed to decode stream chunk: %r — %s", line, e)
+                    continue
+
+    async def passthrough_stream(
+        self,
+        request: ChatRequest,
+        on_final: Optional[Callable[[dict], None]] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Relay Ollama's NDJSON stream byte-for-byte.
+
+        Upstream chunks are forwarded as received with no per-line decoding.
+        Only the tail of the stream is kept, and once it ends the final ``done``
+        record is parsed and handed to ``on_final`` for accounting. A stream
+        without one (truncated, or a done record outside the tail) does not
+        call ``on_final``, so the caller falls back to estimating.
+        """
+        try:
+            logger.info(
+                "[Ollama] Relaying raw stream for model '%s'",
+                request.model,
+                extra={"category": "request"},
+            )
+
+            endpoint, payload, _ = self.build_payload(request, stream=True)
+
+            last_error: Optional[Exception] = None
+            for node in self.nodes.candidates(request.model)[: self.max_attempts]:
+                started = False
+                self.nodes.acquire(node)
+                try:
+                    timer = timeout_policy("ollama", request.model).timer()
+                    response = await timer.wait(self.session.post(
+                        f"{node.url}{endpoint}",
+                        json=payload,
+                        timeout=timer.policy.client_timeout(),
+                    ))
+                    async with response:
+                        if response.status != 200:
+                            error_text = await response.text()
+                            raise OllamaAPIError(response.status, error_text)
+
+                        tail: List[bytes] = []
+                        tail_size = 0
+                        while True:
+                            data = await timer.chunk(response.content.readany())
+                            if not data:
+                                break
+                            started = True
+                            tail.append(data)
+                            tail_size += len(data)
+                            while tail_size - len(tail[0]) >= PASSTHROUGH_TAIL_BYTES:
+                                tail_size -= len(tail.pop(0))
+                            yield data
+
+                    self.nodes.record_success(node, request.model)
+                    final = self.parse_final_record(b"".join(tail))
+                    # No done record: nothing trustworthy to feed residency or metrics
+                    if final:
+                        self.residency.record(request.model, final)
+                        record_ollama(request.model, final)
+                        if on_final is not None:
+                            on_final(final)
+                    return
+                except Exception as e:
+                    # Only fail over while nothing has been sent to the client
+                    if started or not is_node_failure(e):
+                        raise
+                    logger.warning("[Ollama] Node %s failed, trying next: %s", node.url, e)
+                    self.nodes.record_failure(node)
+                    last_error = e
+                finally:
+                    self.nodes.release(node)
+
+            raise last_error or Exception("No Ollama nodes configured")
 
         except Exception as e:
-            logger.exception("Ollama streaming chat completion failed")
-            raise Exception(f"Ollama streaming failed: {str(e)}") from e
+            logger.exception("Ollama passthrough stream failed")
+            raise Exception(f"Ollama passthrough failed: {str(e)}") from e
+
+    @staticmethod
+    def parse_final_record(tail: bytes) -> dict:
+        """Decode the last NDJSON record of a stream, if it is the done record"""
+        line = tail.rstrip().rsplit(b"\n", 1)[-1]
+        try:
+            record = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return {}
+        return record if isinstance(record, dict) and record.get("done") else {}
+
+    def build_payload(
+        self, request: ChatRequest, stream: bool
+    ) -> Tuple[str, dict, List[bytes]]:
+        """
+        Build the endpoint and request body for the configured API mode.
+
+        Returns the endpoint path, the JSON payload and the canonical serialized
+        messages used for prefix-reuse accounting.
+        """
+        messages = self.build_messages(request)
+        serialized = render_history(request.history, "ollama-serialized", serialize_history)
+        if request.system_prompt:
+            serialized = [serialize_message("system", request.system_prompt)] + serialized
+        serialized.append(serialize_message("user", request.message))
+        options = {"temperature": request.temperature if request.temperature is not None else 0.7}
+        if request.max_tokens:
+            options["num_predict"] = request.max_tokens
+
+        keep_alive = self.residency.keep_alive(request.model)
 
+        if self.api_mode == "chat":
+            return "/api/chat", {
+                "model": request.model,
+                "messages": messages,
+                "stream": stream,
+                "options": options,
+                "keep_alive": keep_alive,
+            }, serialized
+
+        payload = {
+            "model": request.model,
+            "stream": stream,
+            "options": options,
+            "keep_alive": keep_alive,
+        }
+        if request.context:
+            # The context already encodes every earlier turn; send only the new one
+            payload["context"] = request.context
+            payload["prompt"] = f"Human: {request.message}\n\nAssistant:"
+        else:
+            payload["prompt"] = self.build_prompt(request)
+        return "/api/generate", payload, serialized
+
+    @staticmethod
+    def extract_content(data: dict) -> str:
+        """Pull generated text out of an /api/chat or /api/generate record"""
+        if "message" in data:
+            return (data.get("message") or {}).get("content", "")
+        return data.get("response", "")
+
+    @traced("ollama.build_messages")
+    def build_messages(self, request: ChatRequest) -> List[dict]:
+        """
+        Build Ollama /api/chat messages.
+
+        Only role and content are forwarded (no timestamps), in a fixed order, so
+        the leading messages are byte-identical from one turn to the next.
+        """
+        messages = []
+
+        if request.system_prompt:
+            messages.append({"role": "system", "content": request.system_prompt})
+
+        messages.extend(render_history(request.history, "chat", chat_message))
+
+        messages.append({"role": "user", "content": request.message})
+        return messages
+
+    @traced("ollama.build_prompt")
     def build_prompt(self, request: ChatRequest) -> str:
         """Constructs a prompt string based on chat history and the current message."""
         parts = []
@@ -191,14 +572,7 @@ class OllamaService:
         if request.system_prompt:
             parts.append(f"System: {request.system_prompt}")
 
-        for msg in request.history:
-            role_map = {
-                "user": "Human",
-                "assistant": "Assistant",
-                "system": "System"
-            }
-            role_label = role_map.get(msg.role, msg.role.capitalize())
-            parts.append(f"{role_label}: {msg.content}")
+        parts.extend(render_history(request.history, "ollama-prompt", prompt_line))
 
         parts.append(f"Human: {request.message}")
         parts.append("Assistant:")
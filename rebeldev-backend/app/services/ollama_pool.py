@@ -0,0 +1,205 @@
+"""
+Pool of Ollama nodes with model-affinity routing.
+
+Requests are routed to healthy nodes that already have the model loaded
+(learned from ``/api/ps`` and from recent traffic), then to nodes that have
+the model pulled, and finally to the least busy healthy node. Nodes that keep
+failing are ejected for a while and re-admitted by a background prober.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+
+from ..config import settings
+from .transport import HTTPTransport, http_transport
+
+logger = logging.getLogger(__name__)
+
+
+def model_name(name: str) -> str:
+    """Ollama's implicit tag: ``llama3.2`` and ``llama3.2:latest`` are one model"""
+    return name.removesuffix(":latest")
+
+
+class OllamaNode:
+    """One Ollama endpoint and what is known about it"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.loaded_models: Set[str] = set()
+        self.available_models: Set[str] = set()
+        # When each model last succeeded here, so probes keep what traffic learned
+        self.served: Dict[str, float] = {}
+        self.last_probe: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "loaded_models": sorted(self.loaded_models),
+            "available_models": sorted(self.available_models),
+        }
+
+
+class OllamaNodePool:
+    """Load balancing, passive ejection and active re-probing across nodes"""
+
+    def __init__(
+        self,
+        urls: Optional[List[str]] = None,
+        transport: Optional[HTTPTransport] = None,
+        max_failures: Optional[int] = None,
+        eject_seconds: Optional[float] = None,
+        probe_interval: Optional[float] = None,
+    ):
+        urls = urls or settings.OLLAMA_BASE_URLS or [settings.OLLAMA_BASE_URL]
+        self.nodes = [OllamaNode(url) for url in urls]
+        self.transport = transport or http_transport
+        self.max_failures = (
+            settings.OLLAMA_NODE_MAX_FAILURES if max_failures is None else max_failures
+        )
+        self.eject_seconds = (
+            settings.OLLAMA_NODE_EJECT_SECONDS if eject_seconds is None else eject_seconds
+        )
+        self.probe_interval = (
+            settings.OLLAMA_PROBE_INTERVAL if probe_interval is None else probe_interval
+        )
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def candidates(self, model: str) -> List[OllamaNode]:
+        """
+        Nodes in the order they should be tried for ``model``.
+
+        Healthy nodes come first, ranked by affinity (model loaded, then model
+        pulled) and then by outstanding requests. Ejected nodes are appended
+        last so a fully ejected pool still fails open.
+        """
+        model = model_name(model)
+
+        def rank(node: OllamaNode):
+            return (
+                not node.healthy,
+                model not in node.loaded_models,
+                bool(node.available_models) and model not in node.available_models,
+                node.outstanding,
+                node.ejected_until,
+            )
+
+        return sorted(self.nodes, key=rank)
+
+    def healthy_count(self) -> int:
+        """Nodes currently taking traffic; at least one, as the pool fails open"""
+        return max(sum(1 for node in self.nodes if node.healthy), 1)
+
+    def pick(self, model: str) -> OllamaNode:
+        return self.candidates(model)[0]
+
+    def acquire(self, node: OllamaNode) -> None:
+        node.outstanding += 1
+        node.requests += 1
+
+    def release(self, node: OllamaNode) -> None:
+        node.outstanding = max(node.outstanding - 1, 0)
+
+    def record_success(self, node: OllamaNode, model: Optional[str] = None) -> None:
+        node.consecutive_failures = 0
+        node.ejected_until = 0.0
+        if model:
+            # Ollama keeps the model loaded after serving it
+            model = model_name(model)
+            node.loaded_models.add(model)
+            node.available_models.add(model)
+            node.served[model] = time.monotonic()
+
+    def record_failure(self, node: OllamaNode) -> None:
+        node.failures += 1
+        node.consecutive_failures += 1
+        if node.consecutive_failures >= self.max_failures:
+            node.ejected_until = time.monotonic() + self.eject_seconds
+            node.loaded_models.clear()
+            logger.warning(
+                "[Ollama] Ejecting node %s for %ss after %s failures",
+                node.url,
+                self.eject_seconds,
+                node.consecutive_failures,
+            )
+
+    async def probe(self, node: OllamaNode) -> bool:
+        """Refresh loaded/available models; re-admits or ejects the node"""
+        session = self.transport.session
+        timeout = aiohttp.ClientTimeout(total=5)
+        started = time.monotonic()
+        try:
+            async with session.get(f"{node.url}/api/ps", timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"/api/ps returned {response.status}")
+                data = await response.json()
+                loaded = {model_name(m["name"]) for m in data.get("models", [])}
+
+            async with session.get(f"{node.url}/api/tags", timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"/api/tags returned {response.status}")
+                data = await response.json()
+                available = {model_name(m["name"]) for m in data.get("models", [])}
+        except Exception as e:
+            logger.warning("[Ollama] Probe of %s failed: %s", node.url, e)
+            node.last_probe = time.monotonic()
+            self.record_failure(node)
+            return False
+
+        # Models served while the probe was in flight postdate its answer
+        recent = {model for model, at in node.served.items() if at >= started}
+        node.served = {model: at for model, at in node.served.items() if at >= started}
+        node.loaded_models = loaded | recent
+        node.available_models = available | recent
+        node.last_probe = time.monotonic()
+        if not node.healthy:
+            logger.info("[Ollama] Node %s is healthy again", node.url)
+        node.consecutive_failures = 0
+        node.ejected_until = 0.0
+        return True
+
+    async def probe_all(self) -> List[bool]:
+        return await asyncio.gather(*(self.probe(node) for node in self.nodes))
+
+    async def _probe_loop(self) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception:
+                logger.exception("[Ollama] Node probe loop failed")
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self) -> None:
+        """Start background re-probing"""
+        if self._probe_task is None and self.probe_interval > 0:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def stats(self) -> dict:
+        return {"nodes": [node.to_dict() for node in self.nodes]}
@@ -10,6 +10,10 @@ from typing import List, AsyncGenerator, Optional
 
 from ..models.schemas import ChatRequest, ChatResponse, StreamChunk, ModelInfo
 from ..config import settings
+from .conversations import chat_message, render_history
+from .timeouts import timeout_policy
+from .tracing import traced
+from .transport import HTTPTransport, http_transport
 
 logger = logging.getLogger(__name__)
 
@@ -17,14 +21,15 @@ logger = logging.getLogger(__name__)
 class OpenAIService:
     """Service for interacting with OpenAI API"""
 
-    def __init__(self):
+    def __init__(self, transport: Optional[HTTPTransport] = None):
         self.api_key = settings.OPENAI_API_KEY
         self.base_url = "https://api.openai.com/v1"
-        self.session = aiohttp.ClientSession()
+        self.transport = transport or http_transport
 
-    async def close(self):
-        """Gracefully close aiohttp session"""
-        await self.session.close()
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled session from the shared transport"""
+        return self.transport.session
 
     async def health_check(self) -> bool:
         """Check if OpenAI API is accessible"""
@@ -78,7 +83,7 @@ class OpenAIService:
                 return models
 
         except Exception as e:
-            raise Exception(f"Failed to fetch OpenAI models: {str(e)}")
+            raise Exception(f"Failed to fetch OpenAI models: {str(e)}") from e
 
     async def chat_completion(self, request: ChatRequest) -> ChatResponse:
         """Non-streaming chat completion"""
@@ -86,14 +91,18 @@ class OpenAIService:
             raise Exception("OpenAI API key not configured")
 
         try:
-            logger.info(f"Calling OpenAI model '{request.model}' (stream=False)")
+            logger.info(
+                "Calling OpenAI model '%s' (stream=False)",
+                request.model,
+                extra={"category": "request"},
+            )
             messages = self.build_messages(request)
 
             payload = {
                 "model": request.model,
                 "messages": messages,
                 "stream": False,
-                "temperature": request.temperature or 0.7,
+                "temperature": request.temperature if request.temperature is not None else 0.7,
             }
 
             if request.max_tokens:
@@ -108,7 +117,7 @@ class OpenAIService:
                 f"{self.base_url}/chat/completions",
                 json=payload,
                 headers=headers,
-                timeout=aiohttp.ClientTimeout(total=60),
+                timeout=timeout_policy("openai", request.model).client_timeout(),
             ) as response:
                 if response.status != 200:
                     error_text = await response.text()
@@ -130,7 +139,7 @@ class OpenAIService:
                 )
 
         except Exception as e:
-            raise Exception(f"OpenAI chat completion failed: {str(e)}")
+            raise Exception(f"OpenAI chat completion failed: {str(e)}") from e
 
     async def chat_completion_stream(
         self, request: ChatRequest
@@ -140,14 +149,18 @@ class OpenAIService:
             raise Exception("OpenAI API key not configured")
 
         try:
-            logger.info(f"Calling OpenAI model '{request.model}' (stream=True)")
+            logger.info(
+                "Calling OpenAI model '%s' (stream=True)",
+                request.model,
+                extra={"category": "request"},
+            )
             messages = self.build_messages(request)
 
             payload = {
                 "model": request.model,
                 "messages": messages,
                 "stream": True,
-                "temperature": request.temperature or 0.7,
+                "temperature": request.temperature if request.temperature is not None else 0.7,
             }
 
             if request.max_tokens:
@@ -158,17 +171,22 @@ class OpenAIService:
                 "Content-Type": "application/json",
             }
 
-            async with self.session.post(
+            timer = timeout_policy("openai", request.model).timer()
+            response = await timer.wait(self.session.post(
                 f"{self.base_url}/chat/completions",
                 json=payload,
                 headers=headers,
-                timeout=aiohttp.ClientTimeout(total=60),
-            ) as response:
+                timeout=timer.policy.client_timeout(),
+            ))
+            async with response:
                 if response.status != 200:
                     error_text = await response.text()
                     raise Exception(f"OpenAI API error {response.status}: {error_text}")
 
-                async for line in response.content:
+                while True:
+                    line = await timer.chunk(response.content.readline())
+                    if not line:
+                        break
                     line = line.decode("utf-8").strip()
                     if not line or not line.startswith("data: "):
                         continue
@@ -199,8 +217,9 @@ class OpenAIService:
                         continue
 
         except Exception as e:
-            raise Exception(f"OpenAI streaming failed: {str(e)}")
+            raise Exception(f"OpenAI streaming failed: {str(e)}") from e
 
+    @traced("openai.build_messages")
     def build_messages(self, request: ChatRequest) -> List[dict]:
         """Build OpenAI messages format from chat request"""
         messages = []
@@ -208,8 +227,7 @@ class OpenAIService:
         if request.system_prompt:
             messages.append({"role": "system", "content": request.system_prompt})
 
-        for msg in request.history:
-            messages.append({"role": msg.role, "content": msg.content})
+        messages.extend(render_history(request.history, "chat", chat_message))
 
         messages.append({"role": "user", "content": request.message})
         return messages
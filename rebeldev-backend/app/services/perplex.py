@@ -10,6 +10,10 @@ from typing import List, AsyncGenerator, Optional
 
 from ..models.schemas import ChatRequest, ChatResponse, StreamChunk, ModelInfo
 from ..config import settings
+from .conversations import chat_message, render_history
+from .timeouts import timeout_policy
+from .tracing import traced
+from .transport import HTTPTransport, http_transport
 
 logger = logging.getLogger(__name__)
 
@@ -17,35 +21,37 @@ logger = logging.getLogger(__name__)
 class PerplexityService:
     """Service for interacting with Perplexity API"""
 
-    def __init__(self):
+    def __init__(self, transport: Optional[HTTPTransport] = None):
         self.api_key = settings.PERPLEXITY_API_KEY
         self.base_url = "https://api.perplexity.ai"
-        self.session = aiohttp.ClientSession()
+        self.transport = transport or http_transport
 
-    async def close(self):
-        """Gracefully close aiohttp session"""
-        await self.session.close()
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled session from the shared transport"""
+        return self.transport.session
 
     async def health_check(self) -> bool:
-        """Check if Perplexity API is accessible"""
+        """
+        Check if Perplexity API is accessible.
+
+        Perplexity has no model-listing endpoint, so an empty completion body is
+        sent instead: a reachable API with a valid key rejects it with a
+        validation error (400/422) without generating anything, while a bad key
+        yields 401.
+        """
         if not self.api_key:
             return False
 
         try:
             headers = {"Authorization": f"Bearer {self.api_key}"}
-            test_payload = {
-                "model": "llama-3.1-sonar-small-128k-online",
-                "messages": [{"role": "user", "content": "test"}],
-                "max_tokens": 1,
-            }
-
             async with self.session.post(
                 f"{self.base_url}/chat/completions",
                 headers=headers,
-                json=test_payload,
+                json={},
                 timeout=aiohttp.ClientTimeout(total=5),
             ) as response:
-                return response.status in [200, 400]
+                return response.status in [200, 400, 422]
 
         except Exception:
             return False
@@ -86,14 +92,18 @@ class PerplexityService:
             raise Exception("Perplexity API key not configured")
 
         try:
-            logger.info(f"Calling Perplexity model '{request.model}' (stream=False)")
+            logger.info(
+                "Calling Perplexity model '%s' (stream=False)",
+                request.model,
+                extra={"category": "request"},
+            )
             messages = self.build_messages(request)
 
             payload = {
                 "model": request.model,
                 "messages": messages,
                 "stream": False,
-                "temperature": request.temperature or 0.7,
+                "temperature": request.temperature if request.temperature is not None else 0.7,
             }
 
             if request.max_tokens:
@@ -108,7 +118,7 @@ class PerplexityService:
                 f"{self.base_url}/chat/completions",
                 json=payload,
                 headers=headers,
-                timeout=aiohttp.ClientTimeout(total=60),
+                timeout=timeout_policy("perplexity", request.model).client_timeout(),
             ) as response:
                 if response.status != 200:
                     error_text = await response.text()
@@ -131,7 +141,7 @@ class PerplexityService:
                 )
 
         except Exception as e:
-            raise Exception(f"Perplexity chat completion failed: {str(e)}")
+            raise Exception(f"Perplexity chat completion failed: {str(e)}") from e
 
     async def chat_completion_stream(
         self, request: ChatRequest
@@ -141,14 +151,18 @@ class PerplexityService:
             raise Exception("Perplexity API key not configured")
 
         try:
-            logger.info(f"Calling Perplexity model '{request.model}' (stream=True)")
+            logger.info(
+                "Calling Perplexity model '%s' (stream=True)",
+                request.model,
+                extra={"category": "request"},
+            )
             messages = self.build_messages(request)
 
             payload = {
                 "model": request.model,
                 "messages": messages,
                 "stream": True,
-                "temperature": request.temperature or 0.7,
+                "temperature": request.temperature if request.temperature is not None else 0.7,
             }
 
             if request.max_tokens:
@@ -159,17 +173,22 @@ class PerplexityService:
                 "Content-Type": "application/json",
             }
 
-            async with self.session.post(
+            timer = timeout_policy("perplexity", request.model).timer()
+            response = await timer.wait(self.session.post(
                 f"{self.base_url}/chat/completions",
                 json=payload,
                 headers=headers,
-                timeout=aiohttp.ClientTimeout(total=60),
-            ) as response:
+                timeout=timer.policy.client_timeout(),
+            ))
+            async with response:
                 if response.status != 200:
                     error_text = await response.text()
                     raise Exception(f"Perplexity API error {response.status}: {error_text}")
 
-                async for line in response.content:
+                while True:
+                    line = await timer.chunk(response.content.readline())
+                    if not line:
+                        break
                     line = line.decode("utf-8").strip()
                     if not line or not line.startswith("data: "):
                         continue
@@ -201,8 +220,9 @@ class PerplexityService:
                         continue
 
         except Exception as e:
-            raise Exception(f"Perplexity streaming failed: {str(e)}")
+            raise Exception(f"Perplexity streaming failed: {str(e)}") from e
 
+    @traced("perplexity.build_messages")
     def build_messages(self, request: ChatRequest) -> List[dict]:
         """Build Perplexity-compatible chat messages"""
         messages = []
@@ -210,8 +230,7 @@ class PerplexityService:
         if request.system_prompt:
             messages.append({"role": "system", "content": request.system_prompt})
 
-        for msg in request.history:
-            messages.append({"role": msg.role, "content": msg.content})
+        messages.extend(render_history(request.history, "chat", chat_message))
 
         messages.append({"role": "user", "content": request.message})
         return messages
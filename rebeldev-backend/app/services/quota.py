@@ -0,0 +1,153 @@
+"""
+Token-budget quotas.
+
+Each client has a budget of model tokens that refills continuously over a
+window. Requests are pre-checked against an estimate of their cost before
+admission and then charged for the prompt and completion tokens actually
+reported by the provider (for streams, from the final ``done`` chunk).
+"""
+
+import math
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from ..models.schemas import ChatRequest, ChatResponse
+from ..config import settings
+from .metrics import record_error
+
+
+class QuotaExceeded(Exception):
+    """Raised when a client's remaining token budget cannot cover a request"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+def estimate_prompt_tokens(request: ChatRequest) -> int:
+    """Cheap prompt size estimate (~4 characters per token)"""
+    chars = len(request.message) + len(request.system_prompt or "")
+    chars += sum(len(m.content) for m in request.history)
+    return math.ceil(chars / 4)
+
+
+def estimate_cost(request: ChatRequest) -> int:
+    """Upper-bound cost used for the admission pre-check"""
+    completion = request.max_tokens or settings.TOKEN_BUDGET_DEFAULT_COMPLETION
+    return estimate_prompt_tokens(request) + completion
+
+
+def usage_tokens(usage: Optional[dict]) -> Optional[int]:
+    """Total tokens from a provider usage block, if it reports any"""
+    if not usage:
+        return None
+    if usage.get("total_tokens") is not None:
+        return int(usage["total_tokens"])
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    return int(prompt + completion) or None
+
+
+def response_tokens(request: ChatRequest, response: ChatResponse) -> int:
+    tokens = usage_tokens(response.usage)
+    if tokens is None:
+        tokens = estimate_prompt_tokens(request) + math.ceil(len(response.message) / 4)
+    return tokens
+
+
+def stream_tokens(request: ChatRequest, metadata: Optional[dict], content_chars: int) -> int:
+    """Tokens for a finished stream, preferring the counts on the done chunk"""
+    metadata = metadata or {}
+    prompt = metadata.get("prompt_eval_count")
+    completion = metadata.get("eval_count")
+    if prompt is None:
+        prompt = estimate_prompt_tokens(request)
+    if completion is None:
+        completion = math.ceil(content_chars / 4)
+    return int(prompt + completion)
+
+
+class TokenQuota:
+    """Per-client continuously refilling token budgets (in process)"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        budget: Optional[int] = None,
+        window: Optional[float] = None,
+        max_clients: int = 100_000,
+    ):
+        self.enabled = settings.TOKEN_BUDGET_ENABLED if enabled is None else enabled
+        self.budget = settings.TOKEN_BUDGET_TOKENS if budget is None else budget
+        self.window = settings.TOKEN_BUDGET_WINDOW if window is None else window
+        self.max_clients = max_clients
+        # Only clients below their full budget, least recently charged first
+        self._balances: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.rejected = 0
+        self.charged = 0
+
+    @property
+    def rate(self) -> float:
+        return self.budget / self.window
+
+    def remaining(self, client: str) -> float:
+        """Refilled balance for ``client``; may be negative after overspending"""
+        now = time.monotonic()
+        balance, updated = self._balances.get(client, (float(self.budget), now))
+        balance = min(float(self.budget), balance + (now - updated) * self.rate)
+        if balance >= self.budget:
+            # A full budget carries no state
+            self._balances.pop(client, None)
+        else:
+            self._balances[client] = (balance, now)
+        return balance
+
+    def _prune(self, now: float) -> None:
+        # Oldest first, stopping at the first client that is still refilling
+        while self._balances:
+            balance, updated = next(iter(self._balances.values()))
+            refilled = balance + (now - updated) * self.rate >= self.budget
+            if not refilled and len(self._balances) <= self.max_clients:
+                break
+            self._balances.popitem(last=False)
+
+    def check(self, client: str, request: ChatRequest) -> None:
+        """Reject up front if the estimated cost exceeds the remaining budget"""
+        if not self.enabled:
+            return
+        cost = min(estimate_cost(request), self.budget)
+        balance = self.remaining(client)
+        if balance < cost:
+            self.rejected += 1
+            error = QuotaExceeded(
+                f"Token budget exhausted: {int(max(balance, 0))} of {self.budget} "
+                f"tokens left, request needs about {cost}",
+                retry_after=max(1, math.ceil((cost - balance) / self.rate)),
+            )
+            record_error(request.provider.value, request.model, error)
+            raise error
+
+    def charge(self, client: str, tokens: int) -> None:
+        """Debit tokens actually consumed"""
+        if not self.enabled or tokens <= 0:
+            return
+        balance = self.remaining(client)
+        now = time.monotonic()
+        self._balances[client] = (balance - tokens, now)
+        self._balances.move_to_end(client)
+        self._prune(now)
+        self.charged += tokens
+
+    def status(self, client: str) -> dict:
+        return {
+            "enabled": self.enabled,
+            "budget": self.budget,
+            "window": self.window,
+            "remaining": int(self.remaining(client)) if self.enabled else None,
+        }
+
+
+# Process-wide quota tracker
+token_quota = TokenQuota()
@@ -0,0 +1,226 @@
+"""
+Ollama model residency: warm-up, keep_alive and idle unloading.
+
+Ollama unloads a model ``keep_alive`` after its last request (5 minutes by
+default), so the next user pays the full ``load_duration``. The residency
+manager preloads configured models at startup, sends a per-model
+``keep_alive`` with every request (pinned models forever, models with recent
+traffic longer, the rest Ollama's default), optionally unloads models that have
+gone idle, and records the load time paid by each request.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Union
+
+import aiohttp
+
+from ..config import settings
+from .ollama_pool import OllamaNode, OllamaNodePool, model_name
+
+logger = logging.getLogger(__name__)
+
+# load_duration (ns) above which a request is counted as a cold load
+COLD_LOAD_NS = 500_000_000
+
+
+class ModelUsage:
+    """Recent traffic and load times for one model"""
+
+    def __init__(self):
+        self.recent: Deque[float] = deque()
+        self.last_used = 0.0
+        self.requests = 0
+        self.cold_loads = 0
+        self.load_ms_total = 0.0
+        self.last_load_ms: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "requests_in_window": len(self.recent),
+            "cold_loads": self.cold_loads,
+            "last_load_ms": self.last_load_ms,
+            "avg_load_ms": round(self.load_ms_total / self.requests, 1) if self.requests else None,
+        }
+
+
+class ModelResidency:
+    """Keeps hot Ollama models loaded and lets cold ones go"""
+
+    def __init__(
+        self,
+        nodes: OllamaNodePool,
+        warm_models: Optional[List[str]] = None,
+        pinned_models: Optional[List[str]] = None,
+        hot_keep_alive: Optional[str] = None,
+        cold_keep_alive: Optional[str] = None,
+        hot_requests: Optional[int] = None,
+        window: Optional[float] = None,
+        unload_idle_after: Optional[float] = None,
+        interval: Optional[float] = None,
+    ):
+        self.nodes = nodes
+        self.warm_models = settings.RESIDENCY_WARM_MODELS if warm_models is None else warm_models
+        # Names are kept without the implicit ":latest" tag, as node state is
+        self.pinned = {
+            model_name(model)
+            for model in (
+                settings.RESIDENCY_PINNED_MODELS if pinned_models is None else pinned_models
+            )
+        }
+        self.hot_keep_alive = (
+            settings.RESIDENCY_HOT_KEEP_ALIVE if hot_keep_alive is None else hot_keep_alive
+        )
+        self.cold_keep_alive = (
+            settings.RESIDENCY_COLD_KEEP_ALIVE if cold_keep_alive is None else cold_keep_alive
+        )
+        self.hot_requests = settings.RESIDENCY_HOT_REQUESTS if hot_requests is None else hot_requests
+        self.window = settings.RESIDENCY_WINDOW if window is None else window
+        self.unload_idle_after = (
+            settings.RESIDENCY_UNLOAD_IDLE_AFTER if unload_idle_after is None else unload_idle_after
+        )
+        self.interval = settings.RESIDENCY_INTERVAL if interval is None else interval
+        self.usage: Dict[str, ModelUsage] = {}
+        self.unloads = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _usage(self, model: str) -> ModelUsage:
+        model = model_name(model)
+        usage = self.usage.get(model)
+        if usage is None:
+            usage = self.usage[model] = ModelUsage()
+        return usage
+
+    def _trim(self, usage: ModelUsage, now: float) -> None:
+        while usage.recent and now - usage.recent[0] > self.window:
+            usage.recent.popleft()
+
+    def is_hot(self, model: str) -> bool:
+        usage = self.usage.get(model_name(model))
+        if usage is None:
+            return False
+        self._trim(usage, time.monotonic())
+        return len(usage.recent) >= self.hot_requests
+
+    def keep_alive(self, model: str) -> Union[str, int]:
+        """keep_alive to send with a request for ``model``"""
+        if model_name(model) in self.pinned:
+            return -1
+        return self.hot_keep_alive if self.is_hot(model) else self.cold_keep_alive
+
+    def record(self, model: str, data: dict) -> None:
+        """Account one finished request from its final Ollama record"""
+        now = time.monotonic()
+        usage = self._usage(model)
+        usage.recent.append(now)
+        self._trim(usage, now)
+        usage.last_used = now
+        usage.requests += 1
+
+        load_ns = data.get("load_duration")
+        if load_ns is not None:
+            usage.last_load_ms = round(load_ns / 1e6, 1)
+            usage.load_ms_total += load_ns / 1e6
+            if load_ns >= COLD_LOAD_NS:
+                usage.cold_loads += 1
+
+    async def _generate(self, node: OllamaNode, model: str, keep_alive: Union[str, int]) -> None:
+        # A prompt-less /api/generate loads (or with keep_alive=0 unloads) the model
+        async with self.nodes.transport.session.post(
+            f"{node.url}/api/generate",
+            json={"model": model, "keep_alive": keep_alive},
+            timeout=aiohttp.ClientTimeout(total=settings.OLLAMA_TIMEOUT),
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"Ollama API error {response.status}: {await response.text()}")
+            data = await response.json()
+
+        if keep_alive == 0:
+            node.loaded_models.discard(model_name(model))
+        else:
+            node.loaded_models.add(model_name(model))
+            node.available_models.add(model_name(model))
+            self._usage(model).last_used = time.monotonic()
+            if data.get("load_duration") is not None:
+                logger.info(
+                    "[Residency] Warmed %s on %s in %.1fs",
+                    model,
+                    node.url,
+                    data["load_duration"] / 1e9,
+                )
+
+    async def warm(self, models: Optional[List[str]] = None) -> None:
+        """Preload models on the node each would be routed to"""
+        async def load(model: str) -> None:
+            try:
+                await self._generate(self.nodes.pick(model), model, self.keep_alive(model))
+            except Exception as e:
+                logger.warning("[Residency] Warm-up of %s failed: %s", model, e)
+
+        await asyncio.gather(*(load(model) for model in (models or self.warm_models)))
+
+    async def unload_idle(self) -> List[str]:
+        """Unload non-pinned models that have had no traffic for a while"""
+        if self.unload_idle_after <= 0:
+            return []
+        now = time.monotonic()
+        unloaded = []
+        for node in self.nodes.nodes:
+            for model in list(node.loaded_models):
+                usage = self.usage.get(model)
+                if model in self.pinned or node.outstanding:
+                    continue
+                if usage is not None and now - usage.last_used < self.unload_idle_after:
+                    continue
+                try:
+                    await self._generate(node, model, 0)
+                except Exception as e:
+                    logger.warning("[Residency] Unload of %s on %s failed: %s", model, node.url, e)
+                    continue
+                self.unloads += 1
+                unloaded.append(model)
+                logger.info("[Residency] Unloaded idle model %s from %s", model, node.url)
+        return unloaded
+
+    async def _loop(self) -> None:
+        await self.warm()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.unload_idle()
+            except Exception:
+                logger.exception("[Residency] Idle unload failed")
+
+    def start(self) -> None:
+        if self._task is None and (self.warm_models or self.unload_idle_after > 0):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        models = set(self.usage) | self.pinned | {model_name(m) for m in self.warm_models}
+        for node in self.nodes.nodes:
+            models |= node.loaded_models
+        return {
+            "unload_idle_after": self.unload_idle_after,
+            "unloads": self.unloads,
+            "models": {
+                model: {
+                    "keep_alive": self.keep_alive(model),
+                    "pinned": model in self.pinned,
+                    "resident_on": [n.url for n in self.nodes.nodes if model in n.loaded_models],
+                    **self.usage.get(model, ModelUsage()).to_dict(),
+                }
+                for model in sorted(models)
+            },
+        }
@@ -0,0 +1,356 @@
+"""
+Per-model admission control in front of the provider services.
+
+Each (provider, model) pair gets a bounded number of concurrent slots and a
+priority-ordered FIFO wait queue. For Ollama, requests for models that are
+already loaded are dispatched ahead of requests that would force a model swap,
+so bursts for the resident model are batched together instead of thrashing VRAM.
+Slot and residency limits are per upstream node and scale with the number of
+healthy nodes behind the provider.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ..config import settings
+from .metrics import record_error, record_queue_time
+from .ollama_pool import model_name
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerRejected(Exception):
+    """Raised when a request cannot be admitted; maps to an HTTP error"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("model", "priority", "seq", "enqueued_at", "future", "swap_timer")
+
+    def __init__(self, model: str, priority: int, seq: int):
+        self.model = model
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Wakes the dispatcher when this waiter's swap may no longer be deferred
+        self.swap_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def sort_key(self) -> Tuple[int, int]:
+        return (-self.priority, self.seq)
+
+
+class Lease:
+    """An admitted slot; release() is idempotent"""
+
+    def __init__(self, scheduler: "ProviderScheduler", model: str, wait_time: float):
+        self.scheduler = scheduler
+        self.model = model
+        self.wait_time = wait_time
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self.model, time.monotonic() - self.admitted_at)
+
+    async def __aenter__(self) -> "Lease":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class ProviderScheduler:
+    """Slots, queues and residency tracking for one provider"""
+
+    def __init__(
+        self,
+        provider: str,
+        slots_per_model: int,
+        max_queue: int,
+        queue_timeout: float,
+        max_resident_models: Optional[int] = None,
+        swap_max_wait: float = 10.0,
+        nodes: Optional[Callable[[], int]] = None,
+    ):
+        self.provider = provider
+        self.slots_per_model = slots_per_model
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_resident_models = max_resident_models
+        self.swap_max_wait = swap_max_wait
+        # Upstream nodes sharing the load; the limits above apply to each
+        self.nodes = nodes or (lambda: 1)
+
+        self._queues: Dict[str, List[Tuple[Tuple[int, int], _Waiter]]] = {}
+        self._active: Dict[str, int] = {}
+        self._resident: "OrderedDict[str, None]" = OrderedDict()
+        self._seq = itertools.count()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.swaps = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.completed = 0
+
+    # -- admission ---------------------------------------------------------
+
+    def _node_count(self) -> int:
+        return max(self.nodes(), 1)
+
+    def _slots(self) -> int:
+        return self.slots_per_model * self._node_count()
+
+    def _max_resident(self) -> int:
+        return self.max_resident_models * self._node_count()
+
+    def _busy_models(self) -> int:
+        return sum(1 for count in self._active.values() if count > 0)
+
+    def _can_admit(self, model: str) -> bool:
+        if self._active.get(model, 0) >= self._slots():
+            return False
+        if self.max_resident_models is None or model in self._resident:
+            return True
+        return self._busy_models() < self._max_resident()
+
+    def _admit(self, model: str) -> None:
+        self._active[model] = self._active.get(model, 0) + 1
+        self.admitted += 1
+        if self.max_resident_models is None:
+            return
+
+        if model not in self._resident:
+            self.swaps += 1
+            self._resident[model] = None
+            # Forget the least recently used idle models beyond capacity
+            capacity = self._max_resident()
+            for name in list(self._resident):
+                if len(self._resident) <= capacity:
+                    break
+                if name != model and self._active.get(name, 0) == 0:
+                    del self._resident[name]
+        self._resident.move_to_end(model)
+
+    def _queue_depth(self, model: str) -> int:
+        return len(self._queues.get(model, ()))
+
+    def _retry_after(self, model: str) -> int:
+        average = self.total_service / self.completed if self.completed else 1.0
+        backlog = self._queue_depth(model) + self._active.get(model, 0)
+        return max(1, math.ceil(average * backlog / max(self._slots(), 1)))
+
+    async def acquire(self, model: str, priority: int = 0) -> Lease:
+        """Wait for a slot on ``model``; raises SchedulerRejected on overload"""
+        if not self._queue_depth(model) and self._can_admit(model) and not self._draining():
+            self._admit(model)
+            return Lease(self, model, 0.0)
+
+        if self._queue_depth(model) >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerRejected(
+                f"Queue for {self.provider}:{model} is full",
+                status_code=429,
+                retry_after=self._retry_after(model),
+            )
+
+        waiter = _Waiter(model, priority, next(self._seq))
+        heapq.heappush(self._queues.setdefault(model, []), (waiter.sort_key, waiter))
+        if self._needs_swap(model):
+            # Nothing else may call _dispatch() by then; enforce the deadline anyway
+            waiter.swap_timer = asyncio.get_running_loop().call_later(
+                self.swap_max_wait, self._dispatch
+            )
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._discard(waiter)
+                self.timed_out += 1
+                raise SchedulerRejected(
+                    f"Timed out waiting for {self.provider}:{model}",
+                    status_code=503,
+                    retry_after=self._retry_after(model),
+                )
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as the caller went away; hand the slot back
+                self._release(model, 0.0)
+            else:
+                waiter.future.cancel()
+                self._discard(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return Lease(self, model, waited)
+
+    def _discard(self, waiter: _Waiter) -> None:
+        if waiter.swap_timer is not None:
+            waiter.swap_timer.cancel()
+        queue = self._queues.get(waiter.model)
+        if not queue:
+            return
+        queue[:] = [entry for entry in queue if entry[1] is not waiter]
+        heapq.heapify(queue)
+        if not queue:
+            del self._queues[waiter.model]
+
+    def _release(self, model: str, service_time: float) -> None:
+        active = self._active.get(model, 0) - 1
+        if active > 0:
+            self._active[model] = active
+        else:
+            # Forget idle models; names are client-supplied and would pile up otherwise
+            self._active.pop(model, None)
+        self.completed += 1
+        self.total_service += service_time
+        self._dispatch()
+
+    def _needs_swap(self, model: str) -> bool:
+        return self.max_resident_models is not None and model not in self._resident
+
+    def _draining(self) -> bool:
+        """True when a swap has waited too long and resident models must drain"""
+        now = time.monotonic()
+        # The heap is ordered by priority, so its top is not necessarily the oldest waiter
+        return any(
+            queue
+            and self._needs_swap(model)
+            and now - min(waiter.enqueued_at for _, waiter in queue) >= self.swap_max_wait
+            for model, queue in self._queues.items()
+        )
+
+    def _dispatch(self) -> None:
+        """Admit as many waiters as capacity allows, resident models first"""
+        while True:
+            draining = self._draining()
+            best: Optional[_Waiter] = None
+            best_rank = None
+            for model, queue in self._queues.items():
+                if not queue or not self._can_admit(model):
+                    continue
+                needs_swap = self._needs_swap(model)
+                if draining and not needs_swap:
+                    # Hold the loaded model back so a starving swap can proceed
+                    continue
+                waiter = queue[0][1]
+                rank = (needs_swap, waiter.sort_key)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = waiter, rank
+
+            if best is None:
+                return
+
+            heapq.heappop(self._queues[best.model])
+            if not self._queues[best.model]:
+                del self._queues[best.model]
+            if best.swap_timer is not None:
+                best.swap_timer.cancel()
+            self._admit(best.model)
+            best.future.set_result(True)
+
+    def stats(self) -> dict:
+        models = sorted(set(self._active) | set(self._queues))
+        return {
+            "slots_per_model": self.slots_per_model,
+            "nodes": self._node_count(),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "swaps": self.swaps,
+            "avg_wait": round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait": round(self.max_wait, 4),
+            "resident": list(self._resident),
+            "models": {
+                model: {
+                    "active": self._active.get(model, 0),
+                    "queued": self._queue_depth(model),
+                }
+                for model in models
+            },
+        }
+
+
+class ModelScheduler:
+    """Registry of per-provider schedulers"""
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = settings.SCHEDULER_ENABLED if enabled is None else enabled
+        self._providers: Dict[str, ProviderScheduler] = {}
+        # Healthy node counts per provider; providers not listed count as one node
+        self.node_counts: Dict[str, Callable[[], int]] = {}
+
+    def for_provider(self, provider: str) -> ProviderScheduler:
+        scheduler = self._providers.get(provider)
+        if scheduler is None:
+            scheduler = ProviderScheduler(
+                provider,
+                slots_per_model=settings.SCHEDULER_SLOTS_PER_MODEL,
+                max_queue=settings.SCHEDULER_MAX_QUEUE_PER_MODEL,
+                queue_timeout=settings.SCHEDULER_QUEUE_TIMEOUT,
+                max_resident_models=(
+                    settings.SCHEDULER_OLLAMA_MAX_LOADED_MODELS if provider == "ollama" else None
+                ),
+                swap_max_wait=settings.SCHEDULER_SWAP_MAX_WAIT,
+                nodes=lambda: self.node_counts.get(provider, lambda: 1)(),
+            )
+            self._providers[provider] = scheduler
+        return scheduler
+
+    async def acquire(self, provider: str, model: str, priority: int = 0) -> Optional[Lease]:
+        """Admit a request; returns None when scheduling is disabled"""
+        if not self.enabled:
+            return None
+        if provider == "ollama":
+            # One slot pool per model, whether or not the client wrote ":latest"
+            model = model_name(model)
+        try:
+            lease = await self.for_provider(provider).acquire(model, priority)
+        except SchedulerRejected as e:
+            record_error(provider, model, e)
+            raise
+        record_queue_time(provider, model, lease.wait_time)
+        return lease
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "providers": {name: s.stats() for name, s in self._providers.items()},
+        }
+
+
+def parse_priority(value: Optional[str]) -> int:
+    """Parse an X-Priority header; names or integers, higher runs first"""
+    if not value:
+        return 0
+    named = {"low": -1, "normal": 0, "high": 1}
+    if value.lower() in named:
+        return named[value.lower()]
+    try:
+        return max(-10, min(10, int(value)))
+    except ValueError:
+        return 0
+
+
+# Process-wide scheduler
+model_scheduler = ModelScheduler()
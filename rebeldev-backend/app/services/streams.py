@@ -0,0 +1,56 @@
+"""
+Streaming response bookkeeping.
+
+Tracks open streams and how they end. When a client disconnects mid-stream the
+upstream generation is aborted; the tokens it had already produced are recorded
+here as wasted work.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamMonitor:
+    """Counts open streams and the tokens thrown away by clients that leave early"""
+
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.wasted_tokens = 0
+
+    def opened(self) -> None:
+        self.active += 1
+
+    def finished(self) -> None:
+        self.active = max(self.active - 1, 0)
+        self.completed += 1
+
+    def errored(self) -> None:
+        self.active = max(self.active - 1, 0)
+        self.failed += 1
+
+    def disconnect(self, model: str, tokens: int) -> None:
+        """The client went away; ``tokens`` were generated for nobody"""
+        self.active = max(self.active - 1, 0)
+        self.disconnected += 1
+        self.wasted_tokens += max(tokens, 0)
+        logger.info(
+            "[Stream] Client disconnected from %s stream, ~%d tokens wasted", model, tokens,
+            extra={"category": "request"},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "disconnected": self.disconnected,
+            "wasted_tokens": self.wasted_tokens,
+        }
+
+
+# Process-wide stream tracker
+stream_monitor = StreamMonitor()
@@ -0,0 +1,136 @@
+"""
+Upstream timing budgets.
+
+Each provider (and optionally each model) gets four budgets: connect, time to
+first byte, the longest gap allowed between streamed chunks, and total
+duration. Connect and total are handed to aiohttp; first-byte and chunk-gap
+are enforced around every read in the streaming loops, so a node that stalls
+fails fast instead of holding a connection for the whole total budget.
+"""
+
+import asyncio
+from typing import Awaitable, Dict, Optional, Tuple, TypeVar
+
+import aiohttp
+
+from ..config import settings
+
+T = TypeVar("T")
+
+PHASES = ("connect", "first_byte", "chunk_gap", "total")
+
+
+class UpstreamTimeout(asyncio.TimeoutError):
+    """An upstream call ran over one of its timing budgets"""
+
+    def __init__(self, phase: str, budget: float):
+        super().__init__(f"Upstream {phase} timeout after {budget:g}s")
+        self.phase = phase
+        self.budget = budget
+
+
+class TimeoutPolicy:
+    """Timing budgets (seconds) for calls to one provider/model"""
+
+    def __init__(self, connect: float, first_byte: float, chunk_gap: float, total: float):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.chunk_gap = chunk_gap
+        self.total = total
+
+    def client_timeout(self) -> aiohttp.ClientTimeout:
+        """
+        aiohttp timeout covering connect and total.
+
+        Stream reads are bounded by StreamTimer. A non-streaming response only
+        arrives once generation is done, so its reads are bounded by ``total``
+        alone; a first-byte cap there would cut off long generations.
+        """
+        return aiohttp.ClientTimeout(total=self.total, sock_connect=self.connect)
+
+    def timer(self) -> "StreamTimer":
+        return StreamTimer(self)
+
+    def to_dict(self) -> dict:
+        return {phase: getattr(self, phase) for phase in PHASES}
+
+
+class StreamTimer:
+    """
+    Deadlines for one streaming call.
+
+    Until the first body chunk arrives every wait is bounded by ``first_byte``
+    (measured from the start of the call); afterwards each read is bounded by
+    ``chunk_gap``. Every wait is also bounded by the remaining total budget.
+    """
+
+    def __init__(self, policy: TimeoutPolicy):
+        self.policy = policy
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self.started = loop.time()
+        self.first_byte_deadline = self.started + policy.first_byte
+        self.total_deadline = self.started + policy.total
+        self.received = False
+
+    def _deadline(self) -> Tuple[float, str, float]:
+        if self.received:
+            deadline = self._loop.time() + self.policy.chunk_gap
+            phase, budget = "chunk_gap", self.policy.chunk_gap
+        else:
+            deadline = self.first_byte_deadline
+            phase, budget = "first_byte", self.policy.first_byte
+        if self.total_deadline <= deadline:
+            return self.total_deadline, "total", self.policy.total
+        return deadline, phase, budget
+
+    async def wait(self, awaitable: Awaitable[T]) -> T:
+        """Await something (e.g. response headers) within the current budget"""
+        deadline, phase, budget = self._deadline()
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await awaitable
+        except TimeoutError as e:
+            raise UpstreamTimeout(phase, budget) from e
+
+    async def chunk(self, awaitable: Awaitable[T]) -> T:
+        """Await the next body chunk; switches to the inter-chunk budget afterwards"""
+        result = await self.wait(awaitable)
+        self.received = True
+        return result
+
+
+_policies: Dict[Tuple[str, str], TimeoutPolicy] = {}
+
+
+def timeout_policy(provider: str, model: Optional[str] = None) -> TimeoutPolicy:
+    """
+    Resolve the budgets for ``provider``/``model``.
+
+    Global TIMEOUT_* defaults are overlaid with TIMEOUT_OVERRIDES["<provider>"]
+    and then TIMEOUT_OVERRIDES["<provider>:<model>"]. OLLAMA_TIMEOUT stays the
+    default total for Ollama. Resolved policies are memoized; models without an
+    override of their own share the provider's policy, so client-supplied model
+    names cannot grow the memo.
+    """
+    overrides = settings.TIMEOUT_OVERRIDES
+    if model and f"{provider}:{model}" not in overrides:
+        model = None
+    key = (provider, model or "")
+    policy = _policies.get(key)
+    if policy is not None:
+        return policy
+
+    values = {
+        "connect": settings.TIMEOUT_CONNECT,
+        "first_byte": settings.TIMEOUT_FIRST_BYTE,
+        "chunk_gap": settings.TIMEOUT_CHUNK_GAP,
+        "total": settings.OLLAMA_TIMEOUT if provider == "ollama" else settings.TIMEOUT_TOTAL,
+    }
+    values.update(overrides.get(provider, {}))
+    if model:
+        values.update(overrides.get(f"{provider}:{model}", {}))
+
+    policy = TimeoutPolicy(**{phase: float(values[phase]) for phase in PHASES})
+    _policies[key] = policy
+    return policy
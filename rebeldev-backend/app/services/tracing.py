@@ -0,0 +1,459 @@
+"""
+Request tracing.
+
+A lightweight tracer that follows the OpenTelemetry data model: spans carry
+128-bit trace IDs and 64-bit span IDs, and they propagate through W3C
+``traceparent`` headers. They are exported in the OTLP/HTTP JSON format that
+any OpenTelemetry collector accepts. A request's spans form one tree:
+
+- the server span from the tracing middleware, covering the whole response
+  including the stream;
+- the router handler;
+- prompt building;
+- one client span per upstream HTTP call. Client spans end when the response
+  headers arrive, so their duration is the upstream time to first byte.
+  Connection pool waits and new connections are span events.
+
+Tracing is off unless TRACING_ENABLED is set. When it is off, the middleware
+and the aiohttp hooks are not installed. Each decorated function then pays
+only for one attribute check.
+"""
+
+import abc
+import asyncio
+import functools
+import json
+import logging
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from yarl import URL
+
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+INTERNAL = "internal"
+SERVER = "server"
+CLIENT = "client"
+# OTLP SpanKind and StatusCode values
+OTLP_KINDS = {INTERNAL: 1, SERVER: 2, CLIENT: 3}
+OTLP_STATUS = {"unset": 0, "ok": 1, "error": 2}
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class SpanContext:
+    """The identity of a span, as carried between processes"""
+
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool = True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+class Span(SpanContext):
+    """A timed operation; unsampled spans only carry IDs for propagation"""
+
+    __slots__ = (
+        "name", "parent_id", "kind", "attributes", "events", "status", "status_message",
+        "start_time", "end_time", "_tracer",
+    )
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        kind: str = INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+        sampled: bool = True,
+    ):
+        super().__init__(trace_id, f"{random.getrandbits(64):016x}", sampled)
+        self.name = name
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.events: List[tuple] = []
+        self.status = "unset"
+        self.status_message = ""
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self._tracer = tracer
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        if self.sampled:
+            self.events.append((time.time_ns(), name, attributes or {}))
+
+    def record_exception(self, error: BaseException) -> None:
+        self.status = "error"
+        self.status_message = str(error)
+        self.add_event("exception", {
+            "exception.type": type(error).__name__,
+            "exception.message": str(error),
+        })
+
+    def end(self) -> None:
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if self.sampled:
+            self._tracer.exporter.export(self)
+
+    @property
+    def duration(self) -> float:
+        """Seconds from start to end"""
+        return ((self.end_time or time.time_ns()) - self.start_time) / 1e9
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": OTLP_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": otlp_attributes(self.attributes),
+            "events": [
+                {"timeUnixNano": str(at), "name": name, "attributes": otlp_attributes(attrs)}
+                for at, name, attrs in self.events
+            ],
+            "status": {"code": OTLP_STATUS[self.status], "message": self.status_message},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        values.append({"key": key, "value": typed})
+    return values
+
+
+class _NoopScope:
+    """What ``Tracer.span`` returns while tracing is off"""
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+NOOP_SCOPE = _NoopScope()
+
+
+class _SpanScope:
+    """Makes a span current for the duration of a ``with`` block and ends it"""
+
+    __slots__ = ("span", "_token")
+
+    def __init__(self, span: Span):
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self._token)
+        if exc is not None and not isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            self.span.record_exception(exc)
+        self.span.end()
+
+
+_current_span: ContextVar[Optional[SpanContext]] = ContextVar("current_span", default=None)
+
+
+class SpanExporter(abc.ABC):
+    """Receives finished, sampled spans; subclass for other backends"""
+
+    @abc.abstractmethod
+    def export(self, span: Span) -> None:
+        """Take one finished span; must not block the event loop"""
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySpanExporter(SpanExporter):
+    """Keeps finished spans in a list; for tests"""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def named(self, name: str) -> List[Span]:
+        return [span for span in self.spans if span.name == name]
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+
+class LoggingSpanExporter(SpanExporter):
+    """Logs each span as one JSON line"""
+
+    def export(self, span: Span) -> None:
+        logger.info(json.dumps(span.to_otlp(), separators=(",", ":")))
+
+
+class OTLPSpanExporter(SpanExporter):
+    """Batches spans and posts them to an OTLP/HTTP collector as JSON"""
+
+    def __init__(
+        self,
+        endpoint: str,
+        service_name: str,
+        max_batch: int = 512,
+        interval: float = 5.0,
+        max_queue: int = 8192,
+    ):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_queue = max_queue
+        self.pending: List[Span] = []
+        self.dropped = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def export(self, span: Span) -> None:
+        if len(self.pending) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.pending.append(span)
+
+    def payload(self, spans: List[Span]) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]}
+
+    async def flush(self) -> None:
+        while self.pending:
+            batch, self.pending = self.pending[: self.max_batch], self.pending[self.max_batch:]
+            try:
+                # A session of its own, so exporting is not itself traced
+                async with self._session.post(self.endpoint, json=self.payload(batch)) as response:
+                    if response.status >= 400:
+                        logger.warning(
+                            "[Tracing] Collector rejected %s spans: %s", len(batch), response.status
+                        )
+            except Exception as e:
+                logger.warning("[Tracing] Exporting %s spans failed: %s", len(batch), e)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.flush()
+            await self._session.close()
+
+
+def create_exporter() -> SpanExporter:
+    """Build the exporter selected by TRACING_EXPORTER"""
+    if settings.TRACING_EXPORTER == "otlp":
+        return OTLPSpanExporter(settings.TRACING_OTLP_ENDPOINT, settings.TRACING_SERVICE_NAME)
+    if settings.TRACING_EXPORTER == "memory":
+        return InMemorySpanExporter()
+    return LoggingSpanExporter()
+
+
+def _ollama_hosts() -> set:
+    """``host:port`` of every configured Ollama node"""
+    urls = settings.OLLAMA_BASE_URLS or [settings.OLLAMA_BASE_URL]
+    return {f"{URL(url).host}:{URL(url).port}" for url in urls}
+
+
+class Tracer:
+    """Creates spans and carries the current one through contextvars"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        exporter: Optional[SpanExporter] = None,
+        sample_ratio: Optional[float] = None,
+        propagate_hosts: Optional[List[str]] = None,
+    ):
+        self.enabled = settings.TRACING_ENABLED if enabled is None else enabled
+        self.exporter = exporter or create_exporter()
+        self.sample_ratio = settings.TRACING_SAMPLE_RATIO if sample_ratio is None else sample_ratio
+        self.propagate_hosts = set(
+            settings.TRACING_PROPAGATE_HOSTS if propagate_hosts is None else propagate_hosts
+        ) or _ollama_hosts()
+
+    @staticmethod
+    def current() -> Optional[SpanContext]:
+        return _current_span.get()
+
+    def start_span(
+        self,
+        name: str,
+        kind: str = INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+        parent: Optional[SpanContext] = None,
+    ) -> Span:
+        """A new span under ``parent`` (default: the current span); not made current"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            trace_id = f"{random.getrandbits(128):032x}"
+            sampled = self.sample_ratio >= 1 or random.random() < self.sample_ratio
+            return Span(self, name, trace_id, None, kind, attributes, sampled)
+        # Children follow their parent's sampling decision
+        return Span(self, name, parent.trace_id, parent.span_id, kind, attributes, parent.sampled)
+
+    def span(
+        self,
+        name: str,
+        kind: str = INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+        parent: Optional[SpanContext] = None,
+    ):
+        """``with tracer.span(...) as span:``; the span is None while tracing is off"""
+        if not self.enabled:
+            return NOOP_SCOPE
+        return _SpanScope(self.start_span(name, kind, attributes, parent))
+
+    @staticmethod
+    def extract(headers) -> Optional[SpanContext]:
+        """The remote parent from a ``traceparent`` header, if valid"""
+        value = headers.get("traceparent")
+        match = TRACEPARENT.match(value.strip().lower()) if value else None
+        if match is None:
+            return None
+        trace_id, span_id, flags = match.groups()
+        return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+    def trace_configs(self) -> List[aiohttp.TraceConfig]:
+        """aiohttp hooks giving every upstream call a client span; none while tracing is off"""
+        if not self.enabled:
+            return []
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(self._on_request_start)
+        config.on_connection_queued_start.append(self._event("connection.queued"))
+        config.on_connection_queued_end.append(self._event("connection.dequeued"))
+        config.on_connection_create_start.append(self._event("connection.create"))
+        config.on_connection_create_end.append(self._event("connection.created"))
+        config.on_connection_reuseconn.append(self._event("connection.reused"))
+        config.on_request_end.append(self._on_request_end)
+        config.on_request_exception.append(self._on_request_exception)
+        return [config]
+
+    async def _on_request_start(self, session, context, params) -> None:
+        if not self.enabled:
+            context.span = None
+            return
+        url = params.url
+        context.span = span = self.start_span(
+            f"HTTP {params.method}",
+            CLIENT,
+            {
+                "http.request.method": params.method,
+                "url.full": str(url.with_query(None)),
+                "server.address": url.host or "",
+            },
+        )
+        # Propagate the trace to our own upstreams only; third-party APIs
+        # must not learn internal trace and span ids
+        if self.propagates_to(url):
+            params.headers["traceparent"] = span.traceparent()
+
+    def propagates_to(self, url: URL) -> bool:
+        hosts = self.propagate_hosts
+        return url.host in hosts or f"{url.host}:{url.port}" in hosts
+
+    @staticmethod
+    def _event(name: str):
+        async def hook(session, context, params) -> None:
+            span = getattr(context, "span", None)
+            if span is not None:
+                span.add_event(name)
+        return hook
+
+    @staticmethod
+    async def _on_request_end(session, context, params) -> None:
+        span = getattr(context, "span", None)
+        if span is not None:
+            span.set_attribute("http.response.status_code", params.response.status)
+            if params.response.status >= 500:
+                span.status = "error"
+            span.end()
+
+    @staticmethod
+    async def _on_request_exception(session, context, params) -> None:
+        span = getattr(context, "span", None)
+        if span is not None:
+            span.record_exception(params.exception)
+            span.end()
+
+
+# Process-wide tracer
+tracer = Tracer()
+
+
+def traced(name: str):
+    """Decorator running a function, sync or async, inside a span of its own"""
+
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
@@ -0,0 +1,100 @@
+"""
+Shared HTTP transport for all provider services.
+
+A single pooled aiohttp session is opened in the application lifespan and
+handed to every service, so connections are reused across providers and
+closed exactly once on shutdown.
+"""
+
+import aiohttp
+import logging
+from typing import Optional
+
+from ..config import settings
+from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPTransport:
+    """Lifecycle-managed aiohttp connection pool"""
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        limit_per_host: Optional[int] = None,
+        keepalive_timeout: Optional[float] = None,
+        dns_cache_ttl: Optional[int] = None,
+    ):
+        self.limit = settings.HTTP_POOL_LIMIT if limit is None else limit
+        self.limit_per_host = (
+            settings.HTTP_POOL_LIMIT_PER_HOST if limit_per_host is None else limit_per_host
+        )
+        self.keepalive_timeout = (
+            settings.HTTP_KEEPALIVE_TIMEOUT if keepalive_timeout is None else keepalive_timeout
+        )
+        self.dns_cache_ttl = (
+            settings.HTTP_DNS_CACHE_TTL if dns_cache_ttl is None else dns_cache_ttl
+        )
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None and not self._session.closed
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The pooled session; only available between start() and close()"""
+        if not self.started:
+            raise RuntimeError("HTTP transport is not started")
+        return self._session
+
+    async def start(self) -> None:
+        """Open the connection pool (idempotent)"""
+        if self.started:
+            return
+
+        self._connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector, trace_configs=tracer.trace_configs()
+        )
+        logger.info(
+            "HTTP transport started (limit=%s, limit_per_host=%s, keepalive=%ss)",
+            self.limit,
+            self.limit_per_host,
+            self.keepalive_timeout,
+        )
+
+    async def close(self) -> None:
+        """Close the pool and every pooled connection"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+    def stats(self) -> dict:
+        """Current pool usage"""
+        if self._connector is None or self._connector.closed:
+            return {"started": False, "limit": self.limit, "limit_per_host": self.limit_per_host}
+
+        # aiohttp does not expose pool counters publicly; read them defensively
+        acquired = len(getattr(self._connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(self._connector, "_conns", {}).values())
+        return {
+            "started": True,
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "acquired": acquired,
+            "idle": idle,
+        }
+
+
+# Process-wide transport, started and closed by the application lifespan
+http_transport = HTTPTransport()
@@ -0,0 +1 @@
+# Utils package for OG-Ollama-UI API
@@ -1 +1,267 @@
-# Custom structlog setup (optional)
+"""
+Structured, non-blocking logging.
+
+Records take this path:
+
+- Filters run on the calling thread. They stamp each record with the current
+  request id and category, then apply sampling and rate limits. A dropped
+  record is never formatted.
+- The kept record goes onto a bounded queue, still unformatted.
+- A writer thread formats it as one JSON line (or text) and does the I/O.
+
+Logging from the event loop therefore costs a few attribute lookups and a
+queue put. If the writer falls behind, records are dropped and counted; the
+loop never waits.
+
+Formatting is deferred to the writer thread, so call sites should pass
+arguments ``logger.info("... %s", value)`` style rather than building
+f-strings. The message template is also the key for rate limiting, which is
+what lets "the same warning, again" be recognised.
+
+Categories default to the logger name. Per-request lines pass
+``extra={"category": "request"}`` so they can be sampled as a group.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional, TextIO
+
+from ..config import settings
+
+# The id of the request being handled, set by RequestIdMiddleware
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message", "asctime", "request_id", "category", "suppressed", "taskName",
+}
+# Rate-limit keys tracked before expired windows are pruned
+MAX_RATE_KEYS = 4096
+
+
+def new_request_id(candidate: Optional[str] = None) -> str:
+    """The client's id if it is safe to log, otherwise a fresh one"""
+    if candidate and REQUEST_ID_PATTERN.match(candidate):
+        return candidate
+    return uuid.uuid4().hex
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the request id and category while still on the caller's thread"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        if not hasattr(record, "category"):
+            record.category = record.name
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of records per category and caps repeats of the same warning"""
+
+    def __init__(self, sample_rates: Dict[str, float], rate_limit: int, rate_window: float):
+        super().__init__()
+        self.sample_rates = dict(sample_rates)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.sampled_out = 0
+        self.suppressed = 0
+        # (category, template) -> [window start, records let through, records suppressed]
+        self._windows: Dict[tuple, list] = {}
+        # Worker threads (asyncio.to_thread) log too
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Errors are never sampled or rate limited
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self.sample_rates.get(record.category)
+        if rate is not None and rate < 1 and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+        if record.levelno < logging.WARNING or self.rate_limit <= 0:
+            return True
+        return self._within_limit(record)
+
+    def _within_limit(self, record: logging.LogRecord) -> bool:
+        # The unformatted template, so repeats with different arguments share a key
+        key = (record.category, record.msg if isinstance(record.msg, str) else repr(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.rate_window:
+                if window is not None and window[2]:
+                    # The first record of a new window reports what the last one dropped
+                    record.suppressed = window[2]
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > MAX_RATE_KEYS:
+                    self._prune(now)
+                return True
+            if window[1] < self.rate_limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+    def _prune(self, now: float) -> None:
+        for key, window in list(self._windows.items()):
+            if now - window[0] >= self.rate_window:
+                del self._windows[key]
+        if len(self._windows) > MAX_RATE_KEYS:
+            self._windows.clear()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted and drops them, counted, when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stdlib version formats the message here, on the event loop; the writer
+        # thread does it instead. Arguments are read later, so they must not be mutated.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        category = getattr(record, "category", record.name)
+        if category != record.name:
+            entry["category"] = category
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines with the request id"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not getattr(record, "request_id", None):
+            record.request_id = "-"
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" ({record.suppressed} similar suppressed)"
+        return line
+
+
+class LogPipeline:
+    """Filters and a queue on the caller's side, a writer thread on the other"""
+
+    def __init__(
+        self,
+        stream: Optional[TextIO] = None,
+        level: Optional[str] = None,
+        log_format: Optional[str] = None,
+        queue_size: Optional[int] = None,
+        sample_rates: Optional[Dict[str, float]] = None,
+        rate_limit: Optional[int] = None,
+        rate_window: Optional[float] = None,
+    ):
+        self.level = (level or settings.LOG_LEVEL).upper()
+        self.sampler = SamplingFilter(
+            settings.LOG_SAMPLE_RATES if sample_rates is None else sample_rates,
+            settings.LOG_RATE_LIMIT if rate_limit is None else rate_limit,
+            settings.LOG_RATE_WINDOW if rate_window is None else rate_window,
+        )
+        self.handler = NonBlockingQueueHandler(
+            queue.Queue(settings.LOG_QUEUE_SIZE if queue_size is None else queue_size)
+        )
+        self.handler.addFilter(ContextFilter())
+        self.handler.addFilter(self.sampler)
+
+        writer = logging.StreamHandler(stream)
+        log_format = log_format or settings.LOG_FORMAT
+        writer.setFormatter(JSONFormatter() if log_format == "json" else TextFormatter())
+        self.listener = logging.handlers.QueueListener(self.handler.queue, writer)
+        self._started = False
+
+    def install(self, logger: logging.Logger) -> None:
+        """Make this pipeline the only handler of ``logger``"""
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(self.handler)
+        logger.setLevel(self.level)
+        if not self._started:
+            self.listener.start()
+            self._started = True
+
+    def stop(self) -> None:
+        """Write out everything queued and stop the writer thread"""
+        if self._started:
+            self._started = False
+            self.listener.stop()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "sampled_out": self.sampler.sampled_out,
+            "suppressed": self.sampler.suppressed,
+        }
+
+
+# Process-wide pipeline, set by configure_logging()
+log_pipeline: Optional[LogPipeline] = None
+
+
+def configure_logging() -> LogPipeline:
+    """Route the root logger, and uvicorn's, through a fresh pipeline"""
+    global log_pipeline
+    if log_pipeline is not None:
+        log_pipeline.stop()
+    log_pipeline = LogPipeline()
+    log_pipeline.install(logging.getLogger())
+    # uvicorn sets up its own blocking handlers before importing the app; send its
+    # records, including the per-request access log, through the pipeline as well
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    return log_pipeline
+
+
+@atexit.register
+def _flush_on_exit() -> None:
+    if log_pipeline is not None:
+        log_pipeline.stop()
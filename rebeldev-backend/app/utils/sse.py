@@ -0,0 +1,175 @@
+"""
+Server-Sent Events encoding for chat streams.
+
+``encode_chunks`` is the original one-frame-per-token format. ``encode_batched``
+coalesces tokens into frames by time window or byte threshold, builds frames
+from prebuilt byte templates instead of Pydantic models, and only attaches
+metadata to the final frame.
+"""
+
+import asyncio
+import json
+import time
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+from fastapi.responses import StreamingResponse
+
+from ..models.schemas import StreamChunk, StreamOptions
+
+DONE_FRAME = b"data: [DONE]\n\n"
+
+_FRAME_PREFIX = b'data: {"content":'
+_FRAME_PARTIAL = b',"done":false}\n\n'
+_FRAME_FINAL = b',"done":true,"metadata":'
+_FRAME_END = b"}\n\n"
+
+# C-accelerated JSON string escaping from the stdlib encoder
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def frame(content: str, done: bool = False, metadata: Optional[dict] = None) -> bytes:
+    """Encode one SSE frame without going through a Pydantic model"""
+    body = _encode_string(content).encode("ascii")
+    if not done:
+        return _FRAME_PREFIX + body + _FRAME_PARTIAL
+    meta = json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+    return _FRAME_PREFIX + body + _FRAME_FINAL + meta + _FRAME_END
+
+
+def error_frame(error: Exception) -> bytes:
+    return b"data: " + json.dumps({"error": str(error)}).encode("utf-8") + b"\n\n"
+
+
+async def _close(source: AsyncIterator) -> None:
+    # Close the upstream promptly rather than leaving it to the GC
+    aclose = getattr(source, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def encode_chunks(source: AsyncIterator[StreamChunk]) -> AsyncGenerator[str, None]:
+    """One frame per chunk, each carrying its metadata (original format)"""
+    try:
+        async for chunk in source:
+            yield f"data: {json.dumps(chunk.model_dump())}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        await _close(source)
+
+
+class _Batch:
+    """Token buffer shared between the upstream reader and the frame writer"""
+
+    def __init__(self, flush_bytes: int):
+        self.flush_bytes = flush_bytes
+        self.parts = []
+        self.size = 0
+        self.deadline: Optional[float] = None
+        self.final: Optional[StreamChunk] = None
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self.has_data = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.drained = asyncio.Event()
+
+    def take(self) -> str:
+        content = "".join(self.parts)
+        self.parts, self.size, self.deadline = [], 0, None
+        self.has_data.clear()
+        self.ready.clear()
+        self.drained.set()
+        return content
+
+
+async def _read_into(batch: _Batch, source: AsyncIterator[StreamChunk], interval: float) -> None:
+    try:
+        async for chunk in source:
+            if chunk.done:
+                batch.parts.append(chunk.content)
+                batch.final = chunk
+                break
+            if not chunk.content:
+                continue
+
+            batch.parts.append(chunk.content)
+            batch.size += len(chunk.content)
+            if batch.deadline is None:
+                batch.deadline = time.monotonic() + interval
+                batch.has_data.set()
+            if batch.size >= batch.flush_bytes:
+                # Full frame buffered; wait for the writer before reading further
+                batch.drained.clear()
+                batch.ready.set()
+                await batch.drained.wait()
+    except Exception as e:
+        batch.error = e
+    finally:
+        await _close(source)
+        batch.finished = True
+        batch.has_data.set()
+        batch.ready.set()
+
+
+async def encode_batched(
+    source: AsyncIterator[StreamChunk], options: StreamOptions
+) -> AsyncGenerator[bytes, None]:
+    """
+    Coalesce chunks into frames.
+
+    A frame is flushed once ``flush_bytes`` of content is buffered or the oldest
+    buffered token is ``flush_interval_ms`` old, whichever comes first. Upstream
+    chunks are read by a separate task, so a stalled upstream never holds back
+    tokens that were already produced and no task is created per token.
+    """
+    interval = options.flush_interval_ms / 1000
+    batch = _Batch(options.flush_bytes)
+    reader = asyncio.create_task(_read_into(batch, source, interval))
+
+    try:
+        while True:
+            await batch.has_data.wait()
+            if not batch.ready.is_set() and batch.deadline is not None:
+                timeout = batch.deadline - time.monotonic()
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(batch.ready.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+            finished = batch.finished
+            content = batch.take()
+            if finished:
+                if batch.error is not None:
+                    if content:
+                        yield frame(content)
+                    raise batch.error
+                if batch.final is not None:
+                    yield frame(content, done=True, metadata=batch.final.metadata)
+                elif content:
+                    yield frame(content)
+                break
+            if content:
+                yield frame(content)
+
+        yield DONE_FRAME
+    finally:
+        if not reader.done():
+            reader.cancel()
+            # Wait for the reader so the upstream is closed before we return
+            await asyncio.gather(reader, return_exceptions=True)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its body iterator when it ends.
+
+    Starlette cancels the sending task when the client disconnects, but a
+    generator suspended at ``yield`` is only finalized later by the GC. Closing
+    it here runs its ``finally`` blocks (and aborts the upstream request) at once.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await _close(self.body_iterator)
@@ -3,22 +3,67 @@ Main FastAPI application for OG-Ollama-UI backend
 Provides API endpoints for chat functionality with multiple AI providers
 """
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import uvicorn
+import asyncio
 import logging
 
-from .routers import chat
+from .routers import batch, chat, conversations, diagnostics, jobs, metrics
 from .config import settings
-from .services.ollama import OllamaService
-from .services.openai import OpenAIService
-from .services.perplex import PerplexityService
-
-# Initialize logging
-logging.basicConfig(level=settings.LOG_LEVEL)
+from .services.transport import http_transport
+from .services.batch import batch_runner
+from .services.cache import response_cache
+from .services.conversations import conversation_store
+from .services.diagnostics import loop_monitor
+from .services.jobs import job_manager
+from .services.tracing import tracer
+from .middleware.ratelimit import RateLimitMiddleware, create_store
+from .middleware.request_id import RequestIdMiddleware
+from .middleware.tracing import TracingMiddleware
+from .utils.logging import configure_logging
+
+# Initialize logging; records are written by a background thread
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# Rate limit buckets; closed with the app
+rate_limit_store = create_store()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared HTTP pool on startup and close it on shutdown"""
+    await tracer.exporter.start()
+    loop_monitor.start()
+    await http_transport.start()
+    ollama_service = chat.SERVICE_REGISTRY["ollama"]
+    ollama_service.start()
+    chat.health_monitor.start()
+    job_manager.start(jobs.run_job)
+    # Fill the model catalog in the background so the first /api/models is warm
+    warm_catalog = asyncio.create_task(chat.model_catalog.warm())
+    try:
+        yield
+    finally:
+        logger.info("Shutting down... closing HTTP connection pool.")
+        warm_catalog.cancel()
+        await job_manager.stop()
+        await batch_runner.close()
+        await chat.health_monitor.stop()
+        await chat.context_window.close()
+        await ollama_service.close()
+        await http_transport.close()
+        response_cache.close()
+        conversation_store.close()
+        job_manager.close()
+        rate_limit_store.close()
+        await tracer.exporter.close()
+        await loop_monitor.stop()
+
+
 # Create FastAPI app
 app = FastAPI(
     title="OG-Ollama-UI API",
@@ -26,8 +71,20 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
+# Rate limiting sits inside CORS so rejections still carry CORS headers
+if settings.RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware, store=rate_limit_store)
+
+# Tracing wraps rate limiting so rejected requests are traced too
+if settings.TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
+
+# Request ids wrap everything below so rejections and traces can be correlated with logs
+app.add_middleware(RequestIdMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -39,20 +96,13 @@ app.add_middleware(
 
 # Include routers
 app.include_router(chat.router, prefix="/api", tags=["chat"])
-
-# Service instances (shared)
-ollama_service = OllamaService()
-openai_service = OpenAIService()
-perplexity_service = PerplexityService()
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Gracefully close services"""
-    logger.info("Shutting down... closing HTTP sessions.")
-    await ollama_service.close()
-    await openai_service.close()
-    await perplexity_service.close()
+app.include_router(conversations.router, prefix="/api", tags=["conversations"])
+app.include_router(batch.router, prefix="/api", tags=["batch"])
+app.include_router(jobs.router, prefix="/api", tags=["jobs"])
+# Scraped outside /api so it is not rate limited
+app.include_router(metrics.router, tags=["metrics"])
+# Operator endpoints, also outside /api; off unless DIAGNOSTICS_ENABLED
+app.include_router(diagnostics.router, prefix="/admin", tags=["diagnostics"])
 
 
 @app.get("/")
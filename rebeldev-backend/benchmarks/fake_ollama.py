@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Fake Ollama server for benchmarks.
+
+Serves /api/chat (streamed and not), /api/generate, /api/tags and /api/ps
+with a configurable time to first token, generation speed and failure rate,
+so the proxy can be load-tested without a GPU. Run it on its own to point a
+dev server at it:
+
+    python -m benchmarks.fake_ollama --port 11434 --ttft 0.2 --tokens-per-sec 40
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Iterable, Optional
+
+from aiohttp import web
+
+
+def tagged(name: str) -> str:
+    """Real Ollama lists untagged models with their implicit ":latest" tag"""
+    return name if ":" in name else f"{name}:latest"
+
+
+class FakeOllama:
+    """Ollama stand-in with synthetic timing"""
+
+    def __init__(
+        self,
+        ttft: float = 0.1,
+        tokens_per_sec: float = 50.0,
+        tokens: int = 64,
+        failure_rate: float = 0.0,
+        failure_status: int = 500,
+        models: Iterable[str] = ("llama3.2",),
+        seed: Optional[int] = None,
+    ):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.models = list(models)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.tokens_sent = 0
+        self.open_streams = 0
+        self.peak_streams = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    def _fails(self) -> bool:
+        return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+    def _done_record(self, model: str, started: float, first: float) -> dict:
+        now = time.perf_counter()
+        return {
+            "model": model,
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "prompt_eval_count": 32,
+            "eval_count": self.tokens,
+            "load_duration": 0,
+            "prompt_eval_duration": int((first - started) * 1e9),
+            "eval_duration": int((now - first) * 1e9),
+            "total_duration": int((now - started) * 1e9),
+        }
+
+    async def _generate(self, emit) -> float:
+        """Wait out the TTFT, then emit tokens at the configured rate; returns first-token time"""
+        await asyncio.sleep(self.ttft)
+        first = time.perf_counter()
+        interval = 1 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0
+        for index in range(self.tokens):
+            # Sleep to a schedule rather than per token, so timer overshoot does not add up
+            delay = first + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await emit(f" tok{index}")
+            self.tokens_sent += 1
+        return first
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        model = body.get("model", "llama3.2")
+        if self._fails():
+            self.failures += 1
+            return web.Response(status=self.failure_status, text="injected failure")
+
+        started = time.perf_counter()
+        if not body.get("stream"):
+            parts = []
+
+            async def collect(token: str) -> None:
+                parts.append(token)
+
+            first = await self._generate(collect)
+            record = self._done_record(model, started, first)
+            record["message"]["content"] = "".join(parts)
+            return web.json_response(record)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        self.open_streams += 1
+        self.peak_streams = max(self.peak_streams, self.open_streams)
+        try:
+            async def send(token: str) -> None:
+                record = {
+                    "model": model,
+                    "message": {"role": "assistant", "content": token},
+                    "done": False,
+                }
+                await response.write((json.dumps(record) + "\n").encode())
+
+            first = await self._generate(send)
+            done = self._done_record(model, started, first)
+            await response.write((json.dumps(done) + "\n").encode())
+        except ConnectionResetError:
+            pass
+        finally:
+            self.open_streams -= 1
+        return response
+
+    async def generate(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"model": body.get("model"), "response": "", "done": True})
+
+    async def tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [
+            {"name": tagged(name), "size": 1, "modified_at": "2025-01-01T00:00:00Z"}
+            for name in self.models
+        ]})
+
+    async def ps(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": tagged(name)} for name in self.models]})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/api/chat", self.chat)
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_get("/api/tags", self.tags)
+        app.router.add_get("/api/ps", self.ps)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "tokens_sent": self.tokens_sent,
+            "peak_streams": self.peak_streams,
+        }
+
+
+async def serve(args: argparse.Namespace) -> None:
+    fake = FakeOllama(
+        ttft=args.ttft,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+        failure_rate=args.failure_rate,
+        models=args.models,
+    )
+    url = await fake.start(args.host, args.port)
+    print(f"Fake Ollama listening on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--ttft", type=float, default=0.1, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per reply")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="share of requests failing with 500"
+    )
+    parser.add_argument("--models", nargs="+", default=["llama3.2"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
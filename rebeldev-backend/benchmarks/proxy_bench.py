@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Proxy load test against a fake Ollama.
+
+Starts benchmarks.fake_ollama and the API in a subprocess, then drives the
+/api/chat, /api/chat/stream and /api/models scenarios at each concurrency level.
+It reports latency and time-to-first-token percentiles, throughput, the peak
+number of streams held open, and the proxy's CPU time per token. The report
+is written as JSON so runs can be compared in CI. Run from the backend
+directory:
+
+    python -m benchmarks.proxy_bench --concurrency 1 8 32 --requests 200 --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from .fake_ollama import FakeOllama, add_arguments
+
+SCENARIOS = ("chat", "stream", "models")
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(samples: List[float]) -> Optional[Dict[str, float]]:
+    """p50/p95/p99 (nearest rank), mean and max, in milliseconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(math.ceil(p * len(ordered)) - 1, 0))]
+
+    return {
+        "p50_ms": round(rank(0.50) * 1000, 2),
+        "p95_ms": round(rank(0.95) * 1000, 2),
+        "p99_ms": round(rank(0.99) * 1000, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+class Sample:
+    """Outcome of one request"""
+
+    __slots__ = ("latency", "ttft", "tokens", "error")
+
+    def __init__(self, latency: float, ttft: Optional[float] = None, tokens: int = 0,
+                 error: Optional[str] = None):
+        self.latency = latency
+        self.ttft = ttft
+        self.tokens = tokens
+        self.error = error
+
+
+class LoadRunner:
+    """Runs one scenario at a fixed concurrency against a running proxy"""
+
+    def __init__(self, base_url: str, model: str = "llama3.2"):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.open_streams = 0
+        self.peak_streams = 0
+        self._seq = 0
+
+    def _payload(self, stream: bool) -> dict:
+        # A distinct message per request keeps the cache and coalescing out of the numbers
+        self._seq += 1
+        return {"message": f"benchmark {self._seq}", "model": self.model, "stream": stream}
+
+    async def chat(self, session: aiohttp.ClientSession) -> Sample:
+        started = time.perf_counter()
+        async with session.post(f"{self.base_url}/api/chat", json=self._payload(False)) as response:
+            body = await response.read()
+            latency = time.perf_counter() - started
+            if response.status != 200:
+                return Sample(latency, error=f"http_{response.status}")
+        usage = json.loads(body).get("usage") or {}
+        return Sample(latency, tokens=usage.get("completion_tokens", 0))
+
+    async def stream(self, session: aiohttp.ClientSession) -> Sample:
+        started = time.perf_counter()
+        ttft = None
+        frames = 0
+        tokens = None
+        async with session.post(
+            f"{self.base_url}/api/chat/stream", json=self._payload(True)
+        ) as response:
+            if response.status != 200:
+                await response.read()
+                return Sample(time.perf_counter() - started, error=f"http_{response.status}")
+            self.open_streams += 1
+            self.peak_streams = max(self.peak_streams, self.open_streams)
+            try:
+                async for line in response.content:
+                    if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                        continue
+                    chunk = json.loads(line[6:])
+                    if "error" in chunk:
+                        return Sample(time.perf_counter() - started, ttft, frames, "stream_error")
+                    if chunk.get("content"):
+                        frames += 1
+                        if ttft is None:
+                            ttft = time.perf_counter() - started
+                    if chunk.get("done"):
+                        tokens = (chunk.get("metadata") or {}).get("eval_count")
+            finally:
+                self.open_streams -= 1
+        # Batched frames carry several tokens; prefer the upstream's count
+        return Sample(time.perf_counter() - started, ttft, tokens or frames)
+
+    async def models(self, session: aiohttp.ClientSession) -> Sample:
+        started = time.perf_counter()
+        async with session.get(f"{self.base_url}/api/models") as response:
+            await response.read()
+            latency = time.perf_counter() - started
+            return Sample(latency, error=None if response.status == 200 else f"http_{response.status}")
+
+    async def run(self, scenario: str, concurrency: int, requests: int) -> List[Sample]:
+        call = getattr(self, scenario)
+        remaining = requests
+        samples: List[Sample] = []
+        self.peak_streams = 0
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=600)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def worker() -> None:
+                nonlocal remaining
+                while remaining > 0:
+                    remaining -= 1
+                    started = time.perf_counter()
+                    try:
+                        samples.append(await call(session))
+                    except Exception as e:
+                        samples.append(Sample(time.perf_counter() - started, error=type(e).__name__))
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return samples
+
+
+def summarize(samples: List[Sample], elapsed: float, cpu: Optional[float], peak: int) -> dict:
+    ok = [s for s in samples if s.error is None]
+    errors: Dict[str, int] = {}
+    for sample in samples:
+        if sample.error is not None:
+            errors[sample.error] = errors.get(sample.error, 0) + 1
+    tokens = sum(s.tokens for s in ok)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_sec": round(len(ok) / elapsed, 2) if elapsed else None,
+        "latency": percentiles([s.latency for s in ok]),
+        "ttft": percentiles([s.ttft for s in ok if s.ttft is not None]),
+        "tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 1) if elapsed else None,
+        "peak_open_streams": peak,
+        "proxy_cpu_s": round(cpu, 4) if cpu is not None else None,
+        "proxy_cpu_us_per_token": round(cpu / tokens * 1e6, 2) if cpu is not None and tokens else None,
+        "proxy_cpu_us_per_request": round(cpu / len(samples) * 1e6, 1) if cpu is not None and samples else None,
+    }
+
+
+class ProxyProcess:
+    """The API under test, run by uvicorn in a child process"""
+
+    def __init__(self, ollama_url: str, concurrency: int, env: Dict[str, str]):
+        self.port = self._free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        # The child's working directory, so its SQLite files (cache, rate limit)
+        # neither land in the source tree nor carry over between runs
+        self.workdir = tempfile.mkdtemp(prefix="bench-")
+        self.env = {
+            **os.environ,
+            "OLLAMA_BASE_URL": ollama_url,
+            "LOG_LEVEL": "WARNING",
+            # Measure the proxy path, not the protective limits in front of it
+            "RATE_LIMIT_ENABLED": "false",
+            "TOKEN_BUDGET_ENABLED": "false",
+            "RESPONSE_CACHE_ENABLED": "false",
+            "SCHEDULER_SLOTS_PER_MODEL": str(concurrency),
+            "SCHEDULER_MAX_QUEUE_PER_MODEL": str(concurrency * 4),
+            "JOB_QUEUE_STORE": "memory",
+            "CONVERSATION_SQLITE_PATH": "",
+            **env,
+        }
+        self.process: Optional[subprocess.Popen] = None
+
+    @staticmethod
+    def _free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    async def start(self) -> None:
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "app.wh0dini_AI_main:app",
+                "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning",
+                "--no-access-log", "--app-dir", BACKEND_DIR,
+            ],
+            cwd=self.workdir,
+            env=self.env,
+        )
+        deadline = time.monotonic() + 30
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Proxy exited with code {self.process.returncode}")
+                try:
+                    async with session.get(f"{self.url}/health") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+        raise RuntimeError("Proxy did not start within 30s")
+
+    def cpu_seconds(self) -> Optional[float]:
+        """User + system CPU time of the proxy so far (Linux only)"""
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+async def run_scenarios(runner: LoadRunner, proxy: Optional[ProxyProcess], scenarios: List[str],
+                        levels: List[int], requests: int) -> List[dict]:
+    results = []
+    for scenario in scenarios:
+        for concurrency in levels:
+            cpu_before = proxy.cpu_seconds() if proxy else None
+            started = time.perf_counter()
+            samples = await runner.run(scenario, concurrency, requests)
+            elapsed = time.perf_counter() - started
+            cpu_after = proxy.cpu_seconds() if proxy else None
+            cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+            result = {
+                "scenario": scenario,
+                "concurrency": concurrency,
+                **summarize(samples, elapsed, cpu, runner.peak_streams),
+            }
+            print(
+                f"[Bench] {scenario:<6} c={concurrency:<4} "
+                f"p50={(result['latency'] or {}).get('p50_ms')}ms "
+                f"p99={(result['latency'] or {}).get('p99_ms')}ms "
+                f"errors={sum(result['errors'].values())}",
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+async def main(args: argparse.Namespace) -> dict:
+    fake = FakeOllama(
+        ttft=args.ttft,
+        tokens_per_sec=args.tokens_per_sec,
+        tokens=args.tokens,
+        failure_rate=args.failure_rate,
+        models=args.models,
+        seed=0,
+    )
+    ollama_url = await fake.start()
+    env = dict(item.split("=", 1) for item in args.env)
+    proxy = ProxyProcess(ollama_url, max(args.concurrency), env) if args.proxy_url is None else None
+    try:
+        if proxy is not None:
+            await proxy.start()
+        runner = LoadRunner(args.proxy_url or proxy.url, model=args.models[0])
+        # One untimed round so connection setup and catalog loading are not measured
+        await runner.run("chat", 1, 2)
+        results = await run_scenarios(
+            runner, proxy, args.scenarios, args.concurrency, args.requests
+        )
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        await fake.stop()
+
+    return {
+        "config": {
+            "requests_per_level": args.requests,
+            "concurrency": args.concurrency,
+            "upstream": {
+                "ttft_s": args.ttft,
+                "tokens_per_sec": args.tokens_per_sec,
+                "tokens": args.tokens,
+                "failure_rate": args.failure_rate,
+            },
+            "env": env,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "upstream_stats": fake.stats(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario and level")
+    parser.add_argument("--proxy-url", help="benchmark an already running API instead of starting one")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="extra settings for the proxy process")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    add_arguments(parser)
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+SSE encoding benchmark: per-token frames vs. batched frames.
+
+Feeds a synthetic token stream through both encoders and reports frames/sec,
+CPU time per token and bytes written. Run from the backend directory:
+
+    python -m benchmarks.sse_bench --tokens 200000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from app.models.schemas import StreamChunk, StreamOptions
+from app.utils import sse
+
+
+async def token_source(count: int, metadata: dict):
+    for i in range(count):
+        # Per-token metadata, as the Ollama service produces it
+        yield StreamChunk(content=" tok", done=False, metadata=metadata)
+    yield StreamChunk(content="", done=True, metadata=metadata)
+
+
+async def run(encoder, count: int) -> dict:
+    metadata = {"model": "llama3.2", "eval_count": None, "eval_duration": None}
+    frames = 0
+    written = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    async for data in encoder(token_source(count, metadata)):
+        frames += 1
+        written += len(data)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    return {
+        "tokens": count,
+        "frames": frames,
+        "bytes": written,
+        "frames_per_sec": round(frames / wall, 1),
+        "tokens_per_sec": round(count / wall, 1),
+        "cpu_us_per_token": round(cpu / count * 1e6, 3),
+    }
+
+
+async def main(count: int, flush_bytes: int) -> dict:
+    options = StreamOptions(flush_interval_ms=1000, flush_bytes=flush_bytes)
+    before = await run(sse.encode_chunks, count)
+    after = await run(lambda source: sse.encode_batched(source, options), count)
+    return {
+        "per_token": before,
+        "batched": after,
+        "cpu_per_token_speedup": round(before["cpu_us_per_token"] / after["cpu_us_per_token"], 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=100_000)
+    parser.add_argument("--flush-bytes", type=int, default=256)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(main(args.tokens, args.flush_bytes)), indent=2))
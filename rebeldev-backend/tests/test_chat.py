@@ -1 +1,1861 @@
 # Tests for chat functionality
+
+import asyncio
+import io
+import json
+import logging
+import threading
+import time
+from collections import Counter
+
+import pytest
+from aiohttp import web
+from fastapi import FastAPI, HTTPException, Request, Response
+
+from app.models.schemas import (
+    ChatMessage,
+    ChatRequest,
+    ChatResponse,
+    StreamChunk,
+    StreamOptions,
+)
+from app.routers import chat
+from app.routers import diagnostics
+from app.routers.batch import parse_batch
+from app.services import ollama as ollama_service
+from app.services import timeouts
+from app.services.batch import BatchRejected, BatchRunner
+from app.services.cache import ResponseCache, SQLiteTier, canonical_request_key
+from app.services.catalog import ModelCatalog, etag_matches
+from app.services.coalescer import RequestCoalescer
+from app.services.context import ContextWindow
+from app.services.diagnostics import LoopMonitor, ProfilerError, SamplingProfiler
+from app.services.conversations import Conversation, ConversationStore
+from app.services.failover import ProviderFailover, TTFTStats
+from app.services.health import HealthMonitor, ProviderUnavailable
+from app.services.jobs import JobManager, SQLiteJobQueue
+from app.services.metrics import error_class, metrics, record_error
+from app.services.ollama import OllamaService
+from app.services.ollama_pool import OllamaNodePool
+from app.services.openai import OpenAIService
+from app.services.quota import QuotaExceeded, TokenQuota
+from app.services.residency import ModelResidency
+from app.services.scheduler import (
+    ModelScheduler,
+    ProviderScheduler,
+    SchedulerRejected,
+    model_scheduler,
+)
+from app.services.streams import stream_monitor
+from app.services.tracing import InMemorySpanExporter, tracer
+from app.services.transport import HTTPTransport
+from app.middleware.ratelimit import (
+    MemoryRateLimitStore,
+    RateLimitMiddleware,
+    RateLimitStore,
+    SQLiteRateLimitStore,
+    client_key,
+)
+from app.middleware.request_id import RequestIdMiddleware
+from app.middleware.tracing import TracingMiddleware
+from app.utils import sse
+from app.utils.logging import LogPipeline, request_id
+from app.config import settings
+
+
+def tagged(name):
+    """Ollama lists untagged models with their implicit ":latest" tag"""
+    return name if ":" in name else f"{name}:latest"
+
+
+class FakeOllama:
+    """Minimal local stand-in for an Ollama node"""
+
+    def __init__(
+        self,
+        reply="Hello world",
+        loaded=(),
+        available=("llama3.2",),
+        status=200,
+        delay=0.0,
+        first_delay=0.0,
+        send_done=True,
+    ):
+        self.reply = reply
+        self.loaded = list(loaded)
+        self.available = list(available)
+        self.status = status
+        self.delay = delay
+        self.first_delay = first_delay
+        self.send_done = send_done
+        self.calls = 0
+        self.sent = 0
+        self.keep_alives = []
+        self.last_body = None
+        self.traceparent = None
+        self.aborted = asyncio.Event()
+        self.aborted_at = None
+        self.runner = None
+        self.url = None
+
+    async def chat(self, request):
+        self.calls += 1
+        self.traceparent = request.headers.get("traceparent")
+        body = await request.json()
+        if self.status != 200:
+            return web.Response(status=self.status, text="boom")
+        self.keep_alives.append(body.get("keep_alive"))
+        self.last_body = body
+
+        if self.first_delay:
+            # Hang before sending anything, like a node stuck loading a model
+            await asyncio.sleep(self.first_delay)
+        if not body.get("stream"):
+            return web.json_response({
+                "model": body["model"],
+                "message": {"role": "assistant", "content": self.reply},
+                "done": True,
+                "prompt_eval_count": 5,
+                "eval_count": 2,
+                "load_duration": 2_000_000,
+            })
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+        try:
+            for token in self.reply.split(" "):
+                record = {"message": {"role": "assistant", "content": token}, "done": False}
+                await response.write((json.dumps(record) + "\n").encode())
+                self.sent += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+        except ConnectionResetError:
+            # The proxy hung up on us mid-generation
+            self.aborted_at = asyncio.get_running_loop().time()
+            self.aborted.set()
+            return response
+        if not self.send_done:
+            return response
+        done = {"message": {"role": "assistant", "content": ""}, "done": True, "eval_count": 2}
+        await response.write((json.dumps(done) + "\n").encode())
+        return response
+
+    async def generate(self, request):
+        # Prompt-less generate: load the model, or unload it with keep_alive=0
+        body = await request.json()
+        self.keep_alives.append(body.get("keep_alive"))
+        if body.get("keep_alive") == 0:
+            self.loaded = [name for name in self.loaded if name != body["model"]]
+        elif body["model"] not in self.loaded:
+            self.loaded.append(body["model"])
+        return web.json_response({"model": body["model"], "done": True, "load_duration": 900_000_000})
+
+    async def ps(self, request):
+        return web.json_response({"models": [{"name": tagged(name)} for name in self.loaded]})
+
+    async def tags(self, request):
+        return web.json_response({"models": [{"name": tagged(name)} for name in self.available]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/api/chat", self.chat)
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_get("/api/ps", self.ps)
+        app.router.add_get("/api/tags", self.tags)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeOpenAI:
+    """OpenAI-compatible /chat/completions endpoint"""
+
+    def __init__(self, reply="Hi from OpenAI"):
+        self.reply = reply
+        self.calls = 0
+        self.runner = None
+        self.url = None
+
+    async def completions(self, request):
+        self.calls += 1
+        body = await request.json()
+        if not body.get("stream"):
+            return web.json_response({
+                "model": body["model"],
+                "choices": [{"message": {"content": self.reply}, "finish_reason": "stop"}],
+                "usage": {"total_tokens": 3},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        first, *rest = self.reply.split(" ")
+        for token in [first] + [" " + word for word in rest]:
+            event = {"model": body["model"], "choices": [{"delta": {"content": token}}]}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def make_service(urls, **pool_options):
+    transport = HTTPTransport()
+    await transport.start()
+    pool = OllamaNodePool(urls, transport=transport, probe_interval=0, **pool_options)
+    return OllamaService(transport=transport, nodes=pool), transport
+
+
+async def call_app(app, method, target, headers=(), body=None):
+    """One request over ASGI, with an optional JSON body; returns status, headers and body"""
+    path, _, query = target.partition("?")
+    response = {"body": b""}
+    payload = b"" if body is None else json.dumps(body).encode()
+    if body is not None:
+        headers = [(b"content-type", b"application/json"), *headers]
+
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if body_sent:
+            # The client stays connected until the response is complete
+            await asyncio.Event().wait()
+        body_sent = True
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = dict(message["headers"])
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": list(headers),
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+def chat_app():
+    app = FastAPI()
+    app.include_router(chat.router, prefix="/api")
+    return app
+
+
+def test_ollama_turns_share_a_byte_identical_message_prefix():
+    async def scenario():
+        upstream = await FakeOllama(reply="Hello world").start()
+        service, transport = await make_service([upstream.url])
+        try:
+            first = await service.chat_completion(
+                ChatRequest(message="hi", system_prompt="Be brief", temperature=0)
+            )
+            sent_first = upstream.last_body["messages"]
+            second = await service.chat_completion(ChatRequest(
+                message="and then?",
+                system_prompt="Be brief",
+                temperature=0,
+                history=[
+                    ChatMessage(role="user", content="hi"),
+                    ChatMessage(role="assistant", content=first.message),
+                ],
+            ))
+            sent_second = upstream.last_body["messages"]
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+        assert sent_first == [
+            {"role": "system", "content": "Be brief"},
+            {"role": "user", "content": "hi"},
+        ]
+        # The second turn extends the first one's messages instead of rewriting them
+        assert sent_second[:2] == sent_first
+        assert sent_second[2:] == [
+            {"role": "assistant", "content": "Hello world"},
+            {"role": "user", "content": "and then?"},
+        ]
+        assert first.metadata["api_mode"] == "chat"
+        assert first.metadata["prefix_reuse_ratio"] == 0
+        assert second.metadata["prefix_reuse_ratio"] > 0.5
+
+    asyncio.run(scenario())
+
+
+def test_providers_share_one_pooled_transport():
+    async def scenario():
+        ollama = await FakeOllama().start()
+        openai = await FakeOpenAI().start()
+        transport = HTTPTransport(limit=10)
+        with pytest.raises(RuntimeError):
+            transport.session
+        await transport.start()
+        await transport.start()  # idempotent
+        pool = OllamaNodePool([ollama.url], transport=transport, probe_interval=0)
+        service = OllamaService(transport=transport, nodes=pool)
+        openai_service = OpenAIService(transport=transport)
+        openai_service.api_key = "test-key"
+        openai_service.base_url = openai.url
+        try:
+            assert service.session is openai_service.session is transport.session
+            for _ in range(3):
+                await service.chat_completion(ChatRequest(message="hi"))
+            await openai_service.chat_completion(ChatRequest(message="hi", provider="openai"))
+            # Sequential calls reuse one keep-alive connection per upstream
+            stats = transport.stats()
+            assert stats["started"] and stats["acquired"] == 0 and stats["idle"] == 2
+        finally:
+            await transport.close()
+            await ollama.stop()
+            await openai.stop()
+
+        assert not transport.started and transport.stats()["started"] is False
+        await transport.close()  # closing twice is harmless
+
+    asyncio.run(scenario())
+
+
+def test_response_cache_hits_expires_and_bounds_disk(monkeypatch, tmp_path):
+    async def scenario():
+        upstream = await FakeOllama(reply="cached reply").start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        path = str(tmp_path / "cache.sqlite3")
+        cache = ResponseCache(enabled=True, max_entries=8, ttl=0.3, sqlite_path=path, max_temperature=0)
+        monkeypatch.setattr(chat, "response_cache", cache)
+        app = chat_app()
+        deterministic = {"message": "hi", "temperature": 0}
+
+        async def ask(body, headers=()):
+            status, headers, payload = await call_app(app, "POST", "/api/chat", headers, body)
+            assert status == 200
+            return headers.get(b"x-cache"), json.loads(payload)
+
+        try:
+            assert (await ask(deterministic))[0] == b"MISS"
+            cache_status, body = await ask(deterministic)
+            assert cache_status == b"HIT" and body["metadata"]["cached"] is True
+            assert body["message"] == "cached reply" and upstream.calls == 1
+            # Sampled requests are never cached; a bypass skips the lookup
+            assert (await ask({"message": "hi", "temperature": 0.7}))[0] is None
+            assert (await ask(deterministic, [(b"x-cache-bypass", b"1")]))[0] == b"BYPASS"
+            assert upstream.calls == 3
+
+            # A new process finds the entry on disk
+            restarted = ResponseCache(enabled=True, ttl=0.3, sqlite_path=path, max_temperature=0)
+            monkeypatch.setattr(chat, "response_cache", restarted)
+            assert (await ask(deterministic))[0] == b"HIT"
+            assert restarted.disk_hits == 1 and upstream.calls == 3
+            restarted.close()
+
+            await asyncio.sleep(0.35)
+            monkeypatch.setattr(chat, "response_cache", cache)
+            assert (await ask(deterministic))[0] == b"MISS" and upstream.calls == 4
+            assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+        finally:
+            cache.close()
+            await transport.close()
+            await upstream.stop()
+
+        # The disk tier stays within its cap, evicting the soonest-expiring rows in batches
+        disk = SQLiteTier(str(tmp_path / "bounded.sqlite3"), ttl=60, max_entries=10)
+        for n in range(25):
+            await disk.set(f"key{n}", f"value{n}")
+        rows = disk._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        assert rows <= 10 and rows == disk._rows
+        assert await disk.get("key24") == "value24" and await disk.get("key0") is None
+        disk.close()
+
+    asyncio.run(scenario())
+
+
+def test_identical_requests_share_one_admitted_upstream_call(monkeypatch):
+    async def scenario():
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 20), delay=0.01).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        coalescer = RequestCoalescer(enabled=True, max_temperature=1.0)
+        scheduler = ModelScheduler(enabled=True)
+        quota = TokenQuota(enabled=True, budget=100_000, window=3600)
+        monkeypatch.setattr(chat, "request_coalescer", coalescer)
+        monkeypatch.setattr(chat, "model_scheduler", scheduler)
+        monkeypatch.setattr(chat, "token_quota", quota)
+        monkeypatch.setattr(chat, "response_cache", ResponseCache(enabled=False))
+        app = chat_app()
+        ask = {"message": "hi"}
+        try:
+            replies = await asyncio.gather(
+                *(call_app(app, "POST", "/api/chat", body=ask) for _ in range(3))
+            )
+            assert [status for status, _, _ in replies] == [200] * 3
+            assert len({body for _, _, body in replies}) == 1
+            # One upstream call, one slot and one charge for three callers
+            assert upstream.calls == 1 and coalescer.leaders == 1 and coalescer.joined == 2
+            assert scheduler.for_provider("ollama").admitted == 1
+            charged = quota.charged
+            assert charged > 0
+            await call_app(app, "POST", "/api/chat", body=ask)
+            assert quota.charged == 2 * charged
+
+            # A joiner arriving mid-stream first replays what was already sent
+            leader = asyncio.create_task(call_app(app, "POST", "/api/chat/stream", body=ask))
+            await asyncio.sleep(0.08)
+            joiner = await call_app(app, "POST", "/api/chat/stream", body=ask)
+            leader = await leader
+            assert leader[0] == joiner[0] == 200 and leader[2] == joiner[2]
+            assert leader[2].count(b'"tok"') == 20 and upstream.calls == 3
+            assert scheduler.for_provider("ollama").admitted == 3
+
+            # Upstream is cancelled once the last subscriber hangs up
+            sent = upstream.sent
+            await asyncio.gather(
+                stream_until_disconnect(app, "/api/chat/stream", frames_before_disconnect=2),
+                stream_until_disconnect(app, "/api/chat/stream", frames_before_disconnect=3),
+            )
+            await asyncio.wait_for(upstream.aborted.wait(), timeout=2)
+            assert upstream.calls == 4 and upstream.sent - sent < 20
+
+            # A leader rejected by admission takes its joiners down with it
+            held = await scheduler.acquire("ollama", "llama3.2")
+            held_too = await scheduler.acquire("ollama", "llama3.2")
+            scheduler.for_provider("ollama").queue_timeout = 0.1
+            rejected, joined = await asyncio.gather(
+                call_app(app, "POST", "/api/chat/stream", body=ask),
+                call_app(app, "POST", "/api/chat/stream", body=ask),
+            )
+            held.release()
+            held_too.release()
+            assert rejected[0] == 503 and b"Retry-After".lower() in rejected[1]
+            assert joined[0] == 200 and b"Timed out waiting" in joined[2]
+            assert upstream.calls == 4 and coalescer.stats()["in_flight_streams"] == 0
+
+            # With scheduling disabled there is no lease, but the call still succeeds and is charged
+            monkeypatch.setattr(chat, "model_scheduler", ModelScheduler(enabled=False))
+            charged = quota.charged
+            status, _, body = await call_app(app, "POST", "/api/chat", body={"message": "unscheduled"})
+            assert status == 200 and b"tok" in body
+            assert upstream.calls == 5 and quota.charged > charged
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_prioritises_rejects_defers_swaps_and_lends_slots_to_flights(monkeypatch):
+    async def scenario():
+        scheduler = ProviderScheduler("ollama", slots_per_model=1, max_queue=2, queue_timeout=1)
+        held = await scheduler.acquire("llama3.2")
+        order = []
+
+        async def queued(priority, name):
+            async with await scheduler.acquire("llama3.2", priority):
+                order.append(name)
+
+        waiters = [asyncio.create_task(queued(-1, "low")), asyncio.create_task(queued(1, "high"))]
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerRejected) as full:
+            await scheduler.acquire("llama3.2")
+        assert full.value.status_code == 429 and full.value.retry_after >= 1
+        held.release()
+        await asyncio.gather(*waiters)
+        assert order == ["high", "low"]
+
+        scheduler.queue_timeout = 0.05
+        held = await scheduler.acquire("llama3.2")
+        with pytest.raises(SchedulerRejected) as waited:
+            await scheduler.acquire("llama3.2")
+        assert waited.value.status_code == 503 and scheduler.timed_out == 1
+        held.release()
+
+        swapper = ProviderScheduler(
+            "ollama", slots_per_model=2, max_queue=4, queue_timeout=1,
+            max_resident_models=1, swap_max_wait=0.1,
+        )
+        loaded = await swapper.acquire("llama3.2")
+        swap = asyncio.create_task(swapper.acquire("mistral"))
+        await asyncio.sleep(0)
+        # Requests for the loaded model go ahead of the swap...
+        (await swapper.acquire("llama3.2")).release()
+        assert not swap.done()
+        # ...until it has waited too long; then the loaded model drains
+        await asyncio.sleep(0.15)
+        late = asyncio.create_task(swapper.acquire("llama3.2"))
+        await asyncio.sleep(0)
+        assert not late.done()
+        loaded.release()
+        (await swap).release()
+        (await late).release()
+        assert swapper.swaps == 3
+        # Idle models, and the queues they waited in, are forgotten
+        assert swapper.stats()["models"] == {} and not swapper._queues
+
+        # The oldest waiter counts, even when a newer, higher-priority one tops the heap
+        loaded = await swapper.acquire("llama3.2")
+        old = asyncio.create_task(swapper.acquire("mistral", -1))
+        await asyncio.sleep(0.15)
+        new = asyncio.create_task(swapper.acquire("mistral", 5))
+        await asyncio.sleep(0)
+        assert swapper._draining()
+        loaded.release()
+        (await new).release()
+        (await old).release()
+
+        # The swap deadline is enforced even if nothing is acquired or released
+        nodes = 1
+        timed = ProviderScheduler(
+            "ollama", slots_per_model=1, max_queue=4, queue_timeout=1,
+            max_resident_models=1, swap_max_wait=0.1, nodes=lambda: nodes,
+        )
+        loaded = await timed.acquire("llama3.2")
+        swap = asyncio.create_task(timed.acquire("mistral"))
+        await asyncio.sleep(0)
+        nodes = 2  # a node came back: room for a second model, but no release to notice it
+        (await asyncio.wait_for(swap, 0.5)).release()
+        loaded.release()
+
+        # A coalesced stream keeps its slot while any subscriber is listening
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 10), delay=0.05).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        admission = ModelScheduler(enabled=True)
+        quota = TokenQuota(enabled=True, budget=100_000, window=3600)
+        monkeypatch.setattr(chat, "request_coalescer", RequestCoalescer(enabled=True, max_temperature=1))
+        monkeypatch.setattr(chat, "model_scheduler", admission)
+        monkeypatch.setattr(chat, "token_quota", quota)
+        monkeypatch.setattr(chat, "response_cache", ResponseCache(enabled=False))
+        app = chat_app()
+        try:
+            leader = asyncio.create_task(
+                stream_until_disconnect(app, "/api/chat/stream", frames_before_disconnect=2)
+            )
+            await asyncio.sleep(0.01)
+            joiner = asyncio.create_task(
+                call_app(app, "POST", "/api/chat/stream", body={"message": "hi"})
+            )
+            await leader
+            slots = admission.for_provider("ollama").stats()["models"]["llama3.2"]
+            assert slots["active"] == 1 and quota.charged == 0
+            status, _, body = await joiner
+            assert status == 200 and body.count(b'"tok"') == 10
+            # The slot is back and the idle model forgotten
+            assert "llama3.2" not in admission.for_provider("ollama").stats()["models"]
+            assert upstream.calls == 1 and not upstream.aborted.is_set()
+            # The leader's client pays once for the whole generation
+            assert quota.charged > 2
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_limits_scale_with_healthy_ollama_nodes():
+    async def scenario():
+        nodes = 2
+        scheduler = ProviderScheduler(
+            "ollama", slots_per_model=1, max_queue=4, queue_timeout=0.05,
+            max_resident_models=1, nodes=lambda: nodes,
+        )
+        # Two nodes: two slots for one model, and two models resident at once
+        first = await scheduler.acquire("llama3.2")
+        second = await scheduler.acquire("llama3.2")
+        other = await scheduler.acquire("mistral")
+        assert scheduler.swaps == 2 and scheduler.stats()["nodes"] == 2
+        with pytest.raises(SchedulerRejected):
+            await scheduler.acquire("llama3.2")
+        for lease in (first, second, other):
+            lease.release()
+
+        # Losing a node shrinks capacity again
+        nodes = 1
+        held = await scheduler.acquire("llama3.2")
+        with pytest.raises(SchedulerRejected):
+            await scheduler.acquire("llama3.2")
+        held.release()
+
+        # ":latest" is the same model, not a second resident one
+        admission = ModelScheduler(enabled=True)
+        plain = await admission.acquire("ollama", "llama3.2")
+        tagged_lease = await admission.acquire("ollama", "llama3.2:latest")
+        ollama = admission.for_provider("ollama")
+        assert ollama.swaps == 1 and ollama.stats()["models"]["llama3.2"]["active"] == 2
+        plain.release()
+        tagged_lease.release()
+
+    asyncio.run(scenario())
+
+
+def test_routes_to_node_with_model_loaded():
+    async def scenario():
+        cold = await FakeOllama(reply="cold").start()
+        warm = await FakeOllama(reply="warm", loaded=["llama3.2"]).start()
+        service, transport = await make_service([cold.url, warm.url])
+        try:
+            await service.nodes.probe_all()
+            # /api/ps says "llama3.2:latest"; requests may use either name
+            assert service.nodes.nodes[1].loaded_models == {"llama3.2"}
+            response = await service.chat_completion(ChatRequest(message="hi"))
+            assert response.message == "warm"
+            assert response.metadata["node"] == warm.url
+            assert service.nodes.pick("llama3.2:latest").url == warm.url
+            assert cold.calls == 0
+        finally:
+            await transport.close()
+            await cold.stop()
+            await warm.stop()
+
+    asyncio.run(scenario())
+
+
+def test_fails_over_and_ejects_dead_node():
+    async def scenario():
+        broken = await FakeOllama(status=500, loaded=["llama3.2"]).start()
+        healthy = await FakeOllama(reply="ok").start()
+        service, transport = await make_service(
+            [broken.url, healthy.url], max_failures=1, eject_seconds=60
+        )
+        try:
+            await service.nodes.probe_all()
+            response = await service.chat_completion(ChatRequest(message="hi"))
+            assert response.message == "ok"
+            assert broken.calls == 1
+
+            # The ejected node is skipped entirely on the next request
+            chunks = [c async for c in service.chat_completion_stream(ChatRequest(message="hi"))]
+            assert "".join(c.content for c in chunks) == "ok"
+            assert broken.calls == 1
+            assert not service.nodes.nodes[0].healthy
+
+            # An active probe re-admits the node once it answers again
+            await service.nodes.probe(service.nodes.nodes[0])
+            assert service.nodes.nodes[0].healthy
+        finally:
+            await transport.close()
+            await broken.stop()
+            await healthy.stop()
+
+    asyncio.run(scenario())
+
+
+def test_probe_failures_count_like_request_failures():
+    async def scenario():
+        gone = await FakeOllama().start()
+        await gone.stop()
+        service, transport = await make_service([gone.url], max_failures=3, eject_seconds=60)
+        node = service.nodes.nodes[0]
+        try:
+            assert not await service.nodes.probe(node)
+            # One blip does not eject the node...
+            assert node.healthy and node.consecutive_failures == 1
+            await service.nodes.probe(node)
+            await service.nodes.probe(node)
+            # ...but max_failures of them in a row do
+            assert not node.healthy and node.consecutive_failures == 3
+        finally:
+            await transport.close()
+
+    asyncio.run(scenario())
+
+
+def test_balances_on_outstanding_requests_without_affinity():
+    pool = OllamaNodePool(["http://a:11434", "http://b:11434"], probe_interval=0)
+    busy, idle = pool.nodes
+    pool.acquire(busy)
+    assert pool.pick("llama3.2") is idle
+    pool.release(busy)
+    busy.loaded_models.add("llama3.2")
+    pool.acquire(busy)
+    assert pool.pick("llama3.2") is busy
+
+
+def test_rate_limit_buckets_headers_keys_and_stream_caps(monkeypatch, tmp_path):
+    async def scenario():
+        release = asyncio.Event()
+
+        async def api(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            if scope["path"] == "/api/chat/stream":
+                await release.wait()
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        monkeypatch.setattr(settings, "AUTH_TOKEN", "secret")
+        monkeypatch.setattr(settings, "RATE_LIMIT_TRUST_FORWARDED", False)
+        limited = RateLimitMiddleware(
+            api, store=MemoryRateLimitStore(), requests=2, window=60, max_streams=1
+        )
+        statuses = []
+        for _ in range(3):
+            status, headers, _ = await call_app(limited, "GET", "/api/models")
+            statuses.append((status, headers[b"ratelimit-remaining"]))
+        assert statuses == [(200, b"1"), (200, b"0"), (429, b"0")]
+        assert int(headers[b"retry-after"]) >= 30 and headers[b"ratelimit-limit"] == b"2"
+
+        # Only the configured token earns its own bucket; made-up ones share the IP's
+        bogus = [(b"authorization", b"Bearer made-up")]
+        assert (await call_app(limited, "GET", "/api/models", bogus))[0] == 429
+        valid = [(b"authorization", b"Bearer secret")]
+        assert (await call_app(limited, "GET", "/api/models", valid))[0] == 200
+
+        streams = RateLimitMiddleware(
+            api, store=MemoryRateLimitStore(), requests=10, window=60, max_streams=1
+        )
+        stream = asyncio.create_task(call_app(streams, "POST", "/api/chat/stream"))
+        await asyncio.sleep(0.01)
+        status, _, body = await call_app(streams, "POST", "/api/chat/stream")
+        assert status == 429 and b"Too many concurrent streams" in body
+        release.set()
+        assert (await stream)[0] == 200 and streams.open_streams == {}
+
+        forwarded = [(b"x-forwarded-for", b"1.2.3.4, 10.0.0.7")]
+        scope = {"headers": forwarded, "client": ("127.0.0.1", 1)}
+        assert client_key(scope) == "ip:127.0.0.1"
+        monkeypatch.setattr(settings, "RATE_LIMIT_TRUST_FORWARDED", True)
+        assert client_key(scope) == "ip:10.0.0.7"
+
+        # The memory store evicts the least recently seen client past its cap
+        store = MemoryRateLimitStore(max_keys=2)
+        for key in ("a", "b", "a", "c"):
+            await store.hit(key, 5, 60)
+        assert list(store._buckets) == ["a", "c"]
+
+        # The SQLite store deletes buckets that have been idle long enough to refill
+        shared = SQLiteRateLimitStore(str(tmp_path / "ratelimit.sqlite3"))
+        await shared.hit("a", 5, 0.2)
+        await asyncio.sleep(0.25)
+        await shared.hit("b", 5, 0.2)
+        keys = [row[0] for row in shared._connect().execute("SELECT key FROM buckets")]
+        assert keys == ["b"]
+        shared.close()
+        with pytest.raises(TypeError):
+            RateLimitStore()
+
+    asyncio.run(scenario())
+
+
+def test_token_quota_charges_usage_and_aborted_streams(monkeypatch):
+    async def scenario():
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 200), delay=0.005).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        quota = TokenQuota(enabled=True, budget=520, window=3600)
+        monkeypatch.setattr(chat, "token_quota", quota)
+        monkeypatch.setattr(chat, "response_cache", ResponseCache(enabled=False))
+        app = chat_app()
+        try:
+            status, _, _ = await call_app(app, "POST", "/api/chat", body={"message": "hi"})
+            # prompt_eval_count + eval_count from the response
+            assert status == 200 and quota.charged == 7
+
+            # A stream the client abandons still pays for what was generated
+            await stream_until_disconnect(app, "/api/chat/stream", frames_before_disconnect=3)
+            assert quota.charged > 7
+            status, _, body = await call_app(app, "GET", "/api/quota")
+            assert json.loads(body)["remaining"] == 520 - quota.charged
+
+            # The next request's estimate (prompt + 512) no longer fits the budget
+            status, headers, _ = await call_app(app, "POST", "/api/chat", body={"message": "hi"})
+            assert status == 429 and int(headers[b"retry-after"]) >= 1
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+        # Full budgets are forgotten; the rest are capped, least recently charged first
+        bounded = TokenQuota(enabled=True, budget=100, window=0.05, max_clients=2)
+        assert bounded.remaining("idle") == 100 and not bounded._balances
+        for client in ("a", "b", "c"):
+            bounded.charge(client, 10)
+        assert list(bounded._balances) == ["b", "c"]
+        await asyncio.sleep(0.06)
+        bounded.charge("d", 10)
+        assert list(bounded._balances) == ["d"]
+
+    asyncio.run(scenario())
+
+
+def test_batched_sse_frames_by_size_and_time_with_metadata_last(monkeypatch):
+    async def tokens(*items, pause_after=None, fail=False):
+        for n, content in enumerate(items):
+            yield StreamChunk(content=content, done=False)
+            if n == pause_after:
+                await asyncio.sleep(0.05)
+        if fail:
+            raise RuntimeError("upstream broke")
+        yield StreamChunk(content="", done=True, metadata={"eval_count": len(items)})
+
+    def events(frames):
+        return [json.loads(f[len(b"data: "):]) for f in frames if f != sse.DONE_FRAME]
+
+    async def collect(source, **options):
+        return [f async for f in sse.encode_batched(source, StreamOptions(**options))]
+
+    async def scenario():
+        # Four content bytes per frame; the time window never expires
+        frames = await collect(
+            tokens("ab", "cd", "ef", "g"), flush_bytes=4, flush_interval_ms=10_000
+        )
+        assert frames[-1] == sse.DONE_FRAME
+        assert [e["content"] for e in events(frames)] == ["abcd", "efg"]
+        assert events(frames)[-1] == {"content": "efg", "done": True, "metadata": {"eval_count": 4}}
+        assert all("metadata" not in e and e["done"] is False for e in events(frames)[:-1])
+
+        # A pause upstream flushes what is buffered once the window expires
+        frames = await collect(tokens("a", "b", "c", pause_after=1), flush_interval_ms=10)
+        assert [e["content"] for e in events(frames)] == ["ab", "c"]
+
+        # Quotes, newlines and non-ASCII content survive the byte templates
+        text = 'héllo "x"\n'
+        assert json.loads(sse.frame(text)[len(b"data: "):]) == {"content": text, "done": False}
+
+        # Tokens read before an upstream error still reach the client
+        stream = sse.encode_batched(
+            tokens("a", "b", fail=True), StreamOptions(flush_interval_ms=10_000)
+        )
+        received = []
+        with pytest.raises(RuntimeError):
+            async for f in stream:
+                received.append(f)
+        assert [e["content"] for e in events(received)] == ["ab"]
+
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 30)).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        try:
+            body = {"message": "hi", "stream_options": {"flush_bytes": 16}}
+            status, _, payload = await call_app(chat_app(), "POST", "/api/chat/stream", body=body)
+        finally:
+            await transport.close()
+            await upstream.stop()
+        frames = [f + b"\n\n" for f in payload.split(b"\n\n") if f]
+        assert status == 200 and frames[-1] == sse.DONE_FRAME
+        assert "".join(e["content"] for e in events(frames)) == "tok" * 30
+        assert len(frames) < 30 and events(frames)[-1]["done"] is True
+
+    asyncio.run(scenario())
+
+
+def test_raw_passthrough_relays_bytes_and_parses_only_the_tail(monkeypatch):
+    parse = OllamaService.parse_final_record
+    done = b'{"done":true,"eval_count":7,"prompt_eval_count":3}'
+    assert parse(b'{"done":false}\n' + done + b"\n") == {
+        "done": True, "eval_count": 7, "prompt_eval_count": 3
+    }
+    # A tail cut mid-record, a last record that is not the done one, or no data at all
+    assert parse(b'{"done":false}\n{"done":tr') == {}
+    assert parse(done + b'\n{"done":false}\n') == {}
+    assert parse(b"") == {}
+
+    async def scenario():
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 50)).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        # Keep only a few records of tail, so the done record must be found in it
+        monkeypatch.setattr(ollama_service, "PASSTHROUGH_TAIL_BYTES", 64)
+        quota = TokenQuota(enabled=True, budget=100_000, window=3600)
+        monkeypatch.setattr(chat, "token_quota", quota)
+        app = chat_app()
+        try:
+            status, headers, body = await call_app(
+                app, "POST", "/api/chat/raw", body={"message": "hi"}
+            )
+            records = [json.loads(line) for line in body.splitlines()]
+            assert status == 200 and headers[b"content-type"] == b"application/x-ndjson"
+            assert len(records) == 51 and records[-1]["done"] is True
+            # Charged from the done record: estimated prompt plus eval_count
+            assert quota.charged == 1 + 2
+
+            # Without a done record the generated tokens are estimated, one per record,
+            # and the request is left out of residency usage
+            requests = service.residency.usage["llama3.2"].requests
+            upstream.send_done = False
+            status, _, body = await call_app(
+                app, "POST", "/api/chat/raw", body={"message": "hi"}
+            )
+            assert status == 200 and len(body.splitlines()) == 50
+            assert quota.charged == 1 + 2 + 1 + 50
+            assert service.residency.usage["llama3.2"].requests == requests
+
+            status, _, _ = await call_app(
+                app, "POST", "/api/chat/raw", body={"message": "hi", "provider": "openai"}
+            )
+            assert status == 400
+            status, _, _ = await call_app(
+                app, "POST", "/api/chat/raw", body={"message": "hi", "conversation_id": "c1"}
+            )
+            assert status == 400
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+async def stream_until_disconnect(app, path, frames_before_disconnect, headers=()):
+    """Drive one streaming request over ASGI and hang up after a few frames"""
+    body = json.dumps({"message": "hi"}).encode()
+    disconnect = asyncio.Event()
+    state = {"body_sent": False, "frames": 0, "disconnected_at": None}
+
+    async def receive():
+        if not state["body_sent"]:
+            state["body_sent"] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            state["frames"] += 1
+            if state["frames"] == frames_before_disconnect:
+                state["disconnected_at"] = asyncio.get_running_loop().time()
+                disconnect.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), *headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    await app(scope, receive, send)
+    return state
+
+
+@pytest.mark.parametrize("path", ["/api/chat/stream", "/api/chat/raw"])
+def test_client_disconnect_aborts_upstream(monkeypatch, path):
+    async def scenario():
+        upstream = await FakeOllama(reply=" ".join(["tok"] * 500), delay=0.01).start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        app = FastAPI()
+        app.include_router(chat.router, prefix="/api")
+        disconnects = stream_monitor.disconnected
+        wasted = stream_monitor.wasted_tokens
+        try:
+            state = await stream_until_disconnect(app, path, frames_before_disconnect=3)
+
+            await asyncio.wait_for(upstream.aborted.wait(), timeout=2)
+            assert upstream.aborted_at - state["disconnected_at"] < 0.5
+            assert upstream.sent < 500
+
+            assert stream_monitor.disconnected == disconnects + 1
+            assert stream_monitor.wasted_tokens > wasted
+            assert "llama3.2" not in model_scheduler.stats()["providers"]["ollama"]["models"]
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_slow_non_streaming_generation_outlives_first_byte(monkeypatch):
+    monkeypatch.setattr(settings, "TIMEOUT_OVERRIDES", {"ollama:llama3.2": {"first_byte": 0.2}})
+    monkeypatch.setattr(timeouts, "_policies", {})
+
+    async def scenario():
+        # Ollama sends a non-streaming body only when generation finishes
+        slow = await FakeOllama(reply="done", first_delay=0.5).start()
+        service, transport = await make_service([slow.url])
+        try:
+            response = await service.chat_completion(ChatRequest(message="hi"))
+            assert response.message == "done"
+            assert slow.calls == 1
+            assert service.nodes.nodes[0].failures == 0
+        finally:
+            await transport.close()
+            await slow.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stalled_nodes_fail_fast(monkeypatch):
+    monkeypatch.setattr(
+        settings, "TIMEOUT_OVERRIDES", {"ollama:llama3.2": {"first_byte": 0.2, "chunk_gap": 0.2}}
+    )
+    monkeypatch.setattr(timeouts, "_policies", {})
+
+    # Only models with an override get a policy of their own; the rest share the provider's
+    assert timeouts.timeout_policy("ollama", "llama3.2").first_byte == 0.2
+    shared = timeouts.timeout_policy("ollama")
+    for model in ("made-up-1", "made-up-2"):
+        assert timeouts.timeout_policy("ollama", model) is shared
+    assert len(timeouts._policies) == 2
+
+    async def scenario():
+        hung = await FakeOllama(loaded=["llama3.2"], first_delay=1).start()
+        healthy = await FakeOllama(reply="ok").start()
+        stalling = await FakeOllama(reply="a b c", delay=1).start()
+        service, transport = await make_service([hung.url, healthy.url])
+        loop = asyncio.get_running_loop()
+        try:
+            await service.nodes.probe_all()
+
+            # No first byte within budget: the request moves on to the next node
+            started = loop.time()
+            chunks = [c async for c in service.chat_completion_stream(ChatRequest(message="hi"))]
+            assert "".join(c.content for c in chunks) == "ok"
+            assert loop.time() - started < 0.8
+            assert hung.calls == 1
+
+
+            # A stall after the first chunk fails the stream on the chunk-gap budget
+            single = OllamaService(
+                transport=transport,
+                nodes=OllamaNodePool([stalling.url], transport=transport, probe_interval=0),
+            )
+            received = []
+            with pytest.raises(Exception, match="chunk_gap"):
+                async for chunk in single.chat_completion_stream(ChatRequest(message="hi")):
+                    received.append(chunk.content)
+            assert received == ["a"]
+        finally:
+            await transport.close()
+            await hung.stop()
+            await healthy.stop()
+            await stalling.stop()
+
+    asyncio.run(scenario())
+
+
+async def make_failover(ollama_url, openai_url, **options):
+    ollama, transport = await make_service([ollama_url])
+    openai = OpenAIService(transport=transport)
+    openai.api_key, openai.base_url = "test", openai_url
+    failover = ProviderFailover(
+        {"ollama": ollama, "openai": openai},
+        fallbacks={"ollama:llama3.2": ["openai:gpt-4o-mini"]},
+        **options,
+    )
+    return failover, transport
+
+
+def test_falls_back_to_next_provider(monkeypatch):
+    async def scenario():
+        broken = await FakeOllama(status=500).start()
+        backup = await FakeOpenAI().start()
+        failover, transport = await make_failover(broken.url, backup.url, hedge_enabled=False)
+        try:
+            response = await failover.complete(ChatRequest(message="hi"))
+            assert response.message == "Hi from OpenAI"
+            assert response.metadata["route"] == "openai:gpt-4o-mini"
+
+            chunks = [c async for c in failover.stream(ChatRequest(message="hi"))]
+            assert "".join(c.content for c in chunks) == "Hi from OpenAI"
+            assert chunks[-1].metadata["route"] == "openai:gpt-4o-mini"
+            assert failover.fallbacks_used == 2
+
+            # A request can opt out of the configured chain
+            with pytest.raises(Exception, match="500"):
+                await failover.complete(ChatRequest(message="hi", fallbacks=[]))
+
+            # Client-chosen fallbacks must name models the catalog knows
+            catalog = ModelCatalog({"ollama": failover.services["ollama"]}, validate=True)
+            await catalog.get("ollama")
+            monkeypatch.setattr(chat, "model_catalog", catalog)
+            chat.check_model(ChatRequest(message="hi", fallbacks=["ollama:llama3.2:latest"]))
+            with pytest.raises(HTTPException) as unknown:
+                chat.check_model(ChatRequest(message="hi", fallbacks=["ollama:made-up"]))
+            assert unknown.value.status_code == 400 and "made-up" in unknown.value.detail
+        finally:
+            await transport.close()
+            await broken.stop()
+            await backup.stop()
+
+    asyncio.run(scenario())
+
+
+def test_fallback_answers_are_not_cached_or_coalesced_as_the_primary(monkeypatch):
+    async def scenario():
+        broken = await FakeOllama(status=500).start()
+        backup = await FakeOpenAI().start()
+        routed, transport = await make_failover(broken.url, backup.url, hedge_enabled=False)
+        cache = ResponseCache(enabled=True, max_entries=8, ttl=60, max_temperature=0)
+        monkeypatch.setattr(chat, "failover", routed)
+        monkeypatch.setattr(chat, "response_cache", cache)
+        app = chat_app()
+        try:
+            for _ in range(2):
+                status, headers, body = await call_app(
+                    app, "POST", "/api/chat", body={"message": "hi", "temperature": 0}
+                )
+                assert status == 200 and json.loads(body)["message"] == "Hi from OpenAI"
+                assert headers.get(b"x-cache") == b"MISS"
+            assert backup.calls == 2 and cache.stats()["memory_entries"] == 0
+        finally:
+            await transport.close()
+            await broken.stop()
+            await backup.stop()
+
+    asyncio.run(scenario())
+
+    # Identical requests with different fallback chains do not share a flight
+    plain = ChatRequest(message="hi", temperature=0)
+    chained = ChatRequest(message="hi", temperature=0, fallbacks=["openai:gpt-4o-mini"])
+    assert canonical_request_key(plain) == canonical_request_key(chained)
+    assert canonical_request_key(plain, routing=True) != canonical_request_key(chained, routing=True)
+
+
+def test_hedges_slow_first_token():
+    async def scenario():
+        slow = await FakeOllama(reply="too late", first_delay=1).start()
+        backup = await FakeOpenAI().start()
+        failover, transport = await make_failover(
+            slow.url, backup.url, hedge_enabled=True, hedge_delay=0.1
+        )
+        loop = asyncio.get_running_loop()
+        try:
+            started = loop.time()
+            chunks = [c async for c in failover.stream(ChatRequest(message="hi"))]
+            assert loop.time() - started < 0.8
+            assert "".join(c.content for c in chunks) == "Hi from OpenAI"
+            assert chunks[-1].metadata["hedged"] is True
+            assert failover.hedges == 1 and failover.hedges_won == 1
+            assert slow.calls == 1 and backup.calls == 1
+
+            # Once the primary's p95 TTFT is known it sets the hedge delay
+            failover.hedge_min_samples = 1
+            failover.ttft["ollama:llama3.2"] = TTFTStats()
+            failover.ttft["ollama:llama3.2"].record(0.05)
+            assert failover.hedge_after("ollama:llama3.2") == 0.05
+        finally:
+            await transport.close()
+            await slow.stop()
+            await backup.stop()
+
+    asyncio.run(scenario())
+
+
+def test_open_breaker_is_skipped_until_half_open_trial():
+    async def scenario():
+        primary = await FakeOllama().start()
+        backup = await FakeOpenAI().start()
+        ollama, transport = await make_service([primary.url])
+        openai = OpenAIService(transport=transport)
+        openai.api_key, openai.base_url = "test", backup.url
+        services = {"ollama": ollama, "openai": openai}
+        health = HealthMonitor(services, interval=0, failure_threshold=2, reset_timeout=0.2)
+        failover = ProviderFailover(
+            services, health=health, fallbacks={"ollama:llama3.2": ["openai:gpt-4o-mini"]}
+        )
+        try:
+            health.record("ollama", False)
+            health.record("ollama", False)
+            assert health.breakers["ollama"].state == "open"
+
+            response = await failover.complete(ChatRequest(message="hi"))
+            assert response.metadata["route"] == "openai:gpt-4o-mini"
+            assert primary.calls == 0
+            with pytest.raises(ProviderUnavailable):
+                failover.check(ChatRequest(message="hi", fallbacks=[]))
+
+            # After the cooldown one trial request is let through and closes the breaker
+            await asyncio.sleep(0.25)
+            response = await failover.complete(ChatRequest(message="hi"))
+            assert response.message == "Hello world"
+            assert health.breakers["ollama"].state == "closed"
+
+            # Probes run together; the snapshot is then served without any I/O
+            await health.probe_all()
+            calls = primary.calls
+            snapshot = health.snapshot()
+            assert snapshot["status"] == "healthy"
+            assert snapshot["providers"] == {"ollama": True, "openai": False}
+            assert primary.calls == calls
+
+            # Client errors say nothing about the provider's health; 5xx do
+            primary.status = 404
+            for _ in range(3):
+                with pytest.raises(Exception, match="404"):
+                    await failover.complete(ChatRequest(message="hi", fallbacks=[]))
+            assert health.breakers["ollama"].state == "closed"
+            primary.status = 500
+            for _ in range(2):
+                with pytest.raises(Exception, match="500"):
+                    await failover.complete(ChatRequest(message="hi", fallbacks=[]))
+            assert health.breakers["ollama"].state == "open"
+
+            # Transport errors of wrapped providers count too: the wrapper keeps the cause
+            openai.base_url = "http://127.0.0.1:9"
+            unreachable = ChatRequest(
+                message="hi", provider="openai", model="gpt-4o-mini", fallbacks=[]
+            )
+            health.record("openai", True)
+            with pytest.raises(Exception, match="OpenAI chat completion failed"):
+                await failover.complete(unreachable)
+            assert health.breakers["openai"].consecutive_failures == 1
+            with pytest.raises(Exception, match="OpenAI streaming failed"):
+                [c async for c in failover.stream(unreachable)]
+            assert health.breakers["openai"].state == "open"
+        finally:
+            await transport.close()
+            await primary.stop()
+            await backup.stop()
+
+    asyncio.run(scenario())
+
+
+def test_model_catalog_serves_stale_while_revalidating():
+    async def scenario():
+        upstream = await FakeOllama(available=["llama3.2:latest"]).start()
+        service, transport = await make_service([upstream.url])
+        catalog = ModelCatalog({"ollama": service}, ttl=0.5, max_stale=60)
+        try:
+            entry = await catalog.get("ollama")
+            assert catalog.is_known("ollama", "llama3.2")
+            assert not catalog.is_known("ollama", "mistral")
+
+            # Curated lists (OpenAI's filter, Perplexity's static list) are not authoritative
+            openai = OpenAIService(transport=transport)
+            openai.get_models = service.get_models
+            curated = ModelCatalog({"openai": openai}, validate=True)
+            await curated.get("openai")
+            assert curated.lists("openai", "llama3.2") and curated.is_known("openai", "o3-mini")
+
+            upstream.available.append("mistral")
+            await asyncio.sleep(0.55)
+            # Stale: served at once while a single refresh runs in the background
+            assert await catalog.get("ollama") is entry
+            await asyncio.sleep(0.1)
+            fresh = await catalog.get("ollama")
+            assert fresh.etag != entry.etag
+            assert catalog.is_known("ollama", "mistral")
+            assert catalog.stale_hits == 1 and catalog.misses == 1
+
+            assert etag_matches(f"W/{fresh.etag}, \"other\"", fresh.etag)
+            assert not etag_matches(entry.etag, fresh.etag)
+
+            # A failed refresh keeps the last list only until max_stale runs out
+            async def unreachable():
+                raise ConnectionError("node down")
+
+            service.get_models = unreachable
+            catalog.max_stale = 0.3
+            await asyncio.sleep(0.55)
+            assert await catalog.get("ollama") is fresh
+            await asyncio.sleep(0.3)
+            with pytest.raises(ConnectionError):
+                await catalog.get("ollama")
+            assert catalog.refresh_errors == 2 and not catalog.lists("ollama", "mistral")
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+        # With several nodes the catalog is the union of what each has pulled
+        first = await FakeOllama(available=["llama3.2", "mistral"]).start()
+        second = await FakeOllama(available=["llama3.2", "qwen2.5:7b"]).start()
+        gone = await FakeOllama().start()
+        await gone.stop()
+        service, transport = await make_service([first.url, gone.url, second.url])
+        try:
+            names = [model.name for model in await service.get_models()]
+            assert names == ["llama3.2:latest", "mistral:latest", "qwen2.5:7b"]
+            assert service.nodes.nodes[1].consecutive_failures == 1
+        finally:
+            await transport.close()
+            await first.stop()
+            await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_residency_warms_keeps_hot_models_and_unloads_idle():
+    async def scenario():
+        upstream = await FakeOllama().start()
+        service, transport = await make_service([upstream.url])
+        service.residency = ModelResidency(
+            service.nodes,
+            warm_models=["llama3.2"],
+            pinned_models=["pinned", "qwen2.5:latest"],
+            hot_requests=2,
+            unload_idle_after=0.1,
+        )
+        try:
+            await service.residency.warm()
+            assert upstream.loaded == ["llama3.2"]
+            assert "llama3.2" in service.nodes.nodes[0].loaded_models
+
+            await service.chat_completion(ChatRequest(message="hi"))
+            await service.chat_completion(ChatRequest(message="hi"))
+            await service.chat_completion(ChatRequest(message="hi"))
+            # Cold until the second request lands, hot afterwards
+            assert upstream.keep_alives[1:] == ["5m", "5m", "30m"]
+            assert service.residency.keep_alive("pinned") == -1
+            # Pins and traffic match with or without the implicit ":latest" tag
+            assert service.residency.keep_alive("pinned:latest") == -1
+            assert service.residency.keep_alive("qwen2.5") == -1
+            assert service.residency.keep_alive("llama3.2:latest") == "30m"
+            usage = service.residency.stats()["models"]["llama3.2"]
+            assert usage["requests"] == 3 and usage["last_load_ms"] == 2.0
+
+            assert await service.residency.unload_idle() == []
+            await asyncio.sleep(0.15)
+            assert await service.residency.unload_idle() == ["llama3.2"]
+            assert upstream.keep_alives[-1] == 0 and upstream.loaded == []
+        finally:
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_conversation_turns_send_only_the_new_message(monkeypatch, tmp_path):
+    async def scenario():
+        upstream = await FakeOllama(reply="Sure").start()
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        path = str(tmp_path / "conversations.sqlite3")
+        store = ConversationStore(sqlite_path=path)
+        monkeypatch.setattr(chat, "conversation_store", store)
+        http_request = Request({"type": "http", "headers": [], "client": ("127.0.0.1", 1)})
+        try:
+            seed = [
+                ChatMessage(role="user", content="hi"),
+                ChatMessage(role="assistant", content="hello"),
+            ]
+            conversation = await store.create("Be brief", seed)
+            for message in ("next", "again"):
+                request = ChatRequest(message=message, stream=False, conversation_id=conversation.id)
+                await chat.chat_completion(request, Response(), http_request, None, None)
+
+            assert [m["content"] for m in upstream.last_body["messages"]] == [
+                "Be brief", "hi", "hello", "next", "Sure", "again"
+            ]
+            assert [m.content for m in conversation.messages][-2:] == ["again", "Sure"]
+            # Each turn rendered only the messages added since the previous one
+            assert len(conversation.rendered["chat"]) == 4
+
+            reopened = await ConversationStore(sqlite_path=path).get(conversation.id)
+            assert reopened.system_prompt == "Be brief"
+            assert [m.content for m in reopened.messages] == [m.content for m in conversation.messages]
+            assert reopened.to_response(offset=4).messages[0].content == "again"
+        finally:
+            store.close()
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_context_window_trims_with_stable_cut_and_background_summary():
+    async def scenario():
+        upstream = await FakeOllama(reply="They talked about cats").start()
+        service, transport = await make_service([upstream.url])
+        window = ContextWindow(
+            {"ollama": service},
+            windows={"ollama": 300},
+            policy="summarize",
+            reserve_tokens=20,
+            summary_model="ollama:llama3.2",
+            summary_max_tokens=20,
+        )
+        conversation = Conversation("c1", messages=[ChatMessage(role="system", content="Be kind")])
+        for i in range(30):
+            role = "user" if i % 2 == 0 else "assistant"
+            conversation.messages.append(ChatMessage(role=role, content=f"message {i:02d} " * 4))
+        try:
+            fitted = window.fit(ChatRequest(message="hi", history=conversation.history()))
+            kept = fitted.history
+            assert kept[0].content == "Be kind"
+            assert 1 < len(kept) < 31 and kept[-1].content.startswith("message 29")
+            assert fitted.system_prompt is None  # summary not ready yet
+
+            await asyncio.gather(*window._background)
+            conversation.messages.append(ChatMessage(role="user", content="message 30 " * 4))
+            fitted = window.fit(ChatRequest(message="hi", history=conversation.history()))
+            # Same cut point as the previous turn, so the prompt prefix is unchanged
+            assert fitted.history[:len(kept)] == kept
+            assert fitted.system_prompt.endswith("They talked about cats")
+            assert window.summaries == 1 and window.summary_hits == 1
+            assert "message 00" in upstream.last_body["messages"][-1]["content"]
+
+            # Another client's history ends the same way but has a different start:
+            # it must not be handed this conversation's summary
+            other = [ChatMessage(role="user", content="a secret " * 4)] + list(conversation.messages[2:])
+            fitted = window.fit(ChatRequest(message="hi", history=other))
+            assert fitted.system_prompt is None and window.summary_hits == 1
+        finally:
+            await window.close()
+            await transport.close()
+            await upstream.stop()
+
+    asyncio.run(scenario())
+
+
+def test_batch_bounds_concurrency_per_model_and_resumes():
+    async def scenario():
+        active = {}
+        peak = {}
+        calls = Counter()
+
+        async def run(request):
+            calls[request.message] += 1
+            active[request.model] = active.get(request.model, 0) + 1
+            peak[request.model] = max(peak.get(request.model, 0), active[request.model])
+            await asyncio.sleep(0.05 if request.model == "slow" else 0.01)
+            active[request.model] -= 1
+            if request.message == "bad" or (request.message == "m6" and calls["m6"] == 1):
+                raise ProviderUnavailable("breaker open", retry_after=0)
+            if request.message == "m9":
+                raise QuotaExceeded("Token budget exceeded", retry_after=3600)
+            return ChatResponse(
+                message=request.message.upper(), model=request.model, provider="ollama"
+            )
+
+        lines = [
+            {"message": "bad" if i == 3 else f"m{i}", "model": "slow" if i < 4 else "fast"}
+            for i in range(12)
+        ]
+        body = "\n".join(json.dumps(line) for line in lines).encode()
+        requests = parse_batch(body, "application/x-ndjson")
+        runner = BatchRunner(concurrency=2, max_running=1, max_attempts=3, max_retry_wait=1)
+        job = runner.submit(requests, run)
+        # Unfinished batches are never pruned, so their number is capped
+        with pytest.raises(BatchRejected):
+            runner.submit(requests, run)
+
+        received = []
+        async for chunk in job.stream():
+            received.extend(chunk.splitlines())
+            if len(received) >= 5:
+                break  # client drops the connection
+        async for chunk in job.stream(after=len(received)):
+            received.extend(chunk.splitlines())
+
+        records = [json.loads(line) for line in received]
+        assert records[-1] == {
+            "batch_id": job.id, "done": True, "total": 12, "completed": 10, "failed": 2,
+            "cancelled": False,
+        }
+        results = {r["index"]: r for r in records[:-1]}
+        assert sorted(results) == list(range(12))
+        # Rejections with a Retry-After are retried, up to max_attempts tries
+        assert results[3]["status"] == 503 and calls["bad"] == 3
+        assert results[6]["response"]["message"] == "M6" and calls["m6"] == 2
+        # ...unless waiting would take longer than max_retry_wait
+        assert results[9]["status"] == 429 and calls["m9"] == 1
+        assert runner.retried == 3
+        assert results[5]["response"]["message"] == "M5"
+        # Completion order: the fast model finishes before the slow one
+        assert records[0]["index"] >= 4
+        assert peak == {"slow": 2, "fast": 2}
+
+    asyncio.run(scenario())
+
+
+def test_jobs_survive_restart_retry_rejections_and_cancel(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "jobs.sqlite3")
+        started = asyncio.Event()
+        attempts = {}
+
+        async def hang(request, client, priority):
+            started.set()
+            await asyncio.Event().wait()
+
+        async def run(request, client, priority):
+            attempts[request.message] = attempts.get(request.message, 0) + 1
+            if request.message == "busy" and attempts["busy"] == 1:
+                raise ProviderUnavailable("breaker open", retry_after=0)
+            return ChatResponse(message=request.message.upper(), model="m", provider="ollama")
+
+        first = JobManager(SQLiteJobQueue(path), workers=1, poll_interval=0.01)
+        first.start(hang)
+        interrupted = await first.submit(ChatRequest(message="long", model="m"), "c")
+        await asyncio.wait_for(started.wait(), 1)
+        # A wait that times out does not leave its event behind
+        assert (await first.wait(interrupted.id, 0.05)).status == "running"
+        assert not first._finished
+        queued = await first.submit(ChatRequest(message="drop", model="m"), "c")
+        assert (await first.cancel(queued.id)).status == "cancelled"
+        await first.stop()  # restart: the running job goes back to the queue
+        first.close()
+
+        second = JobManager(SQLiteJobQueue(path), workers=2, poll_interval=0.01)
+        busy = await second.submit(ChatRequest(message="busy", model="m"), "c")
+        second.start(run)
+        done = await second.wait(interrupted.id, 2)
+        assert done.status == "succeeded" and done.attempts == 2
+        assert ChatResponse.model_validate_json(done.result).message == "LONG"
+        busy = await second.wait(busy.id, 2)
+        assert busy.status == "succeeded" and attempts["busy"] == 2
+        assert (await second.get(queued.id)).status == "cancelled"
+        assert "drop" not in attempts
+        stats = await second.stats()
+        assert stats["retried"] == 1
+        assert stats["queue"] == {"succeeded": 2, "cancelled": 1}
+        await second.stop()
+        second.close()
+
+        # A long job keeps its heartbeat fresh, so it is not mistaken for an abandoned one;
+        # cancelling it from another process stops it on its owner's next heartbeat
+        started.clear()
+        owner = JobManager(SQLiteJobQueue(path), workers=1, poll_interval=0.01, stale_after=0.3)
+        other = JobManager(SQLiteJobQueue(path), workers=0, poll_interval=0.01, stale_after=0.3)
+        owner.start(hang)
+        long = await owner.submit(ChatRequest(message="long", model="m"), "c")
+        await asyncio.wait_for(started.wait(), 1)
+        await asyncio.sleep(0.5)
+        assert await other.queue.requeue(stale_before=time.time() - other.stale_after) == 0
+        assert (await other.cancel(long.id)).status == "cancelled"
+        await asyncio.sleep(0.2)
+        assert not owner._running
+        assert (await owner.get(long.id)).status == "cancelled"
+        await owner.stop()
+        owner.close()
+
+        # A late outcome never overwrites a cancel or another worker's claim
+        queue = other.queue
+        slow = await other.submit(ChatRequest(message="slow", model="m"), "c")
+        claimed = await queue.claim("dead")
+        assert claimed.id == slow.id
+        assert await queue.requeue(stale_before=time.time() + 1, max_attempts=5) == 1
+        assert (await queue.claim("alive")).attempts == 2
+        claimed.status = "succeeded"
+        assert not await queue.save(claimed, "dead")
+        assert (await queue.get(slow.id)).owner == "alive"
+        await queue.cancel(slow.id, running=True)
+        claimed.owner = "alive"
+        assert not await queue.save(claimed, "alive")
+        assert (await queue.get(slow.id)).status == "cancelled"
+
+        # A job reclaimed as stale too often is failed rather than requeued again
+        poison = await other.submit(ChatRequest(message="poison", model="m"), "c")
+        for _ in range(2):
+            await queue.claim("dead")
+            await queue.requeue(stale_before=time.time() + 1, max_attempts=2)
+        poison = await queue.get(poison.id)
+        assert poison.status == "failed" and poison.attempts == 2
+        other.close()
+
+    asyncio.run(scenario())
+
+
+def sample(name, **labels):
+    """Current value of one rendered metrics sample, 0 if absent"""
+    wanted = name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+    for line in metrics.render().splitlines():
+        if line.startswith(wanted + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_break_down_latency_tokens_and_errors(monkeypatch):
+    async def scenario():
+        node = await FakeOllama(reply="one two three", delay=0.01).start()
+        broken = await FakeOllama(status=503).start()
+        backup = await FakeOpenAI().start()
+        failover, transport = await make_failover(node.url, backup.url, hedge_enabled=False)
+        catalog = ModelCatalog({"ollama": failover.services["ollama"]})
+        await catalog.get("ollama")
+        monkeypatch.setattr(metrics, "listed", catalog.lists)
+        labels = {"provider": "ollama", "model": "llama3.2"}
+        before = {
+            "complete": sample("llm_request_duration_seconds_count", **labels, mode="complete"),
+            "stream": sample("llm_request_duration_seconds_count", **labels, mode="stream"),
+            "ttft": sample("llm_time_to_first_token_seconds_count", **labels),
+            "rate": sample("llm_tokens_per_second_count", **labels),
+            "load": sample("ollama_duration_seconds_count", model="llama3.2", phase="load"),
+            "errors": sample("llm_errors_total", **labels, error="upstream_5xx"),
+        }
+        try:
+            await failover.complete(ChatRequest(message="hi", fallbacks=[]))
+            [c async for c in failover.stream(ChatRequest(message="hi", fallbacks=[]))]
+
+            failing, failing_transport = await make_failover(
+                broken.url, backup.url, hedge_enabled=False
+            )
+            response = await failing.complete(ChatRequest(message="hi"))
+            assert response.provider == "openai"
+            await failing_transport.close()
+        finally:
+            await transport.close()
+            await node.stop()
+            await broken.stop()
+            await backup.stop()
+
+        after = {
+            "complete": sample("llm_request_duration_seconds_count", **labels, mode="complete"),
+            "stream": sample("llm_request_duration_seconds_count", **labels, mode="stream"),
+            "ttft": sample("llm_time_to_first_token_seconds_count", **labels),
+            "rate": sample("llm_tokens_per_second_count", **labels),
+            "load": sample("ollama_duration_seconds_count", model="llama3.2", phase="load"),
+            "errors": sample("llm_errors_total", **labels, error="upstream_5xx"),
+        }
+        assert {k: after[k] - before[k] for k in before} == {
+            "complete": 1, "stream": 1, "ttft": 1, "rate": 2, "load": 1, "errors": 1,
+        }
+        text = metrics.render()
+        assert 'llm_time_to_first_token_seconds_bucket{provider="ollama",model="llama3.2",le="+Inf"}' in text
+        assert "# TYPE llm_active_streams gauge" in text
+        assert 'http_pool_connections{state="limit"}' in text
+        assert error_class(Exception("wrapped")) == "error"
+
+        # Transport failures of non-Ollama providers are classified through the wrapper
+        openai = OpenAIService(transport=HTTPTransport())
+        openai.api_key, openai.base_url = "test", "http://127.0.0.1:9"
+        unreachable = ProviderFailover({"openai": openai})
+        labels = {"provider": "openai", "model": "other"}
+        connection = sample("llm_errors_total", **labels, error="connection")
+        await openai.transport.start()
+        try:
+            with pytest.raises(Exception, match="OpenAI chat completion failed"):
+                await unreachable.complete(
+                    ChatRequest(message="hi", provider="openai", model="gpt-4o-mini", fallbacks=[])
+                )
+        finally:
+            await openai.transport.close()
+        assert sample("llm_errors_total", **labels, error="connection") == connection + 1
+        try:
+            try:
+                raise asyncio.TimeoutError()
+            except asyncio.TimeoutError as e:
+                raise Exception(f"Perplexity streaming failed: {e}")
+        except Exception as wrapped:
+            assert error_class(wrapped) == "timeout"
+
+        # Model names outside the catalog share one series
+        other = sample("llm_errors_total", provider="ollama", model="other", error="error")
+        record_error("ollama", "made-up-1", Exception("boom"))
+        record_error("ollama", "made-up-2", Exception("boom"))
+        assert sample("llm_errors_total", provider="ollama", model="other", error="error") == other + 2
+        assert 'model="made-up-1"' not in metrics.render()
+        assert error_class(asyncio.TimeoutError()) == "timeout"
+
+    asyncio.run(scenario())
+
+
+def test_tracing_spans_nest_and_propagate_to_upstream(monkeypatch):
+    async def scenario():
+        exporter = InMemorySpanExporter()
+        monkeypatch.setattr(tracer, "enabled", True)
+        monkeypatch.setattr(tracer, "exporter", exporter)
+        upstream = await FakeOllama(reply="traced reply").start()
+        external = await FakeOllama(reply="third party").start()
+        monkeypatch.setattr(tracer, "propagate_hosts", {upstream.url.split("://")[1]})
+        service, transport = await make_service([upstream.url])
+        monkeypatch.setitem(chat.SERVICE_REGISTRY, "ollama", service)
+        app = FastAPI()
+        app.include_router(chat.router, prefix="/api")
+
+        @app.get("/api/items/{item_id}")
+        async def item(item_id: str):
+            return {"id": item_id}
+
+        caller = "00-" + "ab" * 16 + "-" + "cd" * 8 + "-01"
+        try:
+            await stream_until_disconnect(
+                TracingMiddleware(app), "/api/chat/stream", frames_before_disconnect=0,
+                headers=[(b"traceparent", caller.encode())],
+            )
+            # Hosts outside the propagation list get no traceparent
+            other = OllamaService(
+                transport=transport,
+                nodes=OllamaNodePool([external.url], transport=transport, probe_interval=0),
+            )
+            await other.chat_completion(ChatRequest(message="hi"))
+            assert external.calls == 1 and external.traceparent is None
+
+            # Server spans are named after the route template, not the raw path
+            for item_id in ("a1", "b2"):
+                await call_app(TracingMiddleware(app), "GET", f"/api/items/{item_id}")
+            await call_app(TracingMiddleware(app), "GET", "/api/nowhere")
+            assert len(exporter.named("GET /api/items/{item_id}")) == 2
+            assert len(exporter.named("GET")) == 1
+        finally:
+            await transport.close()
+            await upstream.stop()
+            await external.stop()
+
+        server, = exporter.named("POST /api/chat/stream")
+        handler, = exporter.named("chat.stream")
+        build = exporter.named("ollama.build_messages")[0]  # the streamed request's
+        upstream_call = [
+            s for s in exporter.named("HTTP POST")
+            if s.attributes["url.full"] == f"{upstream.url}/api/chat"
+        ]
+        assert len(upstream_call) == 1
+        streamed = (server, handler, build, *upstream_call)
+        assert {span.trace_id for span in streamed} == {"ab" * 16}
+        assert server.parent_id == "cd" * 8 and server.kind == "server"
+        assert handler.parent_id == server.span_id
+        assert build.parent_id == server.span_id  # built while the response streams
+        assert upstream_call[0].attributes["http.response.status_code"] == 200
+        assert upstream.traceparent == f"00-{'ab' * 16}-{upstream_call[0].span_id}-01"
+        # The server span lasts until the stream ends, after the upstream's headers
+        assert server.end_time >= upstream_call[0].end_time
+        assert server.attributes["http.response.status_code"] == 200
+
+        # Off: no spans and no context, decorated functions run untouched
+        monkeypatch.setattr(tracer, "enabled", False)
+        exporter.clear()
+        with tracer.span("ignored") as span:
+            assert span is None
+        assert service.build_prompt(ChatRequest(message="hi")).endswith("Assistant:")
+        assert exporter.spans == [] and tracer.trace_configs() == []
+
+    asyncio.run(scenario())
+
+
+def test_logging_is_queued_lazy_sampled_and_rate_limited():
+    stream = io.StringIO()
+    pipeline = LogPipeline(
+        stream=stream, level="INFO", log_format="json",
+        sample_rates={"request": 0.0}, rate_limit=2, rate_window=0.2,
+    )
+    logger = logging.getLogger("tests.structured")
+    logger.propagate = False
+    pipeline.install(logger)
+
+    class Probe:
+        formatted_on = None
+
+        def __str__(self):
+            Probe.formatted_on = threading.current_thread()
+            return "probe"
+
+    token = request_id.set("req-1")
+    try:
+        logger.info("Hello %s", Probe(), extra={"model": "llama3.2"})
+        logger.info("Calling model '%s'", "llama3.2", extra={"category": "request"})
+        for n in range(5):
+            logger.warning("Failed to decode stream chunk: %r", n)
+        logger.error("Upstream returned %d", 500)
+    finally:
+        request_id.reset(token)
+    time.sleep(0.25)
+    logger.warning("Failed to decode stream chunk: %r", "later")
+    pipeline.stop()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r["message"] for r in records] == [
+        "Hello probe",
+        "Failed to decode stream chunk: 0",
+        "Failed to decode stream chunk: 1",
+        "Upstream returned 500",
+        "Failed to decode stream chunk: 'later'",
+    ]
+    assert records[0]["request_id"] == "req-1" and records[0]["model"] == "llama3.2"
+    assert "request_id" not in records[-1]
+    # Repeats in a window are dropped; the next window reports how many
+    assert records[-1]["suppressed"] == 3
+    # Formatted by the writer thread, not the caller
+    assert Probe.formatted_on is not threading.current_thread()
+    assert pipeline.stats() == {"queued": 0, "dropped": 0, "sampled_out": 1, "suppressed": 3}
+
+    async def scenario():
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(request_id.get())
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        for header in (b"client-id-1", b"not valid!"):
+            scope = {"type": "http", "headers": [(b"x-request-id", header)]}
+            await RequestIdMiddleware(app)(scope, None, send)
+        assert seen[0] == "client-id-1" and len(seen[1]) == 32
+        assert [dict(m["headers"])[b"x-request-id"] for m in sent[::2]] == [
+            s.encode() for s in seen
+        ]
+        assert request_id.get() is None
+
+    asyncio.run(scenario())
+
+
+def test_diagnostics_catch_blocking_calls_and_profile_the_loop(monkeypatch):
+    def parse_huge_history():
+        time.sleep(0.3)  # stands in for synchronous work on the loop
+
+    def busy_loop_work(until):
+        while time.monotonic() < until:
+            pass
+
+    async def scenario():
+        monitor = LoopMonitor(enabled=True, interval=0.02, slow_threshold=0.1, keep=5)
+        monitor.start()
+        await asyncio.sleep(0.1)
+        parse_huge_history()
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+        stats = monitor.stats()
+        stall, = stats["slow_callbacks"]
+        assert stats["blocked"] == 1 and stats["lag"]["max_ms"] >= 250
+        assert "in parse_huge_history: time.sleep(0.3)" in stall["stack"][-1]
+        assert stall["duration_ms"] >= 250 and stall["blocked_ms"] >= 100
+
+        profiler = SamplingProfiler(max_seconds=5)
+        monkeypatch.setattr(diagnostics, "profiler", profiler)
+        monkeypatch.setattr(settings, "DIAGNOSTICS_ENABLED", True)
+        monkeypatch.setattr(settings, "DIAGNOSTICS_ADMIN_TOKEN", None)
+        app = FastAPI()
+        app.include_router(diagnostics.router, prefix="/admin")
+        admin = [(b"authorization", b"Bearer secret")]
+
+        # Without an admin token the endpoints stay closed
+        assert (await call_app(app, "POST", "/admin/profiler/start", admin))[0] == 404
+        monkeypatch.setattr(settings, "DIAGNOSTICS_ADMIN_TOKEN", "secret")
+
+        assert (await call_app(app, "POST", "/admin/profiler/start"))[0] == 401
+        status, _, _ = await call_app(app, "POST", "/admin/profiler/start?hz=200", admin)
+        assert status == 200 and profiler.running
+        assert (await call_app(app, "POST", "/admin/profiler/start", admin))[0] == 409
+        busy_loop_work(time.monotonic() + 0.2)
+        status, headers, body = await call_app(app, "POST", "/admin/profiler/stop", admin)
+        assert status == 200 and headers[b"content-type"].startswith(b"text/plain")
+
+        lines = body.decode().splitlines()
+        stack, count = lines[0].rsplit(" ", 1)
+        assert "busy_loop_work" in stack.split(";")[-1] and int(count) >= 10
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples
+        with pytest.raises(ProfilerError):
+            await profiler.stop()
+        assert (await call_app(app, "GET", "/admin/diagnostics", admin))[0] == 200
+
+        monkeypatch.setattr(settings, "DIAGNOSTICS_ENABLED", False)
+        assert (await call_app(app, "GET", "/admin/diagnostics", admin))[0] == 404
+
+    asyncio.run(scenario())